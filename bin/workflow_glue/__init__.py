@@ -1,12 +1,15 @@
 """Workflow Python code."""
 import argparse
+import ast
+import functools
 import glob
 import importlib
 import itertools
 import os
 import sys
 
-from .util import _log_level, get_main_logger  # noqa: ABS101
+from .util import (  # noqa: ABS101
+    _log_level, get_main_logger, metrics, profiler)
 
 
 __version__ = "0.0.1"
@@ -15,38 +18,88 @@ _package_name = "workflow_glue"
 HELPERS = "wfg_helpers"
 
 
-def get_components(allowed_components=None):
-    """Find a list of workflow command scripts."""
+@functools.lru_cache(maxsize=None)
+def get_manifest():
+    """Build a manifest of workflow command scripts without importing them.
+
+    Each candidate script is parsed (but not executed) to check it defines
+    top-level `main` and `argparser` functions, so that the CLI can be
+    assembled without paying for the imports of every component (pandas,
+    pysam, ezcharts, ...). The manifest is built once per process.
+
+    :return: dict mapping subcommand name to a dict with the dotted `module`
+        path, the `path` of the source file and a one line `help` string.
+    """
     logger = get_main_logger(_package_name)
 
     # gather all python files in the current directory and the wfg_helpers
     home_path = os.path.dirname(os.path.abspath(__file__))
     standard_lib = os.path.join(home_path, HELPERS)
     globs = itertools.chain.from_iterable((
-        glob.glob(os.path.join(path, "*.py"))
+        sorted(glob.glob(os.path.join(path, "*.py")))
         for path in (home_path, standard_lib)))
 
-    components = dict()
+    manifest = dict()
     for fname in globs:
         name = os.path.splitext(os.path.basename(fname))[0]
         if name in ("__init__", "util"):
             continue
+        try:
+            with open(fname, "rb") as fh:
+                tree = ast.parse(fh.read(), filename=fname)
+        except (OSError, SyntaxError, ValueError) as e:
+            logger.warn(f"Could not parse {name}: {e}")
+            continue
+
+        # if theres a main() and and argparser() thats good enough for us.
+        functions = {
+            node.name for node in tree.body
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))}
+        if not {"main", "argparser"}.issubset(functions):
+            continue
+
+        if os.path.dirname(fname) == standard_lib:
+            module = f"{_package_name}.{HELPERS}.{name}"
+        else:
+            module = f"{_package_name}.{name}"
+        docstring = ast.get_docstring(tree) or ""
+        manifest[name] = {
+            "module": module,
+            "path": fname,
+            "help": docstring.strip().split("\n")[0],
+        }
+    return manifest
+
+
+def stub_argparser(name):
+    """Make a placeholder parser for a component that has not been imported.
+
+    This is sufficient to list the component in the CLI help and to have
+    argparse reject unknown subcommands, without importing the component.
+    """
+    parser = argparse.ArgumentParser(name, add_help=False)
+    parser.add_argument("component_args", nargs=argparse.REMAINDER)
+    return parser
+
+
+def get_components(allowed_components=None):
+    """Find and import a list of workflow command scripts."""
+    logger = get_main_logger(_package_name)
+
+    components = dict()
+    for name, entry in get_manifest().items():
         if allowed_components is not None and name not in allowed_components:
             continue
 
         # leniently attempt to import module
         try:
-            if HELPERS in fname:
-                mod = importlib.import_module(f"{_package_name}.{HELPERS}.{name}")
-            else:
-                mod = importlib.import_module(f"{_package_name}.{name}")
+            mod = importlib.import_module(entry["module"])
         except ModuleNotFoundError as e:
             # if imports cannot be satisifed, refuse to add the component
             # rather than exploding
             logger.warn(f"Could not load {name} due to missing module {e.name}")
             continue
 
-        # if theres a main() and and argparser() thats good enough for us.
         try:
             req = "main", "argparser"
             if all(callable(getattr(mod, x)) for x in req):
@@ -56,8 +109,28 @@ def get_components(allowed_components=None):
     return components
 
 
-def cli():
-    """Run workflow entry points."""
+def _requested_component(argv, manifest):
+    """Return the name of the subcommand given in argv, if any."""
+    # skip over the top-level options, the first remaining positional
+    # argument is the subcommand
+    parser = _log_level()
+    parser.exit_on_error = False
+    try:
+        _, remaining = parser.parse_known_args(argv)
+    except argparse.ArgumentError:
+        # leave it to the full parser to report the problem
+        return None
+    for arg in remaining:
+        if not arg.startswith("-"):
+            return arg if arg in manifest else None
+    return None
+
+
+def cli(argv=None):
+    """Run workflow entry points.
+
+    :param argv: list of arguments to parse, defaults to `sys.argv[1:]`.
+    """
     logger = get_main_logger(_package_name)
     logger.info("Bootstrapping CLI.")
     parser = argparse.ArgumentParser(
@@ -74,22 +147,33 @@ def cli():
         help='additional help', dest='command')
     subparsers.required = True
 
-    # importing everything can take time, try to shortcut
-    if len(sys.argv) > 1:
-        components = get_components(allowed_components=[sys.argv[1]])
-        if not sys.argv[1] in components:
-            logger.warn("Importing all modules, this may take some time.")
-            components = get_components()
-    else:
-        components = get_components()
+    # only the requested component is imported, all others are represented
+    # by a placeholder built from the manifest
+    manifest = get_manifest()
+    if argv is None:
+        argv = sys.argv[1:]
+    requested = _requested_component(argv, manifest)
+    components = dict()
+    if requested is not None:
+        components = get_components(allowed_components=[requested])
 
     # add all module parsers to main CLI
-    for name, module in components.items():
-        p = subparsers.add_parser(
-            name.split(".")[-1], parents=[module.argparser()])
-        p.set_defaults(func=module.main)
-
-    args = parser.parse_args()
+    for name, entry in manifest.items():
+        if name in components:
+            module = components[name]
+            p = subparsers.add_parser(
+                name, parents=[module.argparser()], help=entry["help"])
+            p.set_defaults(func=module.main)
+        else:
+            subparsers.add_parser(
+                name, parents=[stub_argparser(name)], help=entry["help"])
+
+    args = parser.parse_args(argv)
+    if not hasattr(args, "func"):
+        # the component was found in the manifest but could not be imported
+        parser.error(f"Could not load subcommand '{args.command}'.")
 
     logger.info("Starting entrypoint.")
-    args.func(args)
+    with metrics(args.command, argv, sidecar=args.metrics):
+        with profiler(args.profile, args.profile_out, name=args.command):
+            args.func(args)
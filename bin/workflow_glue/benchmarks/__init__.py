@@ -0,0 +1,5 @@
+"""Benchmarks for workflow-glue components.
+
+These are not components themselves: each module is run directly, from
+the `bin` directory, with `python -m workflow_glue.benchmarks.<name>`.
+"""
@@ -0,0 +1,148 @@
+"""Benchmark configure_igv on large lists of files.
+
+A fofn of a reference and of BAM, VCF and bedMethyl files with their
+indexes, spread over a number of samples, is generated once for each
+layout, then `workflow-glue configure_igv` is run on it. With the
+`no_sample` layout the files are listed without sample names, so they all
+fall in a single bundle, which is the worst case for pairing files with
+their indexes.
+
+For each run we report the wall and CPU time, so that changes to
+`SampleBundle` or `TrackBuilder` can be compared against a baseline:
+
+    python -m workflow_glue.benchmarks.configure_igv --n-files 100000 > base.tsv
+"""
+import argparse
+import csv
+import logging
+import os
+import random
+import subprocess
+from subprocess import DEVNULL
+import sys
+import tempfile
+import time
+
+import workflow_glue
+
+
+WORKFLOW_GLUE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(workflow_glue.__file__))),
+    "workflow-glue")
+LAYOUTS = ["samples", "no_sample"]
+FIELDS = [
+    "layout", "n_files", "n_samples", "exit_status", "wall_time", "cpu_user",
+    "cpu_system", "files_per_s"]
+# files of a sample, each followed by its index
+DATA_FILES = [
+    ("bam", "bam.bai"), ("vcf.gz", "vcf.gz.tbi"),
+    ("bedmethyl.gz", "bedmethyl.gz.tbi")]
+
+logger = logging.getLogger(__name__)
+
+
+def generate_fofn(fname, n_files, n_samples, with_samples=True, seed=0):
+    """Write a fofn of at least n_files data files and indexes.
+
+    Files are shuffled within the list, so that indexes are not next to the
+    files they belong to.
+
+    :return: number of files listed, other than the reference.
+    """
+    rng = random.Random(seed)
+    lines = []
+    i = 0
+    while len(lines) < n_files:
+        sample = f"sample{i % n_samples}"
+        for ext, index_ext in DATA_FILES:
+            for path in (f"data/{sample}.{i}.{ext}", f"data/{sample}.{i}.{index_ext}"):
+                lines.append(f"{sample},{path}" if with_samples else path)
+        i += 1
+    rng.shuffle(lines)
+    with open(fname, "w") as fh:
+        fh.write("reference.fasta\nreference.fasta.fai\n")
+        fh.writelines(f"{line}\n" for line in lines)
+    return len(lines)
+
+
+def run_case(fofn, layout, n_files, n_samples):
+    """Run configure_igv once, returning a result row."""
+    cmd = [sys.executable, WORKFLOW_GLUE, "configure_igv", "--fofn", fofn]
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=DEVNULL, stderr=DEVNULL)
+    # wait4 gives the resources of configure_igv alone
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    row = {
+        "layout": layout,
+        "n_files": n_files,
+        "n_samples": n_samples if layout == "samples" else 0,
+        "exit_status": proc.returncode,
+        "wall_time": f"{wall:.3f}",
+        "cpu_user": f"{rusage.ru_utime:.3f}",
+        "cpu_system": f"{rusage.ru_stime:.3f}",
+    }
+    if proc.returncode == 0:
+        row["files_per_s"] = f"{n_files / wall:.0f}"
+    return row
+
+
+def run_benchmark(workdir, n_files, n_samples, layouts, repeats=1):
+    """Run each layout, yielding the result row with the fastest wall time."""
+    for layout in layouts:
+        fofn = os.path.join(workdir, f"{layout}.txt")
+        n_listed = generate_fofn(
+            fofn, n_files, n_samples, with_samples=layout == "samples")
+        rows = [
+            run_case(fofn, layout, n_listed, n_samples) for _ in range(repeats)]
+        row = min(rows, key=lambda r: float(r["wall_time"]))
+        if row["exit_status"]:
+            logger.warning(f"{layout} did not succeed.")
+        else:
+            logger.info(
+                f"{layout}: {row['wall_time']} s, {row['files_per_s']} files/s.")
+        yield row
+
+
+def argparser():
+    """Argument parser for the benchmark."""
+    parser = argparse.ArgumentParser(
+        "benchmark_configure_igv",
+        description=__doc__.split("\n")[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--n-files", type=int, default=100000,
+        help="Number of data and index files in the fofn")
+    parser.add_argument(
+        "--n-samples", type=int, default=2000,
+        help="Number of samples the files of the samples layout are spread over")
+    parser.add_argument(
+        "--layouts", nargs="+", choices=LAYOUTS, default=LAYOUTS,
+        help="Layouts of the fofn to run")
+    parser.add_argument(
+        "--workdir",
+        help="Directory for the generated fofn (defaults to a temporary one)")
+    parser.add_argument(
+        "--repeats", type=int, default=1,
+        help="Runs of each case, the fastest is reported")
+    return parser
+
+
+def main(args):
+    """Run the benchmark, writing a TSV of results to stdout."""
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        writer = csv.DictWriter(
+            sys.stdout, fieldnames=FIELDS, delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+        for row in run_benchmark(
+                workdir, args.n_files, args.n_samples, args.layouts,
+                repeats=args.repeats):
+            writer.writerow(row)
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='[%(asctime)s - %(name)s] %(message)s', level=logging.INFO)
+    main(argparser().parse_args())
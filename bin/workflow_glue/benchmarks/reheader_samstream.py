@@ -0,0 +1,275 @@
+"""Benchmark the throughput of reheader_samstream.
+
+A minimap2-shaped SAM stream of a given size is generated once, then
+`workflow-glue reheader_samstream` is run on it for each combination of
+input (a pipe, as from minimap2, or a file), passthrough strategy and
+output mode. The alignments are written to a pipe that is drained by
+`cat`, as they would be by samtools in a workflow.
+
+For each run we report throughput in MB/s and the CPU time spent by
+reheader_samstream per GB of input, so that changes to `SamHeader` or the
+copy loop can be compared against a baseline:
+
+    python -m workflow_glue.benchmarks.reheader_samstream --size 1G > base.tsv
+"""
+import argparse
+import csv
+import logging
+import os
+import random
+import subprocess
+from subprocess import DEVNULL, PIPE
+import sys
+import tempfile
+import time
+
+import workflow_glue
+from workflow_glue.wfg_helpers.reheader_samstream import COPY_STRATEGIES
+
+
+WORKFLOW_GLUE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(workflow_glue.__file__))),
+    "workflow-glue")
+INPUTS = ["pipe", "file"]
+PASSTHROUGHS = ["auto", "text"] + list(COPY_STRATEGIES)
+# Output modes and their extra arguments. Modes other than plain SAM pass
+# blocks of alignments through Python, so are only run with `auto`.
+MODES = {
+    "sam": [],
+    "stats": ["--stats-out", os.devnull],
+    "remap": ["--rg-collision", "remap"],
+    "bam": ["--output-bam", "--threads", "4"],
+}
+FIELDS = [
+    "mode", "input", "passthrough", "exit_status", "bytes", "wall_time",
+    "cpu_user", "cpu_system", "mb_per_s", "cpu_s_per_gb"]
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+# minimap2 FLAG values and their weights in the stream
+FLAGS = {0: 45, 16: 40, 256: 5, 2048: 3, 2064: 2, 4: 5}
+BASES = "ACGT"
+
+logger = logging.getLogger(__name__)
+
+
+def parse_size(size):
+    """Return a number of bytes from eg. 512M or 10G."""
+    size = size.upper().rstrip("B")
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def header_lines(n_sq, n_pg, n_rg, rg_description="basecalled"):
+    """Return the lines of a minimap2-like header."""
+    lines = [f"@SQ\tSN:chr{i}\tLN:{1000000 + i}" for i in range(n_sq)]
+    lines += [f"@RG\tID:run{i}\tDS:{rg_description}" for i in range(n_rg)]
+    for i in range(n_pg):
+        parent = f"\tPP:program{i - 1}" if i else ""
+        lines.append(
+            f"@PG\tID:program{i}\tPN:program\tVN:1.0{parent}\tCL:program --step {i}")
+    parent = f"\tPP:program{n_pg - 1}" if n_pg else ""
+    lines.append(
+        f"@PG\tID:minimap2\tPN:minimap2\tVN:2.28{parent}"
+        "\tCL:minimap2 -ax map-ont -y ref.mmi reads.fastq")
+    return lines
+
+
+def alignment_line(rng, i, n_sq, n_rg, read_length):
+    """Return a random minimap2-like alignment line."""
+    length = max(1, int(rng.gauss(read_length, read_length / 4)))
+    seq = "".join(rng.choices(BASES, k=length))
+    qual = "".join(rng.choices("+-5?", k=length))
+    flag = rng.choices(list(FLAGS), weights=list(FLAGS.values()))[0]
+    rg = f"RG:Z:run{rng.randrange(n_rg)}\t" if n_rg else ""
+    if flag & 4:
+        return f"read{i}\t4\t*\t0\t0\t*\t*\t0\t0\t{seq}\t{qual}\t{rg}rl:i:0\n"
+    if flag & 256:
+        # minimap2 does not output the sequence of secondary alignments
+        seq = qual = "*"
+    nm = rng.randrange(length // 10 + 1)
+    score = length - nm
+    return (
+        f"read{i}\t{flag}\tchr{rng.randrange(n_sq)}\t{rng.randrange(1, 1000000)}"
+        f"\t60\t{length}M\t*\t0\t0\t{seq}\t{qual}\t{rg}NM:i:{nm}\tms:i:{score}"
+        f"\tAS:i:{score}\tnn:i:0\ttp:A:P\tcm:i:{length // 20}\ts1:i:{score}"
+        f"\ts2:i:0\tde:f:{nm / length:.4f}\trl:i:0\n")
+
+
+def generate_stream(
+        fname, size, n_sq=25, n_pg=1, n_rg=1, read_length=5000,
+        n_distinct=1024, seed=0):
+    """Write a SAM stream of at least size bytes.
+
+    A pool of distinct alignment lines is repeated until the stream is
+    large enough, so that tens of GB can be generated quickly.
+
+    :return: number of bytes written.
+    """
+    rng = random.Random(seed)
+    header = "".join(f"{line}\n" for line in header_lines(n_sq, n_pg, n_rg))
+    pool = "".join(
+        alignment_line(rng, i, n_sq, n_rg, read_length)
+        for i in range(n_distinct)).encode()
+    written = 0
+    with open(fname, "wb") as fh:
+        written += fh.write(header.encode())
+        while written < size:
+            written += fh.write(pool)
+    return written
+
+
+def write_header_in(fname, n_rg, rg_description):
+    """Write a header_in with the RG of the stream and a basecaller PG."""
+    with open(fname, "w") as fh:
+        for i in range(n_rg):
+            fh.write(f"@RG\tID:run{i}\tDS:{rg_description}\n")
+        fh.write("@PG\tID:basecaller\tPN:dorado\tVN:0.8.0\n")
+
+
+def run_case(stream, header_in, input_from, passthrough, mode):
+    """Run reheader_samstream once, returning a result row."""
+    cmd = [
+        sys.executable, WORKFLOW_GLUE, "reheader_samstream", header_in,
+        "--passthrough", passthrough] + MODES[mode]
+    with open(stream, "rb") as fh:
+        if input_from == "pipe":
+            source = subprocess.Popen(["cat"], stdin=fh, stdout=PIPE)
+            stdin = source.stdout
+        else:
+            source = None
+            stdin = fh
+        sink = subprocess.Popen(["cat"], stdin=PIPE, stdout=DEVNULL)
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdin=stdin, stdout=sink.stdin, stderr=DEVNULL)
+        # the pipes belong to the children now
+        sink.stdin.close()
+        if source is not None:
+            source.stdout.close()
+        # wait4 gives the resources of reheader_samstream alone, rather
+        # than of all our children as with RUSAGE_CHILDREN
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if source is not None:
+            source.wait()
+        sink.wait()
+
+    size = os.path.getsize(stream)
+    cpu = rusage.ru_utime + rusage.ru_stime
+    row = {
+        "mode": mode,
+        "input": input_from,
+        "passthrough": passthrough,
+        "exit_status": proc.returncode,
+        "bytes": size,
+        "wall_time": f"{wall:.3f}",
+        "cpu_user": f"{rusage.ru_utime:.3f}",
+        "cpu_system": f"{rusage.ru_stime:.3f}",
+    }
+    # the throughput of a failed run is meaningless
+    if proc.returncode == 0:
+        row["mb_per_s"] = f"{size / 1e6 / wall:.1f}"
+        row["cpu_s_per_gb"] = f"{cpu / (size / 1e9):.3f}"
+    return row
+
+
+def cases(modes, inputs, passthroughs):
+    """Yield the (input, passthrough, mode) combinations to run."""
+    for mode in modes:
+        for input_from in inputs:
+            for passthrough in passthroughs:
+                if mode != "sam" and passthrough != "auto":
+                    continue
+                yield input_from, passthrough, mode
+
+
+def run_benchmark(stream, workdir, n_rg, modes, inputs, passthroughs, repeats=1):
+    """Run each case, yielding the result row with the fastest wall time."""
+    header_in = os.path.join(workdir, "header.sam")
+    # the stream's RG differ from these, to give collisions to remap
+    conflicting = os.path.join(workdir, "header.conflicting.sam")
+    write_header_in(header_in, n_rg, "basecalled")
+    write_header_in(conflicting, n_rg, "basecalled-elsewhere")
+
+    for input_from, passthrough, mode in cases(modes, inputs, passthroughs):
+        header = conflicting if mode == "remap" else header_in
+        rows = [
+            run_case(stream, header, input_from, passthrough, mode)
+            for _ in range(repeats)]
+        row = min(rows, key=lambda r: float(r["wall_time"]))
+        if row["exit_status"]:
+            # eg. sendfile needs a file to read from, or pysam is missing
+            logger.warning(f"{mode}/{input_from}/{passthrough} did not succeed.")
+        else:
+            logger.info(
+                f"{mode}/{input_from}/{passthrough}: {row['mb_per_s']} MB/s, "
+                f"{row['cpu_s_per_gb']} CPU s/GB.")
+        yield row
+
+
+def argparser():
+    """Argument parser for the benchmark."""
+    parser = argparse.ArgumentParser(
+        "benchmark_reheader_samstream",
+        description=__doc__.split("\n")[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--size", default="1G",
+        help="Size of the SAM stream, eg. 512M or 50G")
+    parser.add_argument(
+        "--stream",
+        help=(
+            "Existing SAM stream to benchmark with, rather than generating one "
+            "(the header_in RG are still named run0, run1, ...)"))
+    parser.add_argument(
+        "--workdir",
+        help="Directory for the generated stream (defaults to a temporary one)")
+    parser.add_argument(
+        "--n-sq", type=int, default=25, help="Number of SQ lines")
+    parser.add_argument(
+        "--n-pg", type=int, default=1,
+        help="Number of PG lines in the stream before minimap2's own")
+    parser.add_argument(
+        "--n-rg", type=int, default=1, help="Number of RG lines and tags")
+    parser.add_argument(
+        "--read-length", type=int, default=5000, help="Mean read length")
+    parser.add_argument(
+        "--modes", nargs="+", choices=list(MODES), default=list(MODES),
+        help="Output modes to run")
+    parser.add_argument(
+        "--inputs", nargs="+", choices=INPUTS, default=INPUTS,
+        help="How the stream is given to reheader_samstream")
+    parser.add_argument(
+        "--passthroughs", nargs="+", choices=PASSTHROUGHS, default=PASSTHROUGHS,
+        help="Passthrough strategies to run for SAM output")
+    parser.add_argument(
+        "--repeats", type=int, default=1,
+        help="Runs of each case, the fastest is reported")
+    return parser
+
+
+def main(args):
+    """Run the benchmark, writing a TSV of results to stdout."""
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        stream = args.stream
+        if stream is None:
+            stream = os.path.join(workdir, "stream.sam")
+            size = generate_stream(
+                stream, parse_size(args.size), n_sq=args.n_sq, n_pg=args.n_pg,
+                n_rg=args.n_rg, read_length=args.read_length)
+            logger.info(f"Generated {size / 1e6:.1f} MB stream.")
+
+        writer = csv.DictWriter(
+            sys.stdout, fieldnames=FIELDS, delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+        for row in run_benchmark(
+                stream, workdir, args.n_rg, args.modes, args.inputs,
+                args.passthroughs, repeats=args.repeats):
+            writer.writerow(row)
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='[%(asctime)s - %(name)s] %(message)s', level=logging.INFO)
+    main(argparser().parse_args())
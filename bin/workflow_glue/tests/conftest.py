@@ -1,5 +1,6 @@
 #!/usr/bin/env python
-"""Pytests argument definitions."""
+"""Pytests argument definitions, and helpers shared by tests."""
+import random
 
 
 def pytest_addoption(parser):
@@ -9,3 +10,55 @@ def pytest_addoption(parser):
         action="store",
         default="/host/test_data"
     )
+
+
+def write_bam(
+        fname, sq=None, so=None, rg=None, reads=(), header=None, mode="wb"):
+    """Write a BAM, or a SAM with mode "w", returning its path.
+
+    :param sq: SQ records of the header, as dicts of their tags.
+    :param so: SO of the HD record.
+    :param rg: RG records of the header, as dicts of their tags.
+    :param reads: (reference_id, start, sequence) of each read, aligned
+        without gaps, or unmapped when reference_id is None.
+    :param header: header text or `pysam.AlignmentHeader`, in place of sq,
+        so and rg.
+    """
+    # deferred so that tests without BAM do not need pysam
+    import pysam
+    if header is None:
+        header = {"HD": {"VN": "1.6"}}
+        if so is not None:
+            header["HD"]["SO"] = so
+        if sq is not None:
+            header["SQ"] = sq
+        if rg is not None:
+            header["RG"] = rg
+    elif isinstance(header, str):
+        header = pysam.AlignmentHeader.from_text(header)
+    with pysam.AlignmentFile(str(fname), mode, header=header) as fh:
+        for i, (reference_id, start, sequence) in enumerate(reads):
+            record = pysam.AlignedSegment(fh.header)
+            record.query_name = f"read{i}"
+            record.query_sequence = sequence
+            if reference_id is None:
+                record.flag = 4
+            else:
+                record.reference_id = reference_id
+                record.reference_start = start
+                record.cigarstring = f"{len(sequence)}M"
+            fh.write(record)
+    return str(fname)
+
+
+def tiled_reads(starts, reference_id=0, length=100, seed=None):
+    """Return reads at each start of a reference for write_bam.
+
+    Reads have a repeated sequence, unless a seed is given for random ones.
+    """
+    rng = None if seed is None else random.Random(seed)
+    return [
+        (reference_id, start, (
+            "ACGT" * (length // 4) if rng is None
+            else "".join(rng.choices("ACGT", k=length))))
+        for start in starts]
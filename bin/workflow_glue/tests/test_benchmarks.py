@@ -0,0 +1,45 @@
+"""Test the benchmarks run."""
+from workflow_glue.benchmarks.reheader_samstream import (
+    generate_stream, parse_size, run_benchmark)
+
+
+def test_parse_size():
+    """Test sizes are read with or without a suffix."""
+    assert parse_size("100") == 100
+    assert parse_size("2k") == 2048
+    assert parse_size("1.5GB") == 1.5 * 1024 ** 3
+
+
+def test_generate_stream(tmp_path):
+    """Test the generated stream is minimap2-shaped SAM of the given size."""
+    fname = tmp_path / "stream.sam"
+    size = generate_stream(
+        fname, 100000, n_sq=3, n_pg=2, n_rg=2, read_length=100, n_distinct=10)
+    assert size == fname.stat().st_size >= 100000
+    lines = fname.read_text().splitlines()
+    header = [line for line in lines if line.startswith("@")]
+    assert [line[:3] for line in header] == ["@SQ"] * 3 + ["@RG"] * 2 + ["@PG"] * 3
+    assert header[-1].startswith("@PG\tID:minimap2\tPN:minimap2\tVN:2.28\tPP:program1")
+    for line in lines[len(header):]:
+        fields = line.split("\t")
+        assert len(fields) >= 12
+        assert fields[-1] == "rl:i:0"
+        assert any(field.startswith("RG:Z:run") for field in fields[11:])
+
+
+def test_run_benchmark(tmp_path):
+    """Test a small benchmark runs each case."""
+    stream = tmp_path / "stream.sam"
+    generate_stream(stream, 100000, read_length=100)
+    rows = list(run_benchmark(
+        str(stream), str(tmp_path), 1, ["sam", "stats", "remap"], ["pipe", "file"],
+        ["auto", "sendfile"]))
+    cases = {(r["mode"], r["input"], r["passthrough"]): r for r in rows}
+    assert len(cases) == 2 * 2 + 2 + 2
+    # sendfile cannot read from a pipe
+    assert cases[("sam", "pipe", "sendfile")]["exit_status"] != 0
+    assert "mb_per_s" not in cases[("sam", "pipe", "sendfile")]
+    for case in [("sam", "file", "sendfile"), ("stats", "pipe", "auto"),
+                 ("remap", "file", "auto")]:
+        assert cases[case]["exit_status"] == 0
+        assert float(cases[case]["mb_per_s"]) > 0
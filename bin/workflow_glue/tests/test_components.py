@@ -0,0 +1,45 @@
+"""Test discovery of workflow-glue components."""
+import sys
+
+import workflow_glue
+
+
+def test_manifest_lists_helpers():
+    """Test the manifest contains the standard helpers and their modules."""
+    manifest = workflow_glue.get_manifest()
+    assert manifest["check_xam_index"]["module"] == (
+        "workflow_glue.wfg_helpers.check_xam_index")
+    assert manifest["report"]["module"] == "workflow_glue.report"
+    assert manifest["configure_igv"]["help"] == "Create an IGV config file."
+    # modules without a main and argparser are not components
+    assert "util" not in manifest
+    assert "__init__" not in manifest
+
+
+def test_manifest_does_not_import():
+    """Test building the manifest does not import the components."""
+    workflow_glue.get_manifest.cache_clear()
+    sys.modules.pop("workflow_glue.wfg_helpers.get_max_depth_locus", None)
+    workflow_glue.get_manifest()
+    assert "workflow_glue.wfg_helpers.get_max_depth_locus" not in sys.modules
+
+
+def test_get_components_allowed():
+    """Test only allowed components are imported."""
+    components = workflow_glue.get_components(allowed_components=["configure_igv"])
+    assert list(components) == ["configure_igv"]
+    assert callable(components["configure_igv"].main)
+
+
+def test_requested_component():
+    """Test the subcommand is picked out of argv."""
+    manifest = workflow_glue.get_manifest()
+    find = workflow_glue._requested_component
+    assert find(["configure_igv", "--fofn", "x"], manifest) == "configure_igv"
+    assert find(["--debug", "configure_igv"], manifest) == "configure_igv"
+    assert find(
+        ["--profile", "wall", "configure_igv", "--fofn", "x"], manifest
+    ) == "configure_igv"
+    assert find(["--profile", "nope", "configure_igv"], manifest) is None
+    assert find(["typo", "configure_igv"], manifest) is None
+    assert find(["--help"], manifest) is None
@@ -1,9 +1,15 @@
 """Test the configure_igv script."""
 
+import gzip
+import io
 import json
+import os
 
+import pysam
 import pytest
-from workflow_glue.wfg_helpers.configure_igv import main
+from workflow_glue.tests.conftest import tiled_reads, write_bam
+from workflow_glue.wfg_helpers.configure_igv import (
+    argparser, DATA_TYPES, main, SampleBundle, write_igv_json)
 
 
 DEFAULT_ALN_IN = {
@@ -226,6 +232,11 @@ def test_igv_samples_custom_features(
         extra_variant_opts = None
         extra_interval_opts = None
         locus = None
+        loci = None
+        compact = False
+        shard_by_sample = None
+        build_missing_indexes = False
+        threads = 1
     args = Args()
 
     main(args)
@@ -234,3 +245,184 @@ def test_igv_samples_custom_features(
     with open(tmp_path/"igv.json", 'r') as output_igv:
         expected_igv = json.loads(output_igv.read())
     assert captured_json.items() == expected_igv.items()
+
+
+@pytest.mark.parametrize("loci", [
+    [{"depth": 9.0, "locus": "chr1:950-1150"}, {"depth": 8.5, "locus": "chr2:450-650"}],
+    ["chr1:950-1150", "chr2:450-650"],
+], ids=["get_max_depth_locus", "strings"])
+def test_igv_loci(loci, tmp_path, capsys):
+    """Test a list of loci is set to be shown side by side."""
+    with open(tmp_path/"file-names.txt", "w") as text_file:
+        text_file.write(NO_SAMPLE_FOFN)
+    with open(tmp_path/"loci.json", "w") as loci_file:
+        json.dump(loci, loci_file)
+
+    class Args:
+        fofn = tmp_path / "file-names.txt"
+        keep_track_order = True
+        extra_alignment_opts = None
+        extra_variant_opts = None
+        extra_interval_opts = None
+        locus = None
+        loci = tmp_path / "loci.json"
+        compact = False
+        shard_by_sample = None
+        build_missing_indexes = False
+        threads = 1
+
+    main(Args())
+    igv_json = json.loads(capsys.readouterr().out)
+    assert igv_json["locus"] == ["chr1:950-1150", "chr2:450-650"]
+
+
+def test_classify_files():
+    """Test files are classified as by the first extension they end with."""
+    names = [
+        f"{prefix}{ext}{suffix}"
+        for ext in list(DATA_TYPES) + ["gz", "tbi", "txt"]
+        for prefix in ("", ".", "sample.", "a.b.c.", "dir.d/x.")
+        for suffix in ("", ".tbi", ".gz", ".csi", ".bai")]
+    for name in names:
+        expected = next(
+            (ftype for ext, ftype in DATA_TYPES.items() if name.endswith(f".{ext}")),
+            None)
+        assert SampleBundle.classify_files(name) == expected, name
+
+
+def test_pair_file_with_index():
+    """Test files are paired with the first of their indexes that is present."""
+    infiles = [
+        "a/x.vcf.gz", "i/x.vcf.gz.csi", "i/x.vcf.gz.tbi", "b/y.vcf.gz",
+        "a/z.bam", "i/z.bam.bai", "j/z.bam.bai", "a/w.bam", "a/notes.txt"]
+    bundle = SampleBundle("sample")
+    for fname in infiles:
+        bundle.append(fname)
+    bundle.process_data()
+    assert bundle.data_bundles == [
+        ["a/z.bam", "i/z.bam.bai", "bam"],
+        # a file without an index has no index, even if others have one
+        ["a/w.bam", None, "bam"],
+        ["a/x.vcf.gz", "i/x.vcf.gz.tbi", "vcf"],
+        ["b/y.vcf.gz", None, "vcf"],
+    ]
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("n_tracks", [0, 1, 3])
+@pytest.mark.parametrize("locus", [None, "chr1:1-100", ["chr1:1-100", "chr2:1-10"]])
+def test_write_igv_json(compact, n_tracks, locus):
+    """Test streamed JSON is as written by json.dump."""
+    reference = WF_AVA_EXPECTED_IGV_OUT["reference"]
+    tracks = [
+        dict(track, nested={"colors": [1, 2], "empty": {}})
+        for track in WF_AVA_EXPECTED_IGV_OUT["tracks"][:n_tracks]]
+    igv_json = {"reference": reference, "tracks": tracks}
+    if locus is not None:
+        igv_json["locus"] = locus
+    fh = io.StringIO()
+    assert write_igv_json(
+        fh, reference, iter(tracks), locus=locus, compact=compact) == n_tracks
+    if compact:
+        expected = json.dumps(igv_json, separators=(",", ":"))
+    else:
+        expected = json.dumps(igv_json, indent=4)
+    assert fh.getvalue() == expected
+
+
+def test_shard_by_sample(tmp_path, capsys):
+    """Test a config is written for each sample, with the shared tracks."""
+    fofn = tmp_path / "file-names.txt"
+    fofn.write_text(
+        "reference.fasta\nreference.fasta.fai\n"
+        "sample B,sampleB.bam\nsample B,sampleB.bam.bai\n"
+        "sample/B,other.bam\n"
+        "sample A,sampleA.bam\nsample A,sampleA.bam.bai\n"
+        "genes.bed\n")
+    out_dir = tmp_path / "igv"
+    args = argparser().parse_args([
+        "--fofn", str(fofn), "--locus", "chr1:1-100", "--compact",
+        "--shard-by-sample", str(out_dir)])
+    main(args)
+    assert capsys.readouterr().out == ""
+    manifest = json.loads((out_dir / "manifest.json").read_text())
+    assert manifest == [
+        {"sample": "sample A", "config": "sample_A.json", "tracks": 2},
+        {"sample": "sample B", "config": "sample_B.json", "tracks": 2},
+        {"sample": "sample/B", "config": "sample_B_1.json", "tracks": 2},
+    ]
+    config = json.loads((out_dir / "sample_A.json").read_text())
+    assert config["reference"]["fastaURL"] == "reference.fasta"
+    assert [track["url"] for track in config["tracks"]] == [
+        "sampleA.bam", "genes.bed"]
+    assert config["locus"] == "chr1:1-100"
+
+
+def write_indexing_inputs(tmp_path):
+    """Write files without indexes, returning a fofn of them."""
+    tmp_path.joinpath("ref.fa").write_text(">chr1\n" + "ACGT" * 250 + "\n")
+    pysam.tabix_compress(str(tmp_path / "ref.fa"), str(tmp_path / "ref.fa.gz"))
+    write_bam(
+        tmp_path / "reads.bam", [{"SN": "chr1", "LN": 1000}], "coordinate",
+        reads=tiled_reads(range(0, 500, 50)))
+    tmp_path.joinpath("calls.vcf").write_text(
+        "##fileformat=VCFv4.2\n##contig=<ID=chr1,length=1000>\n"
+        "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+        "chr1\t10\t.\tA\tC\t.\tPASS\t.\nchr1\t20\t.\tG\tT\t.\tPASS\t.\n")
+    tmp_path.joinpath("sorted.bed").write_text("chr1\t5\t8\nchr1\t10\t20\n")
+    tmp_path.joinpath("unsorted.bed").write_text("chr1\t10\t20\nchr1\t5\t8\n")
+    tmp_path.joinpath("gzip.bed.gz").write_bytes(gzip.compress(b"chr1\t5\t8\n"))
+    # an index that is next to its file, but not listed
+    pysam.tabix_compress(
+        str(tmp_path / "sorted.bed"), str(tmp_path / "mods.bedmethyl.gz"))
+    pysam.tabix_index(
+        str(tmp_path / "mods.bedmethyl.gz"), preset="bed", keep_original=True)
+    lines = [str(tmp_path / "ref.fa.gz")]
+    for sample in ("sample A", "sample B"):
+        lines += [
+            f"{sample},{tmp_path / name}" for name in (
+                "reads.bam", "calls.vcf", "sorted.bed", "unsorted.bed",
+                "gzip.bed.gz", "mods.bedmethyl.gz")]
+    fofn = tmp_path / "file-names.txt"
+    fofn.write_text("\n".join(lines))
+    return fofn
+
+
+def test_build_missing_indexes(tmp_path, capsys):
+    """Test missing indexes are built and used, other files keep their tracks."""
+    fofn = write_indexing_inputs(tmp_path)
+    args = argparser().parse_args([
+        "--fofn", str(fofn), "--build-missing-indexes", "--threads", "2"])
+    main(args)
+    igv_json = json.loads(capsys.readouterr().out)
+    assert igv_json["reference"]["indexURL"] == f"{tmp_path}/ref.fa.gz.fai"
+    assert igv_json["reference"]["compressedIndexURL"] == f"{tmp_path}/ref.fa.gz.gzi"
+    tracks = {
+        (track["name"], track["url"]): track.get("indexURL")
+        for track in igv_json["tracks"]}
+    for sample in ("sample A", "sample B"):
+        expected = {
+            "reads.bam": ("reads.bam", "reads.bam.bai"),
+            "calls.vcf": ("calls.vcf.gz", "calls.vcf.gz.tbi"),
+            "sorted.bed": ("sorted.bed.gz", "sorted.bed.gz.tbi"),
+            "unsorted.bed": ("unsorted.bed", None),
+            "gzip.bed.gz": ("gzip.bed.gz", None),
+            "mods.bedmethyl.gz": ("mods.bedmethyl.gz", "mods.bedmethyl.gz.tbi"),
+        }
+        for url, index in expected.values():
+            index = None if index is None else f"{tmp_path}/{index}"
+            assert tracks[(f"{sample}: {url}", f"{tmp_path}/{url}")] == index
+    # the indexes work, and no temporary files are left behind
+    with pysam.TabixFile(str(tmp_path / "calls.vcf.gz")) as fh:
+        assert len(list(fh.fetch("chr1", 0, 15))) == 1
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
+    assert not (tmp_path / "unsorted.bed.gz").exists()
+
+
+def test_build_missing_indexes_not_asked(tmp_path, capsys):
+    """Test no indexes are built unless asked, failing for a bgzipped reference."""
+    fofn = write_indexing_inputs(tmp_path)
+    args = argparser().parse_args(["--fofn", str(fofn)])
+    with pytest.raises(ValueError, match="GZI reference index"):
+        main(args)
+    assert not (tmp_path / "reads.bam.bai").exists()
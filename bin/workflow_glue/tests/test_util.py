@@ -0,0 +1,118 @@
+"""Test the shared helpers in util."""
+import json
+import os
+import pstats
+import time
+
+import pytest
+from workflow_glue import util
+
+
+def busy():
+    """Do something worth profiling."""
+    data = [list(range(1000)) for _ in range(200)]
+    time.sleep(0.05)
+    return sum(map(sum, data))
+
+
+@pytest.mark.parametrize("mode", util.PROFILE_EXTENSIONS.keys())
+def test_profiler_default_path(mode, tmp_path, monkeypatch):
+    """Test each profiler writes its report to the default path."""
+    monkeypatch.chdir(tmp_path)
+    with util.profiler(mode, name="busy") as fname:
+        busy()
+    assert fname == str(tmp_path / f"busy.{util.PROFILE_EXTENSIONS[mode]}")
+    assert (tmp_path / fname).stat().st_size > 0
+
+
+def test_profiler_cprofile(tmp_path):
+    """Test cProfile output can be loaded and contains the profiled code."""
+    fname = tmp_path / "out.pstats"
+    with util.profiler("cprofile", fname):
+        busy()
+    stats = pstats.Stats(str(fname))
+    assert any(func[2] == "busy" for func in stats.stats)
+
+
+def test_profiler_wall(tmp_path):
+    """Test the wall clock sampler sees time spent sleeping."""
+    fname = tmp_path / "out.folded"
+    with util.profiler("wall", fname):
+        busy()
+    with open(fname) as fh:
+        stacks = [line.rsplit(" ", 1) for line in fh]
+    assert any("test_util.busy" in stack for stack, _ in stacks)
+    assert all(int(count) > 0 for _, count in stacks)
+
+
+def test_profiler_written_on_exit(tmp_path):
+    """Test a report is still written when the profiled code exits."""
+    fname = tmp_path / "out.txt"
+    with pytest.raises(SystemExit):
+        with util.profiler("tracemalloc", fname):
+            raise SystemExit(1)
+    assert fname.read_text().startswith("# peak traced memory:")
+
+
+def test_profiler_none():
+    """Test no profiling is a no-op."""
+    with util.profiler(None) as fname:
+        pass
+    assert fname is None
+
+
+def read_json_lines(fname):
+    """Read a JSON lines file."""
+    with open(fname) as fh:
+        return [json.loads(line) for line in fh]
+
+
+def test_metrics_disabled(tmp_path, monkeypatch):
+    """Test nothing is recorded unless metrics are requested."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv(util.METRICS_ENV, raising=False)
+    with util.metrics("busy") as fname:
+        busy()
+    assert fname is None
+    assert not list(tmp_path.iterdir())
+
+
+def test_metrics_sidecar(tmp_path, monkeypatch):
+    """Test a sidecar with resource usage and record counts is written."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv(util.METRICS_ENV, raising=False)
+    with util.metrics("busy", ["busy", "--fast"], sidecar=True) as fname:
+        busy()
+        util.count_records("things", 3)
+        util.count_records("things")
+    (record,) = read_json_lines(fname)
+    assert fname.startswith(str(tmp_path / util.METRICS_SIDECAR_PREFIX))
+    assert record["command"] == "busy"
+    assert record["argv"] == ["busy", "--fast"]
+    assert record["exit_status"] == 0
+    assert record["wall_time"] >= 0.05
+    assert record["peak_rss"] > 0
+    assert record["records"] == {"things": 4}
+
+
+def test_metrics_env_file(tmp_path, monkeypatch):
+    """Test records are appended to the file named by the environment."""
+    fname = tmp_path / "metrics.jsonl"
+    monkeypatch.setenv(util.METRICS_ENV, str(fname))
+    with util.metrics("first"):
+        pass
+    with pytest.raises(SystemExit):
+        with util.metrics("second"):
+            raise SystemExit(3)
+    records = read_json_lines(fname)
+    assert [r["command"] for r in records] == ["first", "second"]
+    assert [r["exit_status"] for r in records] == [0, 3]
+
+
+def test_metrics_env_dir(tmp_path, monkeypatch):
+    """Test a sidecar is written when the environment names a directory."""
+    monkeypatch.setenv(util.METRICS_ENV, str(tmp_path))
+    with util.metrics("busy") as fname:
+        pass
+    assert os.path.dirname(fname) == str(tmp_path)
+    assert read_json_lines(fname)[0]["command"] == "busy"
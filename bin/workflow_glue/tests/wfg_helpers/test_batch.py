@@ -0,0 +1,78 @@
+"""Test the batch subcommand."""
+import csv
+import json
+
+import pytest
+from workflow_glue.wfg_helpers import batch
+
+
+FOFN = """reference.fasta
+{sample}.bam
+{sample}.bam.bai"""
+
+
+def write_fofns(tmp_path, samples):
+    """Write a fofn for each sample and return their paths."""
+    paths = []
+    for sample in samples:
+        path = tmp_path / f"{sample}.txt"
+        path.write_text(FOFN.format(sample=sample))
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize("pool", ["thread", "process"])
+def test_batch_jsonl(tmp_path, pool):
+    """Test jobs from JSON lines write to their own stdout in any pool."""
+    samples = [f"sample{i}" for i in range(20)]
+    fofns = write_fofns(tmp_path, samples)
+    with open(tmp_path / "jobs.jsonl", "w") as fh:
+        for sample, fofn in zip(samples, fofns):
+            fh.write(json.dumps({
+                "id": sample,
+                "command": "configure_igv",
+                "args": ["--fofn", str(fofn)],
+                "stdout": str(tmp_path / f"{sample}.json"),
+            }) + "\n")
+    args = batch.argparser().parse_args([
+        str(tmp_path / "jobs.jsonl"),
+        "--summary", str(tmp_path / "summary.tsv"),
+        "--threads", "4", "--pool", pool,
+    ])
+    batch.main(args)
+
+    for sample in samples:
+        with open(tmp_path / f"{sample}.json") as fh:
+            tracks = json.load(fh)["tracks"]
+        assert [t["name"] for t in tracks] == [f"{sample}.bam"]
+    with open(tmp_path / "summary.tsv") as fh:
+        summary = list(csv.DictReader(fh, delimiter="\t"))
+    assert [row["id"] for row in summary] == samples
+    assert all(row["exit_status"] == "0" for row in summary)
+    assert all(float(row["wall_time"]) >= 0 for row in summary)
+
+
+def test_batch_tsv_failures(tmp_path):
+    """Test failing jobs are reported in the summary and fail the batch."""
+    (fofn,) = write_fofns(tmp_path, ["good"])
+    with open(tmp_path / "jobs.tsv", "w") as fh:
+        fh.write("command\targs\tstdout\n")
+        fh.write(f"configure_igv\t--fofn '{fofn}'\t{tmp_path / 'good.json'}\n")
+        fh.write(f"configure_igv\t--fofn missing.txt\t{tmp_path / 'bad.json'}\n")
+        fh.write(f"configure_igv\t--not-an-option\t{tmp_path / 'ugly.json'}\n")
+    args = batch.argparser().parse_args([
+        str(tmp_path / "jobs.tsv"), "--summary", str(tmp_path / "summary.tsv")])
+    with pytest.raises(SystemExit, match="1"):
+        batch.main(args)
+    with open(tmp_path / "summary.tsv") as fh:
+        summary = list(csv.DictReader(fh, delimiter="\t"))
+    assert [row["exit_status"] for row in summary] == ["0", "1", "2"]
+    assert [row["id"] for row in summary] == ["0", "1", "2"]
+
+
+def test_read_jobs_refuses_unbatchable(tmp_path):
+    """Test jobs cannot run entry points that manage the interpreter."""
+    with open(tmp_path / "jobs.jsonl", "w") as fh:
+        fh.write(json.dumps({"command": "serve", "args": [], "stdout": "x"}))
+    with pytest.raises(ValueError, match="cannot run 'serve'"):
+        batch.read_jobs(str(tmp_path / "jobs.jsonl"))
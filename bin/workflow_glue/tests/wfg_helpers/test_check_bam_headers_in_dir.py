@@ -0,0 +1,79 @@
+"""Test check_bam_headers_in_dir.py."""
+
+import pytest
+from workflow_glue.tests.conftest import write_bam
+from workflow_glue.wfg_helpers import check_bam_headers_in_dir
+
+
+REF = [{"SN": "chr1", "LN": 1000}, {"SN": "chr2", "LN": 2000}]
+OTHER_REF = [{"SN": "chr1", "LN": 1000}]
+
+
+def run(input_dir, capsys, threads=1):
+    """Run the check on a directory, returning the variables it writes."""
+    args = check_bam_headers_in_dir.argparser().parse_args(
+        [str(input_dir), f"--threads={threads}"])
+    check_bam_headers_in_dir.main(args)
+    out = capsys.readouterr().out
+    return dict(item.split("=") for item in out.split(";"))
+
+
+@pytest.fixture
+def sorted_files(monkeypatch):
+    """Check files in order of their names, whatever the filesystem order."""
+    glob = check_bam_headers_in_dir.Path.glob
+    monkeypatch.setattr(
+        check_bam_headers_in_dir.Path, "glob",
+        lambda self, pattern: sorted(glob(self, pattern)))
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+@pytest.mark.parametrize("headers,expected", [
+    ([(None, None)] * 20, ("1", "0", "0")),
+    ([(REF, None)] * 20, ("0", "0", "0")),
+    ([(REF, None)] * 19 + [(REF, "coordinate")], ("0", "0", "1")),
+    ([(REF, None)] * 10 + [(OTHER_REF, None)] + [(REF, None)] * 9, ("0", "1", "0")),
+    ([(None, None)] * 19 + [(REF, None)], ("0", "1", "0")),
+    # a sorted file after the first mismatch is never considered
+    ([(REF, None), (OTHER_REF, None), (REF, "coordinate")], ("0", "1", "0")),
+    ([(REF, "coordinate"), (OTHER_REF, None)], ("0", "1", "1")),
+], ids=["unaligned", "aligned", "sorted", "mixed", "mixed-last", "sorted-late",
+        "sorted-early"])
+def test_main(tmp_path, capsys, sorted_files, headers, expected, threads):
+    """Test the result does not depend on the number of threads."""
+    for i, (sq, so) in enumerate(headers):
+        write_bam(tmp_path / f"reads{i:03}.bam", sq, so)
+    result = run(tmp_path, capsys, threads=threads)
+    assert (
+        result["IS_UNALIGNED"], result["MIXED_HEADERS"], result["IS_SORTED"]
+    ) == expected
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_read_headers_stops_early(monkeypatch, threads):
+    """Test files beyond the read ahead are not read once the consumer stops."""
+    read = []
+
+    def read_header(xam_file):
+        read.append(xam_file)
+        return xam_file
+
+    monkeypatch.setattr(check_bam_headers_in_dir, "read_header", read_header)
+    headers = check_bam_headers_in_dir.read_headers(range(1000), threads=threads)
+    assert [next(headers) for _ in range(5)] == list(range(5))
+    headers.close()
+    assert len(read) <= 5 + 2 * threads
+
+
+def test_read_headers_error_in_order(monkeypatch):
+    """Test an unreadable file raises when it is reached."""
+    def read_header(xam_file):
+        if xam_file == 3:
+            raise ValueError("bad file")
+        return xam_file
+
+    monkeypatch.setattr(check_bam_headers_in_dir, "read_header", read_header)
+    headers = check_bam_headers_in_dir.read_headers(range(10), threads=4)
+    assert [next(headers) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(ValueError, match="bad file"):
+        next(headers)
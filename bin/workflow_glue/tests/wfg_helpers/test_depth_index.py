@@ -0,0 +1,124 @@
+"""Test depth_index.py."""
+import io
+import os
+import random
+
+import pytest
+from workflow_glue.wfg_helpers import depth_index, get_max_depth_locus
+
+
+def random_windows(rng, n_refs=3, max_windows=500):
+    """Return (ref, start, end, depth) windows of a few references."""
+    windows = []
+    for c in range(n_refs):
+        for i in range(rng.randint(1, max_windows)):
+            # few distinct depths, so that there are ties
+            windows.append((f"chr{c}", i * 100, i * 100 + 100, rng.randint(0, 20)))
+    return windows
+
+
+def write_index(tmp_path, windows, size=4096):
+    """Write a BED of windows and its index, returning the path of the index."""
+    contents = "".join(f"{r}\t{s}\t{e}\t{d}\n" for r, s, e, d in windows)
+    fname = tmp_path / "regions.bed"
+    fname.write_text(contents)
+    index = tmp_path / "regions.idx"
+    with depth_index.DepthIndexWriter(index) as writer:
+        get_max_depth_locus.scan_windows(
+            get_max_depth_locus.iter_chunks(
+                io.BytesIO(contents.encode()), size=size),
+            consumers=[writer])
+    return fname, index
+
+
+def brute_force(windows, ref, start, end):
+    """Return the first deepest window overlapping a 0-based region."""
+    overlapping = [
+        w for w in windows if w[0] == ref and w[2] > start and w[1] < end]
+    return max(overlapping, key=lambda w: w[3], default=None)
+
+
+def test_query(tmp_path):
+    """Test region queries match a brute force, across block boundaries."""
+    rng = random.Random(1)
+    windows = random_windows(rng)
+    _, fname = write_index(tmp_path, windows)
+    with depth_index.DepthIndex(fname) as index:
+        deepest = max(w[3] for w in windows)
+        assert index.deepest() == next(w for w in windows if w[3] == deepest)
+        for _ in range(2000):
+            ref = f"chr{rng.randint(0, 2)}"
+            start = rng.randint(0, 50000)
+            end = start + rng.choice([1, 99, 100, 6400, rng.randint(1, 50000)])
+            assert index.query(ref, start, end) == brute_force(
+                windows, ref, start, end)
+        for ref in ("chr0", "chr1", "chr2"):
+            assert index.ref_length(ref) == max(
+                w[2] for w in windows if w[0] == ref)
+        with pytest.raises(ValueError):
+            index.query("chrX")
+
+
+def test_max_matches_scan(tmp_path, capsys):
+    """Test the locus written from an index is that of scanning the BED."""
+    rng = random.Random(2)
+    for _ in range(5):
+        windows = random_windows(rng)
+        bed, _ = write_index(tmp_path, windows)
+        index = tmp_path / "built.idx"
+        outputs = []
+        for argv in ([bed, "--build-index", index], [index]):
+            args = get_max_depth_locus.argparser().parse_args(
+                [str(argv[0]), "2000"] + [str(a) for a in argv[1:]])
+            get_max_depth_locus.main(args)
+            outputs.append(capsys.readouterr().out)
+        assert outputs[0] == outputs[1]
+
+
+@pytest.mark.parametrize("region,expected", [
+    ("chr1", "9\tchr1:50-1050"),
+    ("chr1:1,001-2000", "5\tchr1:650-1650"),
+    # windows overlapping the region by a single base
+    ("chr1:600-600", "9\tchr1:50-1050"),
+    ("chr1:601-1101", "5\tchr1:650-1650"),
+    ("chr1:601-1100", "1\tchr1:150-1150"),
+    ("chr2:1-100", "2\tchr2:1-200"),
+])
+def test_main_region(tmp_path, capsys, region, expected):
+    """Test the deepest window of a 1-based region is found."""
+    windows = [("chr1", i * 100, i * 100 + 100, d) for i, d in enumerate(
+        [1] * 5 + [9] + [1] * 4 + [1, 5, 5] + [1] * 37)] + [("chr2", 0, 200, 2)]
+    _, index = write_index(tmp_path, windows)
+    args = get_max_depth_locus.argparser().parse_args(
+        [str(index), "1000", "--region", region])
+    get_max_depth_locus.main(args)
+    assert capsys.readouterr().out == expected
+
+
+@pytest.mark.parametrize("region", ["chr1:0-10", "chr1:20-10", ":1-10"])
+def test_bad_region(region):
+    """Test a region that does not make sense fails."""
+    with pytest.raises(ValueError):
+        get_max_depth_locus.parse_region(region)
+
+
+def test_region_with_colon():
+    """Test a reference name with a colon is taken as a whole reference."""
+    assert get_max_depth_locus.parse_region("HLA-A*01:01") == ("HLA-A*01:01", 0, None)
+
+
+def test_region_needs_index(tmp_path):
+    """Test --region is rejected for a regions BED."""
+    bed, _ = write_index(tmp_path, [("chr1", 0, 100, 1)])
+    args = get_max_depth_locus.argparser().parse_args(
+        [str(bed), "1000", "--region", "chr1"])
+    with pytest.raises(ValueError):
+        get_max_depth_locus.main(args)
+
+
+def test_refs_not_together(tmp_path):
+    """Test the index is not written if the windows of a ref are split."""
+    windows = [("chr1", 0, 100, 1), ("chr2", 0, 100, 1), ("chr1", 100, 200, 1)]
+    with pytest.raises(ValueError, match="not together"):
+        write_index(tmp_path, windows)
+    assert sorted(os.listdir(tmp_path)) == ["regions.bed"]
@@ -0,0 +1,242 @@
+"""Test get_max_depth_locus.py."""
+import gzip
+import io
+import json
+import random
+
+import pysam
+import pytest
+from workflow_glue.tests.conftest import write_bam
+from workflow_glue.wfg_helpers import get_max_depth_locus
+
+
+def regions_bed(windows):
+    """Return the contents of a regions BED of (ref, length, depths) tuples."""
+    lines = []
+    for ref, length, depths in windows:
+        for i, depth in enumerate(depths):
+            start = i * 100
+            lines.append(f"{ref}\t{start}\t{min(start + 100, length)}\t{depth}\n")
+    return "".join(lines)
+
+
+def run(tmp_path, capsys, contents, locus_size, compress=False):
+    """Run the entry point on a BED, returning what it writes."""
+    fname = tmp_path / ("regions.bed.gz" if compress else "regions.bed")
+    data = contents.encode()
+    fname.write_bytes(gzip.compress(data) if compress else data)
+    args = get_max_depth_locus.argparser().parse_args([str(fname), str(locus_size)])
+    get_max_depth_locus.main(args)
+    return capsys.readouterr().out
+
+
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize("windows,locus_size,expected", [
+    # the locus is centred on the window
+    ([("chr1", 5000, ["1.00"] * 20 + ["9.50"] + ["1.00"] * 29)], 1000,
+        "9.5\tchr1:1550-2550"),
+    # and moved to start at 1 or end at the end of the reference
+    ([("chr1", 5000, ["9.00"] + ["1.00"] * 49)], 1000, "9.0\tchr1:1-1000"),
+    ([("chr1", 4950, ["1.00"] * 49 + ["9.00"])], 1000, "9.0\tchr1:3950-4950"),
+    # the whole reference is shown if it is shorter than the locus
+    ([("chr1", 5000, ["1"] * 50), ("chr2", 250, ["2", "3", "1"])], 1000,
+        "3\tchr2:1-250"),
+    # the first of equal maxima is used
+    ([("chr1", 5000, ["1"] * 50), ("chr2", 5000, ["1"] * 10 + ["3"] * 40)], 200,
+        "3\tchr2:950-1150"),
+], ids=["centred", "start", "end", "short-ref", "first-max"])
+def test_main(tmp_path, capsys, windows, locus_size, expected, compress):
+    """Test the locus written for small BEDs."""
+    contents = regions_bed(windows)
+    assert run(tmp_path, capsys, contents, locus_size, compress) == expected
+
+
+def test_blocks(tmp_path):
+    """Test windows are found across blocks, wherever they are split."""
+    contents = regions_bed([
+        ("chr1", 3000, ["1.00"] * 30), ("chr2", 520, ["2.00", "5.00"] + ["1.00"] * 4),
+        ("chr3", 3000, ["5.00"] * 30)])
+    fname = tmp_path / "regions.bed"
+    # without a final newline
+    fname.write_text(contents.rstrip("\n"))
+    for size in (7, 64, 1000):
+        with get_max_depth_locus.open_bed(fname) as fh:
+            best, last_end = get_max_depth_locus.scan_windows(
+                get_max_depth_locus.iter_chunks(fh, size=size))
+        assert best == ("chr2", 100, 200, 5.0)
+        assert last_end == {"chr1": 3000, "chr2": 520, "chr3": 3000}
+
+
+def test_scan_windows_last_ends():
+    """Test the last end of each reference is kept."""
+    contents = regions_bed([("chr1", 250, [1, 2, 3]), ("chr2", 120, [4, 1])])
+    best, last_end = get_max_depth_locus.scan_windows([contents.encode()])
+    assert best == ("chr2", 0, 100, 4)
+    assert last_end == {"chr1": 250, "chr2": 120}
+
+
+@pytest.mark.parametrize("contents", ["", "chr1\t0\t100\n"], ids=["empty", "columns"])
+def test_bad_bed(tmp_path, capsys, contents):
+    """Test an empty BED or one with missing columns fails."""
+    with pytest.raises(ValueError):
+        run(tmp_path, capsys, contents, 1000)
+
+
+def peaks_bed():
+    """Return a regions BED with a few peaks of depth."""
+    chr1 = ["1.00"] * 50
+    for i, depth in (
+            (10, "9.00"), (11, "8.00"), (30, "7.00"), (32, "6.50"), (45, "6.00")):
+        chr1[i] = depth
+    chr2 = ["1.00"] * 10
+    chr2[5] = "8.50"
+    return regions_bed([("chr1", 5000, chr1), ("chr2", 1000, chr2)])
+
+
+@pytest.mark.parametrize("extra_args,expected", [
+    (["--top", "4"], [
+        "9.0\tchr1:1000-1200", "8.5\tchr2:450-650", "7.0\tchr1:2950-3150",
+        "6.0\tchr1:4450-4650"]),
+    (["--top", "4", "--min-separation", "0"], [
+        "9.0\tchr1:1000-1200", "8.5\tchr2:450-650", "7.0\tchr1:2950-3150",
+        "6.5\tchr1:3150-3350"]),
+    # windows are only merged into regions picked before them
+    (["--per-contig"], ["9.0\tchr1:950-1150", "8.5\tchr2:450-650"]),
+    (["--per-contig", "--top", "2"], [
+        "9.0\tchr1:1000-1200", "7.0\tchr1:2950-3150", "8.5\tchr2:450-650"]),
+], ids=["top", "no-separation", "per-contig", "per-contig-top"])
+def test_top(tmp_path, capsys, extra_args, expected):
+    """Test the top loci are separated, with adjacent windows merged."""
+    fname = tmp_path / "regions.bed"
+    fname.write_text(peaks_bed())
+    args = get_max_depth_locus.argparser().parse_args(
+        [str(fname), "200"] + extra_args)
+    get_max_depth_locus.main(args)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[:len(expected)] == expected
+
+
+def test_top_json(tmp_path, capsys):
+    """Test the top loci as JSON, giving the merged windows of each."""
+    fname = tmp_path / "regions.bed"
+    fname.write_text(peaks_bed())
+    args = get_max_depth_locus.argparser().parse_args(
+        [str(fname), "200", "--top", "3", "--output-format", "json"])
+    get_max_depth_locus.main(args)
+    assert json.loads(capsys.readouterr().out) == [
+        {"ref": "chr1", "start": 1000, "end": 1200, "depth": 9.0,
+         "locus": "chr1:1000-1200"},
+        {"ref": "chr2", "start": 500, "end": 600, "depth": 8.5,
+         "locus": "chr2:450-650"},
+        {"ref": "chr1", "start": 3000, "end": 3100, "depth": 7.0,
+         "locus": "chr1:2950-3150"},
+    ]
+
+
+def plateau_bed():
+    """Return a regions BED with a long run of deep windows and a few peaks."""
+    chr2 = ["1"] * 100
+    for i in (10, 50, 90):
+        chr2[i] = "50"
+    return regions_bed([("chr1", 100000, ["100"] * 1000), ("chr2", 10000, chr2)])
+
+
+@pytest.mark.parametrize("extra_args,expected", [
+    # the run gives as many loci as fit in it, each of at most the locus size
+    (["--top", "3"], [
+        ("chr1", 0, 2000), ("chr1", 4000, 6000), ("chr1", 8000, 8100)]),
+    (["--top", "3", "--per-contig"], [
+        ("chr1", 0, 2000), ("chr1", 4000, 6000), ("chr1", 8000, 8100),
+        ("chr2", 1000, 1100), ("chr2", 5000, 5100), ("chr2", 9000, 9100)]),
+], ids=["top", "per-contig"])
+def test_top_plateau(tmp_path, capsys, extra_args, expected):
+    """Test a run of equal windows does not merge into a single locus."""
+    fname = tmp_path / "regions.bed"
+    fname.write_text(plateau_bed())
+    args = get_max_depth_locus.argparser().parse_args(
+        [str(fname), "2000", "--output-format", "json"] + extra_args)
+    get_max_depth_locus.main(args)
+    loci = json.loads(capsys.readouterr().out)
+    assert [(lo["ref"], lo["start"], lo["end"]) for lo in loci] == expected
+    for locus in loci:
+        # the locus shows the whole of its region
+        start, end = locus["locus"].split(":")[1].split("-")
+        assert int(start) - 1 <= locus["start"] and locus["end"] <= int(end)
+
+
+@pytest.mark.parametrize("per_contig", [False, True])
+def test_top_bounded_heap(per_contig):
+    """Test the bounded heaps pick the same regions as keeping every window."""
+    rng = random.Random(1)
+    windows = [
+        (f"chr{c}", 100000, [f"{rng.uniform(0, 50):.2f}" for _ in range(1000)])
+        for c in range(3)]
+    chunks = list(get_max_depth_locus.iter_chunks(
+        io.BytesIO(regions_bed(windows).encode()), size=4096))
+    results = []
+    for capacity in (None, 10 ** 6):
+        top = get_max_depth_locus.TopWindows(5, 2000, 1000, per_contig=per_contig)
+        top.capacity = capacity
+        get_max_depth_locus.scan_windows(chunks, consumers=[top])
+        results.append(top.regions())
+    assert len(results[0]) == (15 if per_contig else 5)
+    assert results[0] == results[1]
+
+
+def peak_bam(fname, n_background=5000, n_peak=10000):
+    """Write an indexed BAM with reads over chr2:300000-310000 piled up."""
+    rng = random.Random(1)
+    reads = [(0, rng.randrange(999900)) for _ in range(n_background)]
+    reads += [(1, rng.randrange(499900)) for _ in range(n_background)]
+    reads += [(1, rng.randrange(300000, 309900)) for _ in range(n_peak)]
+    sq = [{"SN": "chr1", "LN": 1000000}, {"SN": "chr2", "LN": 500000}]
+    # random bases, so that reads take up space once compressed
+    reads = [
+        (ref, start, "".join(rng.choices("ACGT", k=100)))
+        for ref, start in sorted(reads)]
+    return write_bam(fname, sq, "coordinate", reads=reads)
+
+
+@pytest.mark.parametrize("csi", [False, True])
+def test_bam_index(tmp_path, capsys, csi):
+    """Test the locus estimated from a BAM index is at the pile up."""
+    bam = peak_bam(tmp_path / "reads.bam")
+    pysam.index(*(["-c"] if csi else []), bam)
+    window, ref_lengths = get_max_depth_locus.densest_window(bam)
+    assert window[:3] == ("chr2", 294912, 311296)
+    assert ref_lengths == {"chr1": 1000000, "chr2": 500000}
+    args = get_max_depth_locus.argparser().parse_args([bam, "2000"])
+    get_max_depth_locus.main(args)
+    assert capsys.readouterr().out == "NA\tchr2:302104-304104"
+
+
+def test_bam_refine(tmp_path, capsys):
+    """Test refining reads only the chosen window, counting as mosdepth."""
+    bam = peak_bam(tmp_path / "reads.bam", n_background=100, n_peak=0)
+    pysam.index(bam)
+    with pysam.AlignmentFile(bam) as fh:
+        columns = {
+            col.reference_pos: col.nsegments
+            for col in fh.pileup("chr2", 0, 16384, truncate=True)}
+    position, depth = get_max_depth_locus.refine_window(bam, "chr2", 0, 16384)
+    assert depth == max(columns.values())
+    assert position == min(p for p, n in columns.items() if n == depth)
+    args = get_max_depth_locus.argparser().parse_args([bam, "2000", "--refine"])
+    get_max_depth_locus.main(args)
+    out = capsys.readouterr().out
+    assert out.split("\t")[0].isdigit()
+
+
+def test_bam_options(tmp_path):
+    """Test options of regions BEDs are rejected for a BAM, and vice versa."""
+    bam = peak_bam(tmp_path / "reads.bam", n_background=10, n_peak=0)
+    bed = tmp_path / "regions.bed"
+    bed.write_text("chr1\t0\t100\t1\n")
+    for argv in ([bam, "--top", "2"], [str(bed), "--refine"]):
+        args = get_max_depth_locus.argparser().parse_args([argv[0], "2000"] + argv[1:])
+        with pytest.raises(ValueError):
+            get_max_depth_locus.main(args)
+    # a BAM without an index
+    args = get_max_depth_locus.argparser().parse_args([bam, "2000"])
+    with pytest.raises(ValueError, match="No index"):
+        get_max_depth_locus.main(args)
@@ -0,0 +1,62 @@
+"""Test the metrics_summary script."""
+import csv
+import io
+import json
+
+import pytest
+from workflow_glue.wfg_helpers import metrics_summary
+
+
+def record(command, wall_time, **kwargs):
+    """Make a metrics record."""
+    rec = {
+        "command": command, "wall_time": wall_time, "cpu_user": wall_time / 2,
+        "cpu_system": 0.0, "peak_rss": 1000, "bytes_read": None,
+        "bytes_written": None, "records": {},
+    }
+    rec.update(kwargs)
+    return rec
+
+
+def test_percentile():
+    """Test percentiles interpolate between sorted values."""
+    values = [1, 2, 3, 4, 5]
+    assert metrics_summary.percentile(values, 50) == 3
+    assert metrics_summary.percentile(values, 90) == pytest.approx(4.6)
+    assert metrics_summary.percentile([7], 99) == 7
+    assert metrics_summary.percentile([], 50) is None
+
+
+def test_metrics_summary(tmp_path, capsys):
+    """Test sidecars in a work directory and JSON lines files are summarised."""
+    for i in range(10):
+        task_dir = tmp_path / "work" / f"{i:02d}" / "abcdef"
+        task_dir.mkdir(parents=True)
+        name = f".workflow-glue.check_xam_index.{i}.metrics.json"
+        (task_dir / name).write_text(
+            json.dumps(record("check_xam_index", float(i + 1))) + "\n")
+        # files that are not sidecars are ignored
+        (task_dir / "metrics.json").write_text("not json")
+    with open(tmp_path / "extra.jsonl", "w") as fh:
+        for wall_time in (1.0, 3.0):
+            fh.write(json.dumps(record(
+                "configure_igv", wall_time, records={"tracks": 5})) + "\n")
+
+    args = metrics_summary.argparser().parse_args([
+        str(tmp_path / "work"), str(tmp_path / "extra.jsonl")])
+    metrics_summary.main(args)
+    out, _ = capsys.readouterr()
+    rows = {
+        (row["command"], row["metric"]): row
+        for row in csv.DictReader(io.StringIO(out), delimiter="\t")}
+
+    wall = rows[("check_xam_index", "wall_time")]
+    assert wall["n"] == "10"
+    assert float(wall["p50"]) == pytest.approx(5.5)
+    assert float(wall["max"]) == 10
+    assert float(rows[("check_xam_index", "cpu_time")]["total"]) == 27.5
+    # missing I/O counters are skipped rather than counted as zero
+    assert ("check_xam_index", "bytes_read") not in rows
+    tracks = rows[("configure_igv", "records.tracks")]
+    assert tracks["n"] == "2"
+    assert float(tracks["total"]) == 10
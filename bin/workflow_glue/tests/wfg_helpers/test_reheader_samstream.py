@@ -8,11 +8,16 @@ trouble later. There are two concerns of the testing here:
     - Lightly testing the script end to end to accept the output is also
       not going to be garbage
 """
+import io
 from io import StringIO
+import json
+import subprocess
+from subprocess import PIPE
 
 import pytest
 from workflow_glue.wfg_helpers.reheader_samstream import (
-    argparser, reheader_samstream, SamHeader)
+    argparser, CHUNK_SIZE, copy_fd, COPY_STRATEGIES, iter_blocks, main,
+    read_header_fd, reheader_samstream, rg_tag_remapper, SamHeader, StreamStats)
 
 
 def test_resolve_ok_ordered_pg_chain():
@@ -56,6 +61,28 @@ def test_resolve_bad_pg_chain_cycle():
         SamHeader.resolve_pg_chain(records)
 
 
+def test_resolve_long_pg_chain():
+    """Test resolution of a long PG chain given in reverse order."""
+    records = [{"ID": "0"}] + [
+        {"ID": str(i), "PP": str(i - 1)} for i in range(1, 100000)]
+    links = SamHeader.resolve_pg_chain(records[::-1])
+    assert len(links) == 100000
+    assert links["99999"] == "99998"
+
+
+def test_resolve_bad_pg_chain_cycle_after_branch():
+    """Test a cycle is reported from the first ID that reaches it."""
+    records = [
+        {"ID": "first"},
+        {"ID": "second", "PP": "first"},
+        {"ID": "fourth", "PP": "third"},
+        {"ID": "third", "PP": "fifth"},
+        {"ID": "fifth", "PP": "fourth"},
+    ]
+    with pytest.raises(Exception, match="PG chain appears to contain cycle: \\['fourth', 'third', 'fifth', 'fourth'\\]"):  # noqa:E501
+        SamHeader.resolve_pg_chain(records)
+
+
 def test_resolve_pg_chain_no_head():
     """Test PG chain with no head (ie. no PG has a null PP.ID) yields error."""
     records = [
@@ -156,6 +183,20 @@ def test_add_line_sq():
     assert sh.sq_records[0] == "SN:MEOW"
 
 
+def test_add_line_sq_co_verbatim():
+    """Test SQ and CO records are kept as they were given."""
+    sh = SamHeader()
+    sh.add_line("@SQ\tSN:MEOW\tLN:100\tM5:abc\n")
+    sh.add_line("@CO\t\tindented: comment\t\n")
+    assert sh.sq_records == ["SN:MEOW\tLN:100\tM5:abc"]
+    assert sh.co_records == ["\tindented: comment"]
+    with pytest.raises(Exception, match="Record type could not be determined"):
+        sh.add_line("@SQ\t\n")
+    # a bad line in a run of SQ lines is still reported
+    with pytest.raises(Exception, match="Record type could not be determined"):
+        sh.add_sq_lines("@SQ\tSN:HOOT\n@SQ\t\n")
+
+
 def test_add_line_garbage():
     """Test adding an SQ updates the structure."""
     sh = SamHeader()
@@ -399,3 +440,386 @@ READ2
 READ3
 READ4
 """
+
+
+E2E_HEADER_IN = "@RG\tID:my_reads\n@SQ\tSN:this-should-not-appear\tLN:100\n"
+E2E_STREAM = '\n'.join([
+    "@HD\tVN:1.6\tSO:hooted",
+    "@SQ\tSN:this-should-appear\tLN:1000",
+    "@PG\tID:my_program",
+] + [f"READ{i}\t0\tthis-should-appear\t{i}" for i in range(50000)]) + '\n'
+
+
+def run_text_path(header, stream, insert=()):
+    """Run reheader_samstream on StringIO streams."""
+    args = argparser().parse_args(["/dev/null"] + [f"--insert={x}" for x in insert])
+    stream_out = StringIO()
+    reheader_samstream(StringIO(header), StringIO(stream), stream_out, args)
+    return stream_out.getvalue()
+
+
+def run_fd_path(tmp_path, header, stream, pipe_in=False, pipe_out=False):
+    """Run reheader_samstream on file backed streams, or pipes."""
+    args = argparser().parse_args(["/dev/null"])
+    (tmp_path / "in.sam").write_text(stream)
+    with open(tmp_path / "in.sam") as stream_in:
+        with open(tmp_path / "out.sam", "w") as stream_out:
+            if pipe_in:
+                cat = subprocess.Popen(
+                    ["cat", tmp_path / "in.sam"], stdout=PIPE, text=True)
+                stream_in = cat.stdout
+            if pipe_out:
+                tee = subprocess.Popen(
+                    ["cat"], stdin=PIPE, stdout=stream_out, text=True)
+                stream_out = tee.stdin
+            reheader_samstream(StringIO(header), stream_in, stream_out, args)
+            if pipe_in:
+                stream_in.close()
+                cat.wait()
+            if pipe_out:
+                stream_out.close()
+                tee.wait()
+    return (tmp_path / "out.sam").read_text()
+
+
+@pytest.mark.parametrize("pipe_in", [False, True])
+@pytest.mark.parametrize("pipe_out", [False, True])
+@pytest.mark.parametrize("stream", [
+    E2E_STREAM,
+    "",
+    "@PG\tID:hoot\n",
+    "@PG\tID:hoot",  # no trailing newline
+    "@PG\tID:hoot\n\nREAD1\n",  # empty line ends the header
+    "READ1",
+], ids=["alignments", "empty", "header", "no-newline", "empty-line", "no-header"])
+def test_e2e_fd_matches_text(tmp_path, stream, pipe_in, pipe_out):
+    """Test the file descriptor path gives identical output to the text path."""
+    expected = run_text_path(E2E_HEADER_IN, stream)
+    assert run_fd_path(tmp_path, E2E_HEADER_IN, stream, pipe_in, pipe_out) == expected
+
+
+def test_read_header_fd_small_chunks(tmp_path):
+    """Test header lines split across reads are reassembled."""
+    (tmp_path / "in.sam").write_text(E2E_STREAM)
+    sh = SamHeader()
+    with open(tmp_path / "in.sam", "rb") as fh:
+        body = read_header_fd(sh, fh.fileno(), chunk_size=7)
+        rest = fh.read()
+    assert sh.hd == "@HD\tVN:1.6\tSO:hooted"
+    assert sh.sq_records == ["SN:this-should-appear\tLN:1000"]
+    assert sh.pg_records == [{"ID": "my_program"}]
+    assert (body + rest).decode() == E2E_STREAM.split("@PG\tID:my_program\n")[1]
+
+
+@pytest.mark.parametrize("fd_path", [False, True])
+def test_many_sq(tmp_path, monkeypatch, fd_path):
+    """Test the SQ lines of a large header are kept as runs, not parsed."""
+    sq_lines = "".join(f"@SQ\tSN:ctg{i}\tLN:{i + 1}\n" for i in range(500000))
+    stream = f"@HD\tVN:1.6\n{sq_lines}@PG\tID:minimap2\nREAD1\t0\tctg1\t1\n"
+    added = []
+    add_line = SamHeader.add_line
+
+    def counting_add_line(self, line):
+        added.append(line)
+        return add_line(self, line)
+
+    monkeypatch.setattr(SamHeader, "add_line", counting_add_line)
+    if fd_path:
+        output = run_fd_path(tmp_path, "", stream)
+    else:
+        output = run_text_path("", stream)
+    assert output == stream
+    assert added == ["@HD\tVN:1.6\n", "@PG\tID:minimap2\n"]
+    sh = SamHeader()
+    sh.add_sq_lines(sq_lines)
+    assert sh.n_sq == 500000
+
+
+@pytest.mark.parametrize("buffered", [False, True])
+def test_fd_in_text_out_multibyte(tmp_path, buffered):
+    """Test a character split between raw reads is written out whole."""
+    header = "@PG\tID:hoot\n"
+    # the first read from the descriptor ends within the last "é"
+    padding = "A" * (CHUNK_SIZE - len(header) - len("READ1\t0\t*\t0\tCO:Z:") - 1)
+    stream = f"{header}READ1\t0\t*\t0\tCO:Z:{padding}é\nREAD2\t0\t*\t0\tCO:Z:é\n"
+    (tmp_path / "in.sam").write_text(stream)
+    args = argparser().parse_args(["/dev/null"])
+    # neither output has a file descriptor
+    stream_out = io.TextIOWrapper(io.BytesIO()) if buffered else StringIO()
+    with open(tmp_path / "in.sam") as stream_in:
+        reheader_samstream(StringIO(""), stream_in, stream_out, args)
+    if buffered:
+        stream_out.flush()
+        output = stream_out.buffer.getvalue().decode()
+    else:
+        output = stream_out.getvalue()
+    assert output == run_text_path("", stream)
+    assert output.endswith(f"{padding}é\nREAD2\t0\t*\t0\tCO:Z:é\n")
+
+
+@pytest.mark.parametrize("strategy", COPY_STRATEGIES.keys())
+@pytest.mark.parametrize("pipe_in", [False, True])
+def test_copy_fd_strategies(tmp_path, strategy, pipe_in):
+    """Test each copy strategy either declines or copies everything."""
+    data = E2E_STREAM.encode()
+    (tmp_path / "in.sam").write_bytes(data)
+    with open(tmp_path / "in.sam", "rb") as fin:
+        with open(tmp_path / "out.sam", "wb") as fout:
+            if pipe_in:
+                cat = subprocess.Popen(["cat", tmp_path / "in.sam"], stdout=PIPE)
+                fin = cat.stdout
+            try:
+                used = copy_fd(fin.fileno(), fout.fileno(), strategies=[strategy])
+            except ValueError:
+                # splice needs a pipe, sendfile needs a file to read from
+                assert (strategy, pipe_in) in {("splice", False), ("sendfile", True)}
+                return
+            finally:
+                if pipe_in:
+                    fin.close()
+                    cat.wait()
+    assert used == strategy
+    assert (tmp_path / "out.sam").read_bytes() == data
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 1024])
+@pytest.mark.parametrize("data", [b"", b"A\n", b"A\nBB\nCCC", b"A\n\nBB\n"])
+def test_iter_blocks(data, chunk_size):
+    """Test blocks hold whole lines and nothing is lost."""
+    head, rest = data[:2], io.BytesIO(data[2:])
+    blocks = list(iter_blocks(rest.read, head, chunk_size=chunk_size))
+    assert b"".join(blocks) == data
+    # only the final block may end without a newline
+    assert all(block.endswith(b"\n") for block in blocks[:-1] if block)
+
+
+def test_e2e_output_bam_needs_fd():
+    """Test BAM cannot be written to a text only stream."""
+    args = argparser().parse_args(["/dev/null", "--output-bam"])
+    with pytest.raises(ValueError, match="BAM output"):
+        reheader_samstream(
+            StringIO(E2E_HEADER_IN), StringIO(E2E_STREAM), StringIO(), args)
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+@pytest.mark.parametrize("passthrough", ["auto", "text"])
+def test_e2e_output_bam(tmp_path, threads, passthrough):
+    """Test BAM output holds the same header and records as SAM output."""
+    pysam = pytest.importorskip("pysam")
+    stream = '\n'.join([
+        "@HD\tVN:1.6\tSO:unknown",
+        "@SQ\tSN:this-should-appear\tLN:1000",
+        "@PG\tID:my_program",
+    ] + [
+        f"READ{i}\t0\tthis-should-appear\t{i % 1000 + 1}\t60\t1M\t*\t0\t0\tA\t*"
+        for i in range(50000)]) + '\n'
+    (tmp_path / "in.sam").write_text(stream)
+    args = argparser().parse_args(
+        ["/dev/null", "--output-bam", f"--threads={threads}",
+         f"--passthrough={passthrough}"])
+    with open(tmp_path / "in.sam") as stream_in:
+        with open(tmp_path / "out.bam", "w") as stream_out:
+            reheader_samstream(StringIO(E2E_HEADER_IN), stream_in, stream_out, args)
+
+    expected = run_text_path(E2E_HEADER_IN, stream)
+    with pysam.AlignmentFile(tmp_path / "out.bam", "rb") as bam:
+        assert str(bam.header) == expected[:expected.index("READ0")]
+        names = [read.query_name for read in bam]
+    assert names == [f"READ{i}" for i in range(50000)]
+
+
+def test_template_roundtrip():
+    """Test a header restored from a template has the same state."""
+    sh = SamHeader()
+    for line in E2E_HEADER_IN.splitlines() + [
+        "@PG\tID:bam2fq", "@PG\tID:bam2fq", "@CO\thoot"
+    ]:
+        sh.add_line(line)
+    template = json.loads(json.dumps(sh.to_template()))
+    restored = SamHeader.from_template(template)
+    assert vars(restored) == vars(sh)
+    assert restored.header_str() == sh.header_str()
+
+
+def test_template_bad_version():
+    """Test templates from another version are refused."""
+    template = SamHeader().to_template()
+    template["version"] += 1
+    with pytest.raises(Exception, match="template version 2 is not supported"):
+        SamHeader.from_template(template)
+
+
+@pytest.mark.parametrize("insert", [
+    [],
+    ["@PG\tID:bam2fq\tPN:samtools"],
+    ["@PG\tID:bam2fq\tPN:samtools", "@PG\tID:my_program"],
+], ids=["none", "one", "collision"])
+def test_e2e_from_template(tmp_path, insert):
+    """Test reheadering from a template matches reheadering from the header."""
+    (tmp_path / "header.sam").write_text(E2E_HEADER_IN)
+    main(argparser().parse_args([
+        str(tmp_path / "header.sam"),
+        f"--save-template={tmp_path / 'header.json'}",
+    ] + [f"--insert={x}" for x in insert]))
+
+    args = argparser().parse_args([str(tmp_path / "header.json"), "--from-template"])
+    stream_out = StringIO()
+    with open(tmp_path / "header.json") as header_in:
+        reheader_samstream(header_in, StringIO(E2E_STREAM), stream_out, args)
+    assert stream_out.getvalue() == run_text_path(E2E_HEADER_IN, E2E_STREAM, insert)
+
+
+def test_rg_collision_remap():
+    """Test a conflicting RG is renamed when remapping is enabled."""
+    sh = SamHeader()
+    sh.add_line("@RG\tID:HOOT\tDS:first")
+    sh.add_line("@RG\tID:HOOT-0\tDS:taken")
+    sh.rg_collision = "remap"
+    rg = sh.add_line("@RG\tID:HOOT\tDS:second")
+    assert rg == {"ID": "HOOT-1", "DS": "second"}
+    # repeating the same RG does not remap again
+    assert sh.add_line("@RG\tID:HOOT\tDS:second") == rg
+    assert sh.remapped_rgids == {"HOOT": "HOOT-1"}
+    assert [r["ID"] for r in sh.rg_records] == ["HOOT", "HOOT-0", "HOOT-1"]
+    with pytest.raises(Exception, match="conflicts with more than one previously seen RG"):  # noqa:E501
+        sh.add_line("@RG\tID:HOOT\tDS:third")
+
+
+def test_rg_tag_remapper():
+    """Test only whole RG tags in optional fields are rewritten."""
+    remap = rg_tag_remapper({"A": "A-0", "A-0": "A-0-0"})
+    mandatory = "\t".join(["READ", "0", "RG:Z:A", "1", "60", "1M", "*", "0", "0"])
+    block = "\n".join([
+        f"{mandatory}\tA\t*\tRG:Z:A\tNM:i:0",
+        f"{mandatory}\tA\t*\tNM:i:0\tRG:Z:A-0",
+        f"{mandatory}\tA\t*\tRG:Z:AB",
+        f"{mandatory}\tA\t*",
+        f"{mandatory}\tA\t*\tRG:Z:A",
+    ]).encode()
+    assert remap(block).decode() == "\n".join([
+        f"{mandatory}\tA\t*\tRG:Z:A-0\tNM:i:0",
+        f"{mandatory}\tA\t*\tNM:i:0\tRG:Z:A-0-0",
+        f"{mandatory}\tA\t*\tRG:Z:AB",
+        f"{mandatory}\tA\t*",
+        f"{mandatory}\tA\t*\tRG:Z:A-0",
+    ])
+
+
+RG_HEADER_IN = "@RG\tID:run\tDS:basecalled-first\n"
+RG_STREAM = "".join([
+    "@RG\tID:run\tDS:basecalled-second\n",
+    "@PG\tID:minimap2\n",
+] + [
+    f"READ{i}\t4\t*\t0\t0\t*\t*\t0\t0\tA\t*\tRG:Z:run\n" for i in range(50000)
+])
+
+
+@pytest.mark.parametrize("pipe_in", [False, True])
+def test_e2e_rg_collision_remap(tmp_path, pipe_in):
+    """Test the stream RG and its reads are remapped on either path."""
+    args = argparser().parse_args(["/dev/null", "--rg-collision=remap"])
+    stream_out = StringIO()
+    reheader_samstream(
+        StringIO(RG_HEADER_IN), StringIO(RG_STREAM), stream_out, args)
+    output = stream_out.getvalue()
+    assert output.startswith(
+        "@HD\tVN:1.6\tSO:unknown\n"
+        "@RG\tID:run\tDS:basecalled-first\n"
+        "@RG\tID:run-0\tDS:basecalled-second\n")
+    assert output.count("\tRG:Z:run-0\n") == 50000
+    assert "\tRG:Z:run\n" not in output
+
+    (tmp_path / "in.sam").write_text(RG_STREAM)
+    with open(tmp_path / "in.sam") as stream_in:
+        with open(tmp_path / "out.sam", "w") as fd_out:
+            if pipe_in:
+                cat = subprocess.Popen(
+                    ["cat", tmp_path / "in.sam"], stdout=PIPE, text=True)
+                stream_in = cat.stdout
+            reheader_samstream(StringIO(RG_HEADER_IN), stream_in, fd_out, args)
+            if pipe_in:
+                stream_in.close()
+                cat.wait()
+    assert (tmp_path / "out.sam").read_text() == output
+
+
+def test_e2e_rg_collision_error():
+    """Test a conflicting stream RG is an error by default."""
+    args = argparser().parse_args(["/dev/null"])
+    with pytest.raises(Exception, match="Duplicate RG with ID 'run'"):
+        reheader_samstream(
+            StringIO(RG_HEADER_IN), StringIO(RG_STREAM), StringIO(), args)
+
+
+def sam_line(name, flag, seq="ACGT"):
+    """Return a minimal SAM alignment line."""
+    return f"{name}\t{flag}\tchr1\t1\t60\t4M\t*\t0\t0\t{seq}\t*\tNM:i:0\n"
+
+
+def test_stream_stats():
+    """Test alignments are counted by type from their FLAG."""
+    stats = StreamStats()
+    block = "".join([
+        sam_line("primary", 0),
+        sam_line("primary-rev", 16, seq="ACGTACGT"),
+        sam_line("secondary", 256, seq="*"),
+        sam_line("supplementary", 2048, seq="AC"),
+        sam_line("supplementary-rev", 2064),
+        sam_line("unmapped", 4),
+        sam_line("unmapped-mate", 77),
+    ]).encode()
+    assert stats.update(block) is block
+    stats.update(sam_line("more", 0).encode().rstrip(b"\n"))
+    assert stats.to_dict() == {
+        "total": 8,
+        "primary": 3,
+        "secondary": 1,
+        "supplementary": 2,
+        "unmapped": 2,
+        "mapped_bases": 16,
+    }
+
+
+@pytest.mark.parametrize("fd", [False, True])
+@pytest.mark.parametrize("remap", [False, True])
+def test_e2e_stats_out(tmp_path, fd, remap):
+    """Test stats are written while the stream passes through unchanged."""
+    argv = ["/dev/null", f"--stats-out={tmp_path / 'stats.json'}"]
+    header = ""
+    if remap:
+        argv.append("--rg-collision=remap")
+        header = RG_HEADER_IN
+    args = argparser().parse_args(argv)
+    stream_out = StringIO()
+    if fd:
+        (tmp_path / "in.sam").write_text(RG_STREAM)
+        with open(tmp_path / "in.sam") as stream_in:
+            with open(tmp_path / "out.sam", "w") as fd_out:
+                reheader_samstream(StringIO(header), stream_in, fd_out, args)
+        output = (tmp_path / "out.sam").read_text()
+    else:
+        reheader_samstream(
+            StringIO(header), StringIO(RG_STREAM), stream_out, args)
+        output = stream_out.getvalue()
+    stats = json.loads((tmp_path / "stats.json").read_text())
+    assert stats == {
+        "total": 50000,
+        "primary": 0,
+        "secondary": 0,
+        "supplementary": 0,
+        "unmapped": 50000,
+        "mapped_bases": 0,
+    }
+    assert output.count("\tRG:Z:run-0\n") == (50000 if remap else 0)
+
+
+@pytest.mark.parametrize("passthrough", ["text", "sendfile", "readinto"])
+def test_e2e_passthrough(tmp_path, passthrough):
+    """Test the output is the same whichever passthrough is chosen."""
+    args = argparser().parse_args(["/dev/null", f"--passthrough={passthrough}"])
+    (tmp_path / "in.sam").write_text(E2E_STREAM)
+    with open(tmp_path / "in.sam") as stream_in:
+        with open(tmp_path / "out.sam", "w") as stream_out:
+            reheader_samstream(StringIO(E2E_HEADER_IN), stream_in, stream_out, args)
+    expected = run_text_path(E2E_HEADER_IN, E2E_STREAM)
+    assert (tmp_path / "out.sam").read_text() == expected
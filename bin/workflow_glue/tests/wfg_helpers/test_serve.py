@@ -0,0 +1,77 @@
+"""Test the serve subcommand and its client."""
+import os
+from pathlib import Path
+import subprocess
+import sys
+import time
+
+import pytest
+
+
+BIN_DIR = Path(__file__).resolve().parents[3]
+
+
+@pytest.fixture
+def server(tmp_path):
+    """Start a server on a socket in a temporary directory."""
+    socket_path = tmp_path / "wfg.sock"
+    env = dict(os.environ, PYTHONPATH=str(BIN_DIR))
+    proc = subprocess.Popen(
+        [
+            sys.executable, BIN_DIR / "workflow-glue", "serve",
+            "--socket", socket_path, "--components", "reheader_samstream",
+        ],
+        env=env, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        if socket_path.exists():
+            break
+        time.sleep(0.05)
+    else:
+        proc.kill()
+        raise RuntimeError("Server did not start.")
+    yield socket_path
+    proc.terminate()
+    proc.wait(timeout=10)
+    assert not socket_path.exists()
+
+
+def run(executable, args, stdin, cwd, socket_path=None):
+    """Run a workflow-glue executable and return its result."""
+    env = dict(os.environ, PYTHONPATH=str(BIN_DIR))
+    if socket_path is not None:
+        env["WORKFLOW_GLUE_SOCKET"] = str(socket_path)
+    return subprocess.run(
+        [sys.executable, BIN_DIR / executable] + args,
+        input=stdin, capture_output=True, cwd=cwd, env=env)
+
+
+def test_client_matches_direct_run(server, tmp_path):
+    """Test a subcommand run via the server produces identical output."""
+    (tmp_path / "header.sam").write_text("@RG\tID:my_reads\n")
+    stream = b"@PG\tID:my_program\nREAD1\nREAD2\n"
+    args = ["reheader_samstream", "header.sam", "--insert", "@PG\tID:hoot"]
+    direct = run("workflow-glue", args, stream, tmp_path)
+    served = run("workflow-glue-client", args, stream, tmp_path, server)
+    assert served.returncode == direct.returncode == 0
+    assert served.stdout == direct.stdout
+    assert served.stdout.startswith(b"@HD")
+
+
+def test_client_exit_status(server, tmp_path):
+    """Test the client exits with the status of the subcommand."""
+    args = ["reheader_samstream", "missing.sam"]
+    served = run("workflow-glue-client", args, b"", tmp_path, server)
+    assert served.returncode == 1
+    assert b"FileNotFoundError" in served.stderr
+    served = run("workflow-glue-client", ["not_a_command"], b"", tmp_path, server)
+    assert served.returncode == 2
+
+
+def test_client_without_server(tmp_path):
+    """Test the client runs the command itself when no server is listening."""
+    (tmp_path / "header.sam").write_text("@RG\tID:my_reads\n")
+    args = ["reheader_samstream", "header.sam"]
+    result = run(
+        "workflow-glue-client", args, b"READ1\n", tmp_path, tmp_path / "no.sock")
+    assert result.returncode == 0
+    assert result.stdout == b"@HD\tVN:1.6\tSO:unknown\n@RG\tID:my_reads\nREAD1\n"
@@ -0,0 +1,107 @@
+"""Test xam_header.py."""
+
+import gzip
+
+import pysam
+import pytest
+from workflow_glue.tests.conftest import write_bam
+from workflow_glue.wfg_helpers import check_xam_index, xam_header
+
+
+HEADERS = {
+    "unaligned": "@HD\tVN:1.6\tSO:unknown\n@RG\tID:run\n",
+    "aligned": "@HD\tVN:1.6\tSO:coordinate\n@SQ\tSN:chr1\tLN:100\n@SQ\tSN:chr2\tLN:5\n",
+    "m5": f"@SQ\tSN:chr1\tLN:100\tM5:{'a' * 32}\tUR:file:///ref.fa\n",
+    "tag-order": f"@SQ\tLN:100\tUR:file:///ref.fa\tM5:{'a' * 32}\tSN:chr1\n",
+    "no-hd": "@SQ\tSN:chr1\tLN:100\n@PG\tID:minimap2\n",
+    "read-groups": (
+        "@RG\tID:a\tDS:runid=run1 basecall_model=fast@v4\n"
+        "@RG\tID:b\tDS:runid=run2 basecall_model=fast@v4\n"
+        "@RG\tID:c\tDS:basecall_model=hac@v5\n"
+        "@RG\tID:d\tDS:no model here\n"),
+    # a header spanning many BGZF blocks
+    "large": "".join(
+        f"@SQ\tSN:contig{i}\tLN:{i + 1}\tM5:{i:032x}\n" for i in range(20000)),
+}
+
+
+@pytest.mark.parametrize("name", HEADERS)
+@pytest.mark.parametrize("mode,ext", [("wb", "bam"), ("w", "sam")])
+def test_read_header_matches_pysam(tmp_path, name, mode, ext):
+    """Test the header summary matches one made from pysam's header."""
+    fname = write_bam(tmp_path / f"reads.{ext}", header=HEADERS[name], mode=mode)
+    header = xam_header.read_header(fname)
+    assert header == xam_header._header_from_pysam(fname)
+    with pysam.AlignmentFile(str(fname), check_sq=False) as f:
+        assert header.n_sq == len(f.header.to_dict().get("SQ", []))
+        assert header.hd == f.header.to_dict().get("HD")
+
+
+def test_read_header_run_info(tmp_path):
+    """Test run IDs and basecall models are found in RG.DS."""
+    fname = write_bam(tmp_path / "reads.bam", header=HEADERS["read-groups"])
+    header = xam_header.read_header(fname)
+    assert header.run_ids == ["run1", "run2"]
+    assert header.basecall_models == ["fast@v4", "hac@v5"]
+
+
+def test_read_header_references_only(tmp_path):
+    """Test the binary references are used when the text has no `@SQ`."""
+    header = pysam.AlignmentHeader.from_references(["chr1", "chr2"], [100, 5])
+    fname = write_bam(tmp_path / "reads.bam", header=header)
+    summary = xam_header.read_header(fname)
+    assert summary.n_sq == 2
+    assert summary == xam_header._header_from_pysam(fname)
+
+
+def test_sq_digest():
+    """Test only SN, LN and M5 of `@SQ` affect the digest."""
+    m5 = HEADERS["m5"]
+    same = xam_header.sq_digest(xam_header._sq_from_text(m5))
+    assert same == xam_header.sq_digest(
+        xam_header._sq_from_text(HEADERS["tag-order"]))
+    assert same == xam_header.sq_digest(
+        xam_header._sq_from_text(m5.replace("ref.fa", "other.fa")))
+    for changed in [
+        m5.replace("chr1", "chr2"),
+        m5.replace("LN:100", "LN:101"),
+        m5.replace("\tM5:" + "a" * 32, ""),
+        m5 + m5.replace("chr1", "chr2"),
+    ]:
+        assert same != xam_header.sq_digest(xam_header._sq_from_text(changed))
+    # fields cannot be shifted between elements
+    assert xam_header.sq_digest([("a1", 1, None)]) != xam_header.sq_digest(
+        [("a", 11, None)])
+
+
+def test_sq_without_ln():
+    """Test malformed `@SQ` lines are not silently skipped."""
+    with pytest.raises(ValueError, match="without SN or LN"):
+        xam_header._sq_from_text("@SQ\tSN:chr1\tLN:1\n@SQ\tSN:chr2\n")
+
+
+def test_is_bam(tmp_path):
+    """Test BAM is told apart from SAM and bgzipped SAM."""
+    bam = write_bam(tmp_path / "reads.bam", header=HEADERS["aligned"])
+    sam = write_bam(tmp_path / "reads.sam", header=HEADERS["aligned"], mode="w")
+    assert xam_header.is_bam(bam)
+    assert not xam_header.is_bam(sam)
+    sam_gz = tmp_path / "reads.sam.gz"
+    pysam.tabix_compress(str(sam), str(sam_gz))
+    assert not xam_header.is_bam(sam_gz)
+    # plain gzip has no BGZF extra field
+    gz = tmp_path / "reads.gz"
+    with open(bam, "rb") as fh:
+        gz.write_bytes(gzip.compress(fh.read()))
+    assert not xam_header.is_bam(gz)
+
+
+def test_validate_xam_index(tmp_path):
+    """Test BAM without an index file is found invalid, and with one valid."""
+    bam = write_bam(tmp_path / "reads.bam", header=HEADERS["aligned"])
+    assert not check_xam_index.validate_xam_index(bam)
+    pysam.index(str(bam))
+    assert check_xam_index.validate_xam_index(bam)
+    # htslib also finds an index named without the BAM extension
+    (tmp_path / "reads.bam.bai").rename(tmp_path / "reads.bai")
+    assert check_xam_index.validate_xam_index(bam)
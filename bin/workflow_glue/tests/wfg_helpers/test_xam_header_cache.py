@@ -0,0 +1,166 @@
+"""Test xam_header_cache.py."""
+import multiprocessing
+import os
+
+import pytest
+from workflow_glue.tests.conftest import write_bam
+from workflow_glue.wfg_helpers import check_bam_headers_in_dir
+from workflow_glue.wfg_helpers.xam_header import XamHeader
+from workflow_glue.wfg_helpers.xam_header_cache import file_identity, HeaderCache
+
+
+REF = [{"SN": "chr1", "LN": 1000}]
+HEADER = XamHeader(
+    2, "digest", {"VN": "1.6", "SO": "coordinate"}, ["run1"], ["hac@v5.0.0"])
+
+
+@pytest.fixture
+def xam_file(tmp_path):
+    """Return an input file, the cache only looks at its identity."""
+    fname = tmp_path / "reads.bam"
+    fname.write_bytes(b"reads")
+    return str(fname)
+
+
+def test_round_trip(tmp_path, xam_file):
+    """Test a header is returned as it was stored, from a new connection."""
+    with HeaderCache(tmp_path / "cache.db") as cache:
+        assert cache.get_many([xam_file]) == {}
+        cache.put_many({file_identity(xam_file): HEADER})
+    with HeaderCache(tmp_path / "cache.db") as cache:
+        assert cache.get_many([xam_file]) == {xam_file: HEADER}
+
+
+@pytest.mark.parametrize("change", ["size", "mtime", "replace"])
+def test_miss_after_change(tmp_path, xam_file, change):
+    """Test a modified or replaced file is not given the stored header."""
+    with HeaderCache(tmp_path / "cache.db") as cache:
+        cache.put_many({file_identity(xam_file): HEADER})
+        if change == "size":
+            with open(xam_file, "ab") as fh:
+                fh.write(b"more reads")
+        elif change == "mtime":
+            stat = os.stat(xam_file)
+            os.utime(xam_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        else:
+            new = f"{xam_file}.new"
+            with open(new, "wb") as fh:
+                fh.write(b"reads")
+            os.replace(new, xam_file)
+        assert cache.get_many([xam_file]) == {}
+
+
+def test_symlink(tmp_path, xam_file):
+    """Test a staged symlink shares the entry of the file it points to."""
+    link = str(tmp_path / "staged.bam")
+    os.symlink(xam_file, link)
+    with HeaderCache(tmp_path / "cache.db") as cache:
+        cache.put_many({file_identity(xam_file): HEADER})
+        assert cache.get_many([link]) == {link: HEADER}
+
+
+def test_missing_file(tmp_path, xam_file):
+    """Test a file that cannot be found is a miss, not an error."""
+    with HeaderCache(tmp_path / "cache.db") as cache:
+        cache.put_many({file_identity(xam_file): HEADER})
+        os.unlink(xam_file)
+        assert cache.get_many([xam_file]) == {}
+
+
+def test_unusable_cache(tmp_path, xam_file):
+    """Test a cache that cannot be read or written is skipped."""
+    with HeaderCache(tmp_path / "cache.db") as cache:
+        cache.conn.execute("DROP TABLE xam_headers_v1")
+        cache.put_many({file_identity(xam_file): HEADER})
+        assert cache.get_many([xam_file]) == {}
+
+
+def _put(args):
+    """Store headers for files from a separate process."""
+    path, fnames = args
+    with HeaderCache(path) as cache:
+        for fname in fnames:
+            cache.put_many({file_identity(fname): HEADER})
+
+
+def test_concurrent_writers(tmp_path):
+    """Test processes writing to the same cache do not lose entries."""
+    fnames = []
+    for i in range(40):
+        fname = tmp_path / f"reads{i}.bam"
+        fname.write_bytes(b"reads")
+        fnames.append(str(fname))
+    path = str(tmp_path / "cache.db")
+    # create the table before the writers race to do so
+    HeaderCache(path).close()
+    with multiprocessing.Pool(4) as pool:
+        pool.map(_put, [(path, fnames[i::4]) for i in range(4)])
+    with HeaderCache(path) as cache:
+        assert cache.get_many(fnames) == {fname: HEADER for fname in fnames}
+
+
+def test_check_bam_headers_in_dir(tmp_path, capsys, monkeypatch):
+    """Test only files that are not in the cache are read."""
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for i in range(3):
+        write_bam(input_dir / f"reads{i}.bam", REF)
+    read = []
+    read_header = check_bam_headers_in_dir.read_header
+
+    def counting_read_header(xam_file):
+        read.append(os.path.basename(xam_file))
+        return read_header(xam_file)
+
+    monkeypatch.setattr(
+        check_bam_headers_in_dir, "read_header", counting_read_header)
+
+    def run():
+        args = check_bam_headers_in_dir.argparser().parse_args(
+            [str(input_dir), "--header-cache", str(tmp_path / "cache.db")])
+        check_bam_headers_in_dir.main(args)
+        return capsys.readouterr().out
+
+    expected = "IS_UNALIGNED=0;MIXED_HEADERS=0;IS_SORTED=0"
+    assert run() == expected
+    assert sorted(read) == ["reads0.bam", "reads1.bam", "reads2.bam"]
+
+    read.clear()
+    write_bam(input_dir / "reads3.bam", REF, "coordinate")
+    assert run() == "IS_UNALIGNED=0;MIXED_HEADERS=0;IS_SORTED=1"
+    assert read == ["reads3.bam"]
+
+
+def test_check_bam_headers_in_dir_bad_cache(tmp_path, capsys):
+    """Test the check still runs if the cache cannot be opened."""
+    write_bam(tmp_path / "reads.bam", REF)
+    args = check_bam_headers_in_dir.argparser().parse_args(
+        [str(tmp_path), "--header-cache", str(tmp_path / "missing" / "cache.db")])
+    check_bam_headers_in_dir.main(args)
+    assert capsys.readouterr().out == "IS_UNALIGNED=0;MIXED_HEADERS=0;IS_SORTED=0"
+
+
+def test_check_bam_headers_in_dir_changed(tmp_path, capsys, monkeypatch):
+    """Test a file changed while its header is read is read again next run."""
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    fname = write_bam(input_dir / "reads.bam", REF)
+    read = []
+    read_header = check_bam_headers_in_dir.read_header
+
+    def changing_read_header(xam_file):
+        header = read_header(xam_file)
+        if not read:
+            write_bam(xam_file, REF, "coordinate")
+        read.append(xam_file)
+        return header
+
+    monkeypatch.setattr(
+        check_bam_headers_in_dir, "read_header", changing_read_header)
+    args = check_bam_headers_in_dir.argparser().parse_args(
+        [str(input_dir), "--header-cache", str(tmp_path / "cache.db")])
+    check_bam_headers_in_dir.main(args)
+    assert capsys.readouterr().out == "IS_UNALIGNED=0;MIXED_HEADERS=0;IS_SORTED=0"
+    check_bam_headers_in_dir.main(args)
+    assert capsys.readouterr().out == "IS_UNALIGNED=0;MIXED_HEADERS=0;IS_SORTED=1"
+    assert [str(xam_file) for xam_file in read] == [fname, fname]
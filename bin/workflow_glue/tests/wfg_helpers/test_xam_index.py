@@ -0,0 +1,281 @@
+"""Test xam_index.py."""
+import os
+import struct
+
+import pysam
+from pysam.libcbgzf import BGZFile
+import pytest
+from workflow_glue.tests.conftest import tiled_reads, write_bam
+from workflow_glue.wfg_helpers import check_xam_index, xam_index
+
+
+REF = [{"SN": "chr1", "LN": 10000000}, {"SN": "chr2", "LN": 10000000}]
+
+
+def write_reads(fname, n_records, sq=REF, step=50, seed=None):
+    """Write a sorted BAM with records spread over the first reference."""
+    reads = tiled_reads(range(0, n_records * step, step), seed=seed)
+    return write_bam(fname, sq, "coordinate", reads=reads)
+
+
+def index_bam(fname, csi=False):
+    """Index a BAM, returning the path of the index."""
+    if csi:
+        pysam.index("-c", fname)
+        return f"{fname}.csi"
+    pysam.index(fname)
+    return f"{fname}.bai"
+
+
+def touch_after(index, xam_file):
+    """Set the mtime of an index to after that of its BAM."""
+    mtime = os.stat(xam_file).st_mtime_ns + 10 ** 9
+    os.utime(index, ns=(mtime, mtime))
+
+
+@pytest.mark.parametrize("csi", [False, True])
+def test_valid(tmp_path, csi):
+    """Test a fresh index is valid, and found without being given."""
+    bam = write_reads(tmp_path / "reads.bam", 1000)
+    index = index_bam(bam, csi=csi)
+    assert xam_index.check_index(bam, index) == (bam, index, True, None)
+    assert xam_index.check_index(bam).valid
+    with open(index, "rb") as fh:
+        n_ref, max_offset = xam_index.parse_index(fh.read())
+    assert n_ref == 2
+    assert 0 < max_offset >> 16 < os.path.getsize(bam)
+
+
+@pytest.mark.parametrize("csi", [False, True])
+def test_stale_offsets(tmp_path, csi):
+    """Test an index of a larger, earlier version of the BAM is rejected."""
+    bam = write_reads(tmp_path / "reads.bam", 20000)
+    index = index_bam(bam, csi=csi)
+    write_reads(bam, 10)
+    touch_after(index, bam)
+    result = xam_index.check_index(bam, index)
+    assert not result.valid
+    assert "beyond the end of the BAM" in result.reason
+
+
+def test_stale_n_ref(tmp_path):
+    """Test an index with a different number of references is rejected."""
+    bam = write_reads(tmp_path / "reads.bam", 10)
+    index = index_bam(bam)
+    write_reads(bam, 10, sq=REF[:1])
+    touch_after(index, bam)
+    result = xam_index.check_index(bam, index)
+    assert result.reason == "Index has 2 references but the BAM header has 1."
+
+
+def test_n_ref_binary_references(tmp_path):
+    """Test the references of the index are compared with binary ones."""
+    header = "@HD\tVN:1.6\n@SQ\tSN:chr1\tLN:10000000\n"
+    references = b"".join(
+        struct.pack("<i", 5) + f"chr{i}\0".encode() + struct.pack("<i", 10000000)
+        for i in (1, 2))
+    bam = str(tmp_path / "reads.bam")
+    # the text has a single SQ, but the binary references have two
+    with BGZFile(bam, "wb") as fh:
+        fh.write(
+            b"BAM\1" + struct.pack("<i", len(header)) + header.encode()
+            + struct.pack("<i", 2) + references)
+    index = index_bam(bam)
+    assert xam_index.check_index(bam, index).valid
+
+
+def test_older_than_bam(tmp_path):
+    """Test an index modified before the BAM is rejected, unless allowed."""
+    bam = write_reads(tmp_path / "reads.bam", 10)
+    index = index_bam(bam)
+    touch_after(bam, index)
+    result = xam_index.check_index(bam, index)
+    assert result.reason == "Index is older than the BAM."
+    assert xam_index.check_index(bam, index, check_mtime=False).valid
+
+
+@pytest.mark.parametrize("contents,reason", [
+    (b"not an index", "Not a BAI or BGZF compressed CSI."),
+    (b"BAI\x01\x02\x00\x00\x00\x01", "Index is truncated."),
+], ids=["magic", "truncated"])
+def test_malformed(tmp_path, contents, reason):
+    """Test an index that cannot be parsed is rejected with the reason."""
+    bam = write_reads(tmp_path / "reads.bam", 10)
+    index = tmp_path / "reads.bam.bai"
+    index.write_bytes(contents)
+    touch_after(index, bam)
+    assert xam_index.check_index(bam).reason == reason
+
+
+def test_no_index(tmp_path):
+    """Test a BAM without an index is rejected."""
+    bam = write_reads(tmp_path / "reads.bam", 10)
+    assert xam_index.check_index(bam) == (bam, None, False, "No index found.")
+
+
+def test_check_indexes_in_order(tmp_path):
+    """Test results of many pairs are given in order."""
+    pairs = []
+    for i in range(10):
+        bam = write_reads(tmp_path / f"reads{i}.bam", 10)
+        # only even BAMs are indexed
+        pairs.append((bam, index_bam(bam) if i % 2 == 0 else None))
+    results = list(xam_index.check_indexes(pairs, threads=4))
+    assert [r.xam_file for r in results] == [bam for bam, _ in pairs]
+    assert [r.valid for r in results] == [i % 2 == 0 for i in range(10)]
+
+
+def test_check_xam_index_main(tmp_path, capsys):
+    """Test a stale index is reported invalid by check_xam_index."""
+    bam = write_reads(tmp_path / "reads.bam", 20000)
+    index = index_bam(bam)
+    args = check_xam_index.argparser().parse_args([bam])
+    check_xam_index.main(args)
+    assert capsys.readouterr().out == "HAS_VALID_INDEX=1"
+    write_reads(bam, 10)
+    touch_after(index, bam)
+    check_xam_index.main(args)
+    assert capsys.readouterr().out == "HAS_VALID_INDEX=0"
+
+
+def test_check_xam_index_mtime(tmp_path, capsys):
+    """Test an older index is only rejected by check_xam_index if asked."""
+    bam = write_reads(tmp_path / "reads.bam", 10)
+    index = index_bam(bam)
+    touch_after(bam, index)
+    for extra_args, expected in (([], "1"), (["--check-mtime"], "0")):
+        args = check_xam_index.argparser().parse_args([bam] + extra_args)
+        check_xam_index.main(args)
+        assert capsys.readouterr().out == f"HAS_VALID_INDEX={expected}"
+
+
+def run_batch(capsys, *argv):
+    """Run check_xam_index in batch mode, returning the rows of its TSV."""
+    args = check_xam_index.argparser().parse_args(argv)
+    check_xam_index.main(args)
+    header, *lines = capsys.readouterr().out.splitlines()
+    assert header == "bam\tindex\tstatus\trebuilt\treason"
+    return [line.split("\t") for line in lines]
+
+
+@pytest.mark.parametrize("csi", [False, True])
+def test_batch_rebuild(tmp_path, capsys, csi):
+    """Test missing and stale indexes of a directory are rebuilt."""
+    fresh = write_reads(tmp_path / "fresh.bam", 10)
+    fresh_index = index_bam(fresh)
+    stale = write_reads(tmp_path / "stale.bam", 20000)
+    stale_index = index_bam(stale, csi=csi)
+    write_reads(stale, 10)
+    touch_after(stale_index, stale)
+    missing = write_reads(tmp_path / "missing.bam", 10)
+    rows = run_batch(
+        capsys, "--input-dir", str(tmp_path), "--rebuild", "--threads", "2",
+        *(["--csi"] if csi else []))
+    missing_index = f"{missing}.csi" if csi else f"{missing}.bai"
+    assert [row[:4] for row in rows] == [
+        [fresh, fresh_index, "valid", "0"],
+        [missing, missing_index, "invalid", "1"],
+        [stale, stale_index, "invalid", "1"],
+    ]
+    for bam in (fresh, stale, missing):
+        assert xam_index.check_index(bam).valid
+    # no temporary files are left behind
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        os.path.basename(f) for f in (
+            fresh, fresh_index, stale, stale_index, missing, missing_index))
+
+
+def test_batch_rebuild_failure(tmp_path, capsys):
+    """Test a BAM that cannot be indexed is reported, not stopping the run."""
+    reads = tiled_reads([500, 100, 900])
+    unsorted = write_bam(tmp_path / "a_unsorted.bam", REF, "coordinate", reads=reads)
+    missing = write_reads(tmp_path / "b_missing.bam", 10)
+    rows = run_batch(capsys, "--input-dir", str(tmp_path), "--rebuild")
+    assert [row[:4] for row in rows] == [
+        [unsorted, "", "invalid", "0"],
+        [missing, f"{missing}.bai", "invalid", "1"],
+    ]
+    assert "Rebuild failed: " in rows[0][4]
+    assert xam_index.check_index(missing).valid
+    assert sorted(os.listdir(tmp_path)) == [
+        "a_unsorted.bam", "b_missing.bam", "b_missing.bam.bai"]
+
+
+def test_batch_manifest(tmp_path, capsys):
+    """Test a manifest is checked, without rebuilding unless asked."""
+    bam = write_reads(tmp_path / "reads.bam", 10)
+    index = tmp_path / "elsewhere.bai"
+    os.rename(index_bam(bam), index)
+    other = write_reads(tmp_path / "other.bam", 10)
+    manifest = tmp_path / "manifest.tsv"
+    manifest.write_text(f"bam\tindex\n{bam}\t{index}\n{other}\t\n")
+    rows = run_batch(capsys, "--manifest", str(manifest))
+    assert rows == [
+        [bam, str(index), "valid", "0", ""],
+        [other, "", "invalid", "0", "No index found."],
+    ]
+
+
+def test_rebuild_index_atomic(tmp_path, monkeypatch):
+    """Test a failed rebuild leaves the existing index untouched."""
+    bam = write_reads(tmp_path / "reads.bam", 10)
+    index = index_bam(bam)
+    with open(index, "rb") as fh:
+        contents = fh.read()
+
+    def fail(*args):
+        # samtools writes part of the index before failing
+        with open(args[-1], "wb") as fh:
+            fh.write(b"partial")
+        raise pysam.SamtoolsError("failed")
+
+    monkeypatch.setattr(check_xam_index.pysam, "index", fail)
+    with pytest.raises(pysam.SamtoolsError):
+        check_xam_index.rebuild_index(bam, index)
+    with open(index, "rb") as fh:
+        assert fh.read() == contents
+    assert sorted(os.listdir(tmp_path)) == ["reads.bam", "reads.bam.bai"]
+
+
+def test_single_mode_arguments(tmp_path):
+    """Test a XAM and a batch input cannot be given together."""
+    bam = write_reads(tmp_path / "reads.bam", 10)
+    for argv in ([], [bam, "--input-dir", str(tmp_path)], [bam, "--rebuild"]):
+        args = check_xam_index.argparser().parse_args(argv)
+        with pytest.raises(ValueError):
+            check_xam_index.main(args)
+
+
+@pytest.mark.parametrize("csi", [False, True])
+def test_index_density(tmp_path, csi):
+    """Test the compressed bytes of the windows of an index add up."""
+    bam = write_reads(tmp_path / "reads.bam", 20000)
+    index = index_bam(bam, csi=csi)
+    with open(index, "rb") as fh:
+        data = fh.read()
+    window_size, densities = xam_index.index_density(data)
+    assert window_size == 16384
+    # reads cover the first 1 Mb of chr1, and none of chr2; htslib merges
+    # the CSI bins of regions within a few BGZF blocks, which these reads of
+    # a repeated sequence are
+    if not csi:
+        assert len(densities[0]) == -(-(20000 * 50) // 16384)
+    assert densities[1] == []
+    assert all(density >= 0 for density in densities[0])
+    # the reads of chr1 are all the BAM but its header and EOF block
+    assert 0.9 < sum(densities[0]) / os.path.getsize(bam) < 1
+
+
+def test_index_density_bai_csi(tmp_path):
+    """Test the densest windows of a BAI and a CSI of a uniform BAM agree."""
+    bam = write_reads(tmp_path / "reads.bam", 20000, step=100, seed=1)
+    densities = []
+    for csi in (False, True):
+        with open(index_bam(bam, csi=csi), "rb") as fh:
+            densities.append(xam_index.index_density(fh.read())[1][0])
+    bai, csi = densities
+    assert sum(bai) == sum(csi)
+    # the linear index of a BAI only changes with each BGZF block, so its
+    # windows alternate between empty and two windows worth of bytes
+    assert abs(bai.index(max(bai)) - csi.index(max(csi))) <= 2
+    assert max(csi) <= max(bai)
@@ -0,0 +1,97 @@
+"""Test xam_preflight.py."""
+import json
+
+import pysam
+import pytest
+from workflow_glue.tests.conftest import write_bam
+from workflow_glue.wfg_helpers import xam_preflight
+
+
+REF = [{"SN": "chr1", "LN": 1000}]
+OTHER_REF = [{"SN": "chr2", "LN": 1000}]
+
+
+def write_input(fname, sq=None, so=None, run_id=None, index=None):
+    """Write a BAM with a single record and the given header, and an index."""
+    rg = None
+    if run_id is not None:
+        rg = [{"ID": run_id, "DS": f"runid={run_id} basecall_model=hac@v5.0.0"}]
+    reference_id = None if sq is None else 0
+    write_bam(fname, sq, so, rg, reads=[(reference_id, 10, "ACGT")])
+    if index == "valid":
+        pysam.index(str(fname))
+    elif index == "corrupt":
+        with open(f"{fname}.bai", "wb") as fh:
+            fh.write(b"not an index")
+    return str(fname)
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    """Return a function writing a manifest of (alias, path) rows."""
+    def _manifest(rows):
+        fname = tmp_path / "manifest.tsv"
+        with open(fname, "w") as fh:
+            fh.write("alias\tpath\n")
+            for alias, path in rows:
+                fh.write(f"{alias}\t{path}\n")
+        return fname
+    return _manifest
+
+
+@pytest.mark.parametrize("bams,keep_unaligned,expected", [
+    ([(REF, "coordinate", "valid")], False, ("indexed", True)),
+    ([(REF, "coordinate", "corrupt")], False, ("to_index", False)),
+    ([(REF, "coordinate", None)], False, ("to_index", None)),
+    ([(REF, None, None)], False, ("to_catsort", None)),
+    ([(None, None, "valid")], True, ("indexed", True)),
+    ([(None, None, None)] * 2, True, ("to_catsort", None)),
+    ([(None, None, None)] * 2, False, ("no_files", None)),
+    ([(REF, "coordinate", None)] * 2, False, ("to_merge", None)),
+    ([(REF, None, None)] * 2, False, ("to_sortmerge", None)),
+    ([(REF, None, None), (OTHER_REF, None, None)], False, (None, None)),
+], ids=[
+    "indexed", "corrupt-index", "no-index", "unsorted", "unaligned-indexed",
+    "unaligned", "unaligned-dropped", "merge", "sortmerge", "mixed"])
+def test_plan(tmp_path, manifest, bams, keep_unaligned, expected):
+    """Test the branch and index validity of single samples."""
+    paths = [
+        write_input(tmp_path / f"reads{i}.bam", sq, so, index=index)
+        for i, (sq, so, index) in enumerate(bams)]
+    samples = xam_preflight.read_manifest(manifest(("s1", p) for p in paths))
+    (plan,) = xam_preflight.plan_samples(
+        samples, threads=2, keep_unaligned=keep_unaligned)
+    assert (plan["branch"], plan["index_valid"]) == expected
+    assert plan["files"] == paths
+
+
+def test_main(tmp_path, manifest, capsys):
+    """Test samples are planned in order with the run IDs of all their files."""
+    rows = []
+    for alias, n_files in (("s2", 1), ("s1", 3)):
+        for i in range(n_files):
+            path = write_input(
+                tmp_path / f"{alias}_{i}.bam", REF, "coordinate", run_id=f"run{i}")
+            rows.append((alias, path))
+    args = xam_preflight.argparser().parse_args(
+        [str(manifest(rows)), "--threads", "4"])
+    xam_preflight.main(args)
+    plans = json.loads(capsys.readouterr().out)
+    assert [plan["alias"] for plan in plans] == ["s2", "s1"]
+    assert plans[0]["run_ids"] == ["run0"]
+    assert plans[1]["run_ids"] == ["run0", "run1", "run2"]
+    assert plans[1]["basecall_models"] == ["hac@v5.0.0"]
+    assert plans[1]["branch"] == "to_merge"
+
+
+def test_manifest_index_column(tmp_path):
+    """Test an index given in the manifest is used instead of `<path>.bai`."""
+    path = write_input(tmp_path / "reads.bam", REF, "coordinate", index="valid")
+    index = tmp_path / "elsewhere.bai"
+    (tmp_path / "reads.bam.bai").rename(index)
+    fname = tmp_path / "manifest.tsv"
+    fname.write_text(f"alias\tpath\tindex\ns1\t{path}\t{index}\n")
+    samples = xam_preflight.read_manifest(fname)
+    assert samples == {"s1": ([path], str(index))}
+    (plan,) = xam_preflight.plan_samples(samples)
+    assert plan["branch"] == "indexed"
@@ -3,7 +3,12 @@
 Be careful what you place in here. This file is imported into all glue.
 """
 import argparse
+import collections
+import contextlib
 import logging
+import os
+import sys
+import threading
 
 
 _log_name = None
@@ -37,6 +42,20 @@ def wf_parser(name):
         add_help=False)
 
 
+def exit_status(code):
+    """Convert the argument of `sys.exit` to a process exit status.
+
+    This mirrors the interpreter: `None` is success, integers are used as
+    they are and anything else is printed to stderr and treated as failure.
+    """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write(f"{code}\n")
+    return 1
+
+
 def _log_level():
     """Parser to set logging level and acquire software version/commit."""
     parser = argparse.ArgumentParser(
@@ -52,4 +71,255 @@ def _log_level():
         dest='log_level', const=logging.WARNING, default=logging.INFO,
         help='Minimal logging; warnings only.')
 
+    parser.add_argument(
+        '--profile', choices=PROFILE_EXTENSIONS.keys(),
+        help=(
+            'Profile the subcommand: cprofile writes a .pstats file, '
+            'tracemalloc the top allocating lines and wall a sampled '
+            'wall-clock profile of folded stacks for flame graphs.'))
+    parser.add_argument(
+        '--profile-out',
+        help=(
+            'Path of the profile report. Defaults to <subcommand> with an '
+            'extension for the profiler, in the working directory.'))
+    parser.add_argument(
+        '--metrics', action='store_true',
+        help=(
+            'Write resource usage of the subcommand to a JSON sidecar in the '
+            f'working directory. Also enabled by setting ${METRICS_ENV}.'))
+
     return parser
+
+
+METRICS_ENV = "WORKFLOW_GLUE_METRICS"
+METRICS_SIDECAR_PREFIX = ".workflow-glue."
+METRICS_SIDECAR_SUFFIX = ".metrics.json"
+
+PROFILE_EXTENSIONS = {
+    "cprofile": "pstats",
+    "tracemalloc": "tracemalloc.txt",
+    "wall": "wall.folded",
+}
+
+
+class WallClockSampler(threading.Thread):
+    """Periodically sample the stack of a thread.
+
+    Unlike cProfile, samples are taken regardless of whether the thread is
+    running Python code, waiting on I/O or inside a C extension, making this
+    suitable for finding where time goes in I/O heavy helpers.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        """Initialise a sampler of the thread with the given ident."""
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop_sampling = threading.Event()
+
+    @staticmethod
+    def frame_name(frame):
+        """Return a name for a stack frame."""
+        code = frame.f_code
+        module = frame.f_globals.get("__name__", "?")
+        return f"{module}.{getattr(code, 'co_qualname', code.co_name)}"
+
+    def run(self):
+        """Sample until stopped."""
+        while not self._stop_sampling.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self.frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        """Stop sampling and wait for the sampler to finish."""
+        self._stop_sampling.set()
+        self.join()
+
+    def write(self, fname):
+        """Write samples as folded stacks, one stack and its count per line."""
+        with open(fname, "w") as fh:
+            for stack, count in self.counts.most_common():
+                fh.write(f"{stack} {count}\n")
+
+
+def _write_tracemalloc_report(snapshot, peak, fname, limit=50):
+    """Write the lines responsible for the most allocated memory."""
+    stats = snapshot.statistics("lineno")
+    with open(fname, "w") as fh:
+        fh.write(f"# peak traced memory: {peak} bytes\n")
+        fh.write(f"# top {min(limit, len(stats))} of {len(stats)} lines\n")
+        for stat in stats[:limit]:
+            frame = stat.traceback[0]
+            fh.write(
+                f"{stat.size}\t{stat.count}\t{frame.filename}:{frame.lineno}\n")
+
+
+@contextlib.contextmanager
+def profiler(mode, fname=None, name="workflow-glue"):
+    """Profile the enclosed block, writing a report when it exits.
+
+    :param mode: one of `PROFILE_EXTENSIONS`, or None to not profile.
+    :param fname: path of the report, defaults to name with an extension
+        for the mode in the working directory.
+    :param name: name used for the default report path.
+    """
+    if mode is None:
+        yield None
+        return
+    if fname is None:
+        fname = os.path.join(os.getcwd(), f"{name}.{PROFILE_EXTENSIONS[mode]}")
+    logger = get_named_logger("profiler")
+
+    # profilers are imported here as this module is imported into all glue
+    if mode == "cprofile":
+        import cProfile
+        prof = cProfile.Profile()
+        start = prof.enable
+
+        def finish():
+            prof.disable()
+            prof.dump_stats(fname)
+    elif mode == "tracemalloc":
+        import tracemalloc
+
+        def start():
+            tracemalloc.start(25)
+
+        def finish():
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            _write_tracemalloc_report(snapshot, peak, fname)
+    elif mode == "wall":
+        sampler = WallClockSampler(threading.get_ident())
+        start = sampler.start
+
+        def finish():
+            sampler.stop()
+            sampler.write(fname)
+    else:
+        raise ValueError(f"Unknown profiler: {mode}")
+
+    start()
+    try:
+        yield fname
+    finally:
+        finish()
+        logger.info(f"Wrote {mode} profile to '{fname}'.")
+
+
+_record_counts = collections.Counter()
+
+
+def count_records(name, n=1):
+    """Add to a named count of records processed, reported in task metrics."""
+    _record_counts[name] += n
+
+
+def _io_counters():
+    """Return the bytes read and written by this process, where known."""
+    counters = {}
+    try:
+        with open("/proc/self/io") as fh:
+            for line in fh:
+                key, value = line.split(":", 1)
+                counters[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get("rchar"), counters.get("wchar")
+
+
+def _metrics_destination(sidecar, name):
+    """Return where metrics should be written and whether to append."""
+    env = os.environ.get(METRICS_ENV)
+    sidecar_name = (
+        f"{METRICS_SIDECAR_PREFIX}{name}.{os.getpid()}{METRICS_SIDECAR_SUFFIX}")
+    if env:
+        if os.path.isdir(env):
+            return os.path.join(env, sidecar_name), False
+        return env, True
+    if sidecar:
+        return os.path.join(os.getcwd(), sidecar_name), False
+    return None, False
+
+
+@contextlib.contextmanager
+def metrics(name, argv=None, sidecar=False):
+    """Record the resource usage of the enclosed block.
+
+    Metrics are only recorded when requested, either with `sidecar` or by
+    setting `METRICS_ENV`. If that names a directory a sidecar is written
+    there, otherwise it is a file to which a JSON line is appended.
+
+    :param name: name of the entry point being measured.
+    :param argv: arguments of the entry point to include in the record.
+    :param sidecar: write a JSON sidecar into the working directory.
+    """
+    fname, append = _metrics_destination(sidecar, name)
+    if fname is None:
+        yield None
+        return
+    # deferred as this module is imported into all glue
+    import json
+    import resource
+    import time
+
+    def usage():
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (
+            own.ru_utime + children.ru_utime, own.ru_stime + children.ru_stime,
+            max(own.ru_maxrss, children.ru_maxrss))
+
+    _record_counts.clear()
+    start_time = time.time()
+    start_wall = time.perf_counter()
+    start_user, start_sys, _ = usage()
+    start_read, start_written = _io_counters()
+    status = 0
+    try:
+        yield fname
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else int(e.code is not None)
+        raise
+    except BaseException:
+        status = 1
+        raise
+    finally:
+        end_user, end_sys, maxrss = usage()
+        end_read, end_written = _io_counters()
+        record = {
+            "command": name,
+            "argv": argv,
+            "pid": os.getpid(),
+            "cwd": os.getcwd(),
+            "start_time": start_time,
+            "exit_status": status,
+            "wall_time": time.perf_counter() - start_wall,
+            "cpu_user": end_user - start_user,
+            "cpu_system": end_sys - start_sys,
+            # ru_maxrss is in kilobytes on Linux and bytes on macOS
+            "peak_rss": maxrss if sys.platform == "darwin" else maxrss * 1024,
+            "bytes_read": None if start_read is None else end_read - start_read,
+            "bytes_written": (
+                None if start_written is None else end_written - start_written),
+            "records": dict(_record_counts),
+        }
+        line = json.dumps(record) + "\n"
+        if append:
+            # a single write to a file opened for appending is not interleaved
+            # with those of other tasks sharing the file
+            fd = os.open(fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+        else:
+            with open(fname, "w") as fh:
+                fh.write(line)
@@ -0,0 +1,207 @@
+"""Run many workflow-glue subcommands in a single interpreter.
+
+Launching a container and a fresh interpreter for each call to a short
+helper (e.g. `check_xam_index`) can dominate the runtime of a workflow
+with thousands of samples. This entry point takes a list of jobs and runs
+them through the components' `main` functions in one process, on a pool
+of threads or forked worker processes.
+
+The job list is either a TSV with a header, or JSON lines (`.jsonl`,
+`.json`) with one object per job. Each job has the keys:
+
+  - `command`: the subcommand to run
+  - `args`: its arguments, as a list for JSON or split like a shell
+    command line for TSV
+  - `stdout`: the file that receives its standard output
+  - `id` (optional): a name for the job in the summary, defaults to the
+    row number
+
+A summary TSV records the exit status, wall time and CPU time of each job
+in the order of the job list.
+"""
+import contextlib
+import csv
+import json
+import multiprocessing
+import os
+import shlex
+import sys
+import threading
+import time
+import traceback
+
+from .. import get_components  # noqa: ABS101
+from ..util import exit_status, get_named_logger, wf_parser  # noqa: ABS101
+
+
+SUMMARY_FIELDS = ["id", "command", "stdout", "exit_status", "wall_time", "cpu_time"]
+# these manage the interpreter themselves so cannot be batched
+UNBATCHABLE = ("batch", "serve")
+
+# components used by the jobs, loaded before any workers are started
+_components = dict()
+
+
+class StdoutRouter:
+    """Route writes to `sys.stdout` to a file chosen by the current thread.
+
+    Helpers write their results straight to `sys.stdout`, which is shared
+    by every thread in the process. `contextlib.redirect_stdout` swaps the
+    global and so cannot be used by concurrent jobs.
+    """
+
+    def __init__(self, default):
+        """Initialise the router with the stream used outside of jobs."""
+        self.default = default
+        self._local = threading.local()
+
+    @property
+    def target(self):
+        """Return the stream for the current thread."""
+        return getattr(self._local, "target", None) or self.default
+
+    def write(self, data):
+        """Write to the current thread's stream."""
+        return self.target.write(data)
+
+    def flush(self):
+        """Flush the current thread's stream."""
+        return self.target.flush()
+
+    def __getattr__(self, name):
+        """Defer anything else to the current thread's stream."""
+        return getattr(self.target, name)
+
+    @contextlib.contextmanager
+    def redirect(self, fh):
+        """Send writes from the current thread to fh."""
+        self._local.target = fh
+        try:
+            yield fh
+        finally:
+            self._local.target = None
+
+
+def read_jobs(fname):
+    """Read a job list from a TSV or JSON lines file."""
+    jobs = []
+    if fname.endswith((".jsonl", ".json")):
+        with open(fname) as fh:
+            rows = [json.loads(line) for line in fh if line.strip()]
+    else:
+        with open(fname, newline="") as fh:
+            rows = list(csv.DictReader(fh, delimiter="\t"))
+        for row in rows:
+            row["args"] = shlex.split(row.get("args") or "")
+    for i, row in enumerate(rows):
+        for key in ("command", "stdout"):
+            if not row.get(key):
+                raise ValueError(f"Job {i} of '{fname}' has no '{key}'.")
+        if not isinstance(row.get("args", []), list):
+            raise ValueError(f"Job {i} of '{fname}' has 'args' that are not a list.")
+        if row["command"] in UNBATCHABLE:
+            raise ValueError(f"Job {i} of '{fname}' cannot run '{row['command']}'.")
+        jobs.append({
+            "id": str(row.get("id") or i),
+            "command": row["command"],
+            "args": [str(x) for x in row.get("args", [])],
+            "stdout": row["stdout"],
+        })
+    return jobs
+
+
+def run_job(job):
+    """Run a single job and return its summary record."""
+    logger = get_named_logger("batch")
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    status = 0
+    try:
+        module = _components[job["command"]]
+        with open(job["stdout"], "w") as out, sys.stdout.redirect(out):
+            module.main(module.argparser().parse_args(job["args"]))
+    except SystemExit as e:
+        status = exit_status(e.code)
+    except Exception:
+        logger.error(f"Job '{job['id']}' failed:\n{traceback.format_exc()}")
+        status = 1
+    return {
+        "id": job["id"],
+        "command": job["command"],
+        "stdout": job["stdout"],
+        "exit_status": status,
+        "wall_time": f"{time.perf_counter() - wall_start:.6f}",
+        "cpu_time": f"{time.thread_time() - cpu_start:.6f}",
+    }
+
+
+def run_jobs(jobs, threads=1, pool="thread"):
+    """Run jobs on a pool and return their summaries in job order."""
+    # deferred to avoid the import cost for the other entry points
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    commands = {job["command"] for job in jobs}
+    _components.update(get_components(allowed_components=commands))
+    missing = commands - set(_components)
+    if missing:
+        raise ValueError(f"Could not load subcommands: {', '.join(sorted(missing))}.")
+
+    if pool == "process":
+        executor = ProcessPoolExecutor(
+            max_workers=threads, mp_context=multiprocessing.get_context("fork"))
+    else:
+        executor = ThreadPoolExecutor(max_workers=threads)
+
+    sys.stdout.flush()
+    stdout = sys.stdout
+    sys.stdout = StdoutRouter(stdout)
+    try:
+        with executor:
+            return list(executor.map(run_job, jobs))
+    finally:
+        sys.stdout = stdout
+
+
+def main(args):
+    """Run the entry point."""
+    logger = get_named_logger("batch")
+
+    jobs = read_jobs(args.jobs)
+    logger.info(
+        f"Running {len(jobs)} jobs on {args.threads} {args.pool} workers.")
+    summaries = run_jobs(jobs, threads=args.threads, pool=args.pool)
+
+    with open(args.summary, "w", newline="") as fh:
+        writer = csv.DictWriter(
+            fh, fieldnames=SUMMARY_FIELDS, delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(summaries)
+
+    n_failed = sum(1 for s in summaries if s["exit_status"] != 0)
+    logger.info(f"Wrote summary of {len(jobs)} jobs to '{args.summary}'.")
+    if n_failed:
+        logger.error(f"{n_failed} of {len(jobs)} jobs failed.")
+        if not args.allow_failures:
+            sys.exit(1)
+
+
+def argparser():
+    """Argument parser for entrypoint."""
+    parser = wf_parser("batch")
+    parser.add_argument(
+        "jobs", help="TSV or JSON lines (.jsonl) file listing the jobs to run")
+    parser.add_argument(
+        "--summary", default="batch_summary.tsv",
+        help="Output TSV with the exit status and timing of each job")
+    parser.add_argument(
+        "--threads", type=int, default=os.cpu_count() or 1,
+        help="Number of jobs to run concurrently")
+    parser.add_argument(
+        "--pool", choices=["thread", "process"], default="thread",
+        help=(
+            "Run jobs on threads, or on forked processes for CPU bound "
+            "helpers that do not release the GIL"))
+    parser.add_argument(
+        "--allow-failures", action="store_true",
+        help="Exit successfully even if some jobs failed")
+    return parser
@@ -1,11 +1,79 @@
 """Check (u)BAM files for `@SQ` lines whether they are the same in all headers."""
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 from pathlib import Path
+import sqlite3
 import sys
 
-import pysam
+from .xam_header import read_header  # noqa: ABS101
+from .xam_header_cache import file_identity, HeaderCache  # noqa: ABS101
+from ..util import count_records, get_named_logger, wf_parser  # noqa: ABS101
 
-from ..util import get_named_logger, wf_parser  # noqa: ABS101
+
+def read_headers(xam_files, threads=1, read=None):
+    """Yield the headers of files in order, reading ahead on a pool of threads.
+
+    Opening a file can be slow on network filesystems, so up to twice as many
+    headers as threads are read ahead of the consumer. Files that have not
+    been read when the consumer stops are not read at all.
+
+    :param read: function to read the header of a file, defaults to
+        `xam_header.read_header`.
+    """
+    read = read or read_header
+    xam_files = iter(xam_files)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = collections.deque(
+            executor.submit(read, xam_file)
+            for xam_file in itertools.islice(xam_files, 2 * threads))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for xam_file in itertools.islice(xam_files, 1):
+                    pending.append(executor.submit(read, xam_file))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def check_headers(headers):
+    """Return whether headers are unaligned, mixed and sorted.
+
+    Headers are consumed until the first with `@SQ` lines that differ from
+    those of the first header.
+
+    :param headers: iterable of `xam_header.XamHeader`.
+    :return: tuple of (is_unaligned, mixed_headers, is_sorted).
+    """
+    first_sq_digest = None
+    mixed_headers = False
+    sorted_xam = False
+    header = None
+    for header in headers:
+        count_records("files")
+        # Check if it is sorted.
+        # When there is more than one BAM, merging/sorting
+        # will happen regardless of this flag.
+        if header.hd is not None and header.hd.get('SO') == 'coordinate':
+            sorted_xam = True
+        # `@SQ` lines are compared by a digest of their SN/LN/M5 elements
+        if first_sq_digest is None:
+            # this is the first file
+            first_sq_digest = header.sq_digest
+        else:
+            # this is a subsequent file; check with the first `@SQ` lines
+            if header.sq_digest != first_sq_digest:
+                mixed_headers = True
+                break
+    if header is None:
+        raise ValueError("No headers to check.")
+    # we set `is_unaligned` to `True` if there were no mixed headers and the last file
+    # didn't have `@SQ` lines (as we can then be sure that none of the files did)
+    is_unaligned = not mixed_headers and not header.n_sq
+    return is_unaligned, mixed_headers, sorted_xam
 
 
 def main(args):
@@ -18,42 +86,52 @@ def main(args):
     target_files = list(args.input_path.glob("*"))
     if not target_files:
         raise ValueError(f"No files found in input directory '{args.input_path}'.")
+    # Look up any headers we have already read in previous runs
+    cached = dict()
+    new = dict()
+    cache = None
+    if args.header_cache is not None:
+        try:
+            cache = HeaderCache(args.header_cache)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not open header cache: {e}")
+        else:
+            cached = cache.get_many(target_files)
+            logger.info(
+                f"Found {len(cached)} of {len(target_files)} headers in the cache.")
+
+    def read(xam_file):
+        header = cached.get(xam_file)
+        if header is not None:
+            return header
+        identity = None
+        if cache is not None:
+            # taken before reading, so a file changed meanwhile is read again
+            # by the next run rather than given this header
+            try:
+                identity = file_identity(xam_file)
+            except OSError as e:
+                logger.warning(f"Not caching the header of '{xam_file}': {e}")
+        header = read_header(xam_file)
+        if identity is not None:
+            new[identity] = header
+        return header
+
     # Loop over target files and check if there are `@SQ` lines in all headers or not.
     # Set `is_unaligned` accordingly. If there are mixed headers (either with some files
     # containing `@SQ` lines and some not or with different files containing different
     # `@SQ` lines), set `mixed_headers` to `True`.
     # Also check if there is the SO line, to validate whether the file is (un)sorted.
-    first_sq_lines = None
-    mixed_headers = False
-    sorted_xam = False
-    for xam_file in target_files:
-        # get the `@SQ` and `@HD` lines in the header
-        with pysam.AlignmentFile(xam_file, check_sq=False) as f:
-            # compare only the SN/LN/M5 elements of SQ to avoid labelling XAM with
-            # same reference but different SQ.UR as mixed_header (see CW-4842)
-            sq_lines = [{
-                "SN": sq["SN"],
-                "LN": sq["LN"],
-                "M5": sq.get("M5"),
-            } for sq in f.header.get("SQ", [])]
-            hd_lines = f.header.get("HD")
-        # Check if it is sorted.
-        # When there is more than one BAM, merging/sorting
-        # will happen regardless of this flag.
-        if hd_lines is not None and hd_lines.get('SO') == 'coordinate':
-            sorted_xam = True
-        if first_sq_lines is None:
-            # this is the first file
-            first_sq_lines = sq_lines
-        else:
-            # this is a subsequent file; check with the first `@SQ` lines
-            if sq_lines != first_sq_lines:
-                mixed_headers = True
-                break
+    # Headers are read concurrently but checked in the order of the files, so
+    # the result is the same as reading them one at a time; once a mismatch is
+    # found the remaining files are not read.
+    headers = read_headers(target_files, threads=args.threads, read=read)
+    is_unaligned, mixed_headers, sorted_xam = check_headers(headers)
+    headers.close()
+    if cache is not None:
+        cache.put_many(new)
+        cache.close()
 
-    # we set `is_unaligned` to `True` if there were no mixed headers and the last file
-    # didn't have `@SQ` lines (as we can then be sure that none of the files did)
-    is_unaligned = not mixed_headers and not sq_lines
     # write `is_unaligned` and `mixed_headers` out so that they can be set as env.
     # variables
     sys.stdout.write(
@@ -68,4 +146,13 @@ def argparser():
     """Argument parser for entrypoint."""
     parser = wf_parser("check_bam_headers_in_dir")
     parser.add_argument("input_path", type=Path, help="Path to target directory")
+    parser.add_argument(
+        "--threads", type=int, default=1,
+        help="Number of threads reading headers (reading is mostly I/O bound)")
+    parser.add_argument(
+        "--header-cache", type=Path,
+        help=(
+            "SQLite database of headers read in previous runs, keyed by file "
+            "identity, which is created if necessary and updated with any "
+            "headers that are read"))
     return parser
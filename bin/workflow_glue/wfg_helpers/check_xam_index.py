@@ -1,20 +1,55 @@
-"""Validate a single (u)BAM file index."""
+"""Validate (u)BAM file indexes.
 
+A single XAM is checked by default. With `--input-dir` or `--manifest` the
+indexes of many BAM are checked on a pool of threads and, with `--rebuild`,
+the invalid ones are regenerated in the same task. A TSV with the columns
+bam, index, status, rebuilt and reason is then written.
+"""
+
+import csv
+import os
 from pathlib import Path
 import sys
 
 import pysam
 
+from .xam_header import is_bam  # noqa: ABS101
+from .xam_index import check_index, check_indexes  # noqa: ABS101
 from ..util import get_named_logger, wf_parser  # noqa: ABS101
 
 
-def validate_xam_index(xam_file):
-    """Use fetch to validate the index.
+def validate_xam_index(xam_file, index=None, check_mtime=False, logger=None):
+    """Validate the index of a XAM.
+
+    The index of a BAM is checked by `xam_index.check_index`, which also
+    rejects an index left over from an earlier version of the BAM.
 
-    Invalid indexes will fail the call with a ValueError:
+    Other formats are opened with pysam and we use fetch to validate the
+    index. Invalid indexes will fail the call with a ValueError:
     ValueError: fetch called on bamfile without index
+
+    :param index: path of the index, if not one htslib would look for.
+    :param check_mtime: whether to reject a BAM index modified before the BAM.
+        This is off by default as copies of files, eg. from a git checkout or
+        object store, are not guaranteed to keep the order of their mtimes.
+    :param logger: logger to report why an index was rejected to.
     """
-    with pysam.AlignmentFile(xam_file, check_sq=False) as alignments:
+    if is_bam(xam_file):
+        result = check_index(xam_file, index, check_mtime=check_mtime)
+        if not result.valid and logger is not None:
+            logger.warning(f"Rejected index of '{xam_file}': {result.reason}")
+        return result.valid
+    if index is not None:
+        index = str(index)
+    try:
+        alignments = pysam.AlignmentFile(
+            xam_file, check_sq=False, index_filename=index)
+    except OSError:
+        # an index that is given is loaded, and can fail, on opening the file
+        if index is None:
+            raise
+        return False
+    with alignments:
         try:
             alignments.fetch()
             has_valid_index = True
@@ -23,12 +58,108 @@ def validate_xam_index(xam_file):
     return has_valid_index
 
 
+def read_bam_manifest(fname):
+    """Return (bam, index) tuples from a TSV, index is None if not given."""
+    with open(fname, newline="") as fh:
+        return [
+            (row["bam"], row.get("index") or None)
+            for row in csv.DictReader(fh, delimiter="\t")]
+
+
+def rebuild_index(xam_file, index=None, csi=False, threads=1):
+    """Index a BAM, replacing the index file atomically.
+
+    The index is written to a temporary file in the same directory and then
+    renamed, so readers of the index never see a partial file.
+
+    :param index: path of the index, defaults to `<xam_file>.bai` (or
+        `.csi`). The format follows its extension.
+    :return: path of the index.
+    """
+    if index is None:
+        index = f"{xam_file}.csi" if csi else f"{xam_file}.bai"
+    index = Path(index)
+    tmp_index = index.with_name(f".{index.name}.{os.getpid()}.tmp")
+    fmt = ["-c"] if index.suffix == ".csi" else ["-b"]
+    try:
+        pysam.index(*fmt, "-@", str(threads), str(xam_file), str(tmp_index))
+        os.replace(tmp_index, index)
+    finally:
+        if tmp_index.exists():
+            tmp_index.unlink()
+    return index
+
+
+def check_many(pairs, threads=1, rebuild=False, csi=False, check_mtime=False):
+    """Check and optionally rebuild the indexes of many BAM.
+
+    Indexes are checked concurrently, then the invalid ones are rebuilt one
+    at a time, each with all threads as indexing is CPU bound. An index that
+    cannot be rebuilt stays invalid, with the error as its reason.
+
+    :param pairs: list of (bam, index) tuples, where index may be None to use
+        the one htslib would.
+    :return: list of dicts with the keys bam, index, status, rebuilt and reason.
+    """
+    rows = []
+    for result in check_indexes(pairs, threads=threads, check_mtime=check_mtime):
+        rows.append({
+            "bam": result.xam_file,
+            "index": result.index,
+            "status": "valid" if result.valid else "invalid",
+            "rebuilt": 0,
+            "reason": result.reason,
+        })
+    if rebuild:
+        for row in rows:
+            if row["status"] != "invalid":
+                continue
+            # a BAM samtools cannot index, eg. an unsorted one, is reported
+            # rather than stopping the other rebuilds
+            try:
+                row["index"] = rebuild_index(
+                    row["bam"], row["index"], csi=csi, threads=threads)
+            except (pysam.SamtoolsError, OSError) as e:
+                row["reason"] = f"Rebuild failed: {e}"
+                continue
+            row["rebuilt"] = 1
+    return rows
+
+
 def main(args):
     """Run the entry point."""
     logger = get_named_logger("checkBamIdx")
 
+    batch_input = args.input_dir or args.manifest
+    if (args.input_xam is None) == (batch_input is None):
+        raise ValueError(
+            "Give either a XAM to check or one of --input-dir and --manifest.")
+    if args.input_xam is None:
+        if args.input_dir is not None:
+            pairs = [
+                (str(bam), None) for bam in sorted(args.input_dir.glob("*.bam"))]
+        else:
+            pairs = read_bam_manifest(args.manifest)
+        rows = check_many(
+            pairs, threads=args.threads, rebuild=args.rebuild, csi=args.csi,
+            check_mtime=args.check_mtime)
+        writer = csv.DictWriter(
+            sys.stdout, fieldnames=["bam", "index", "status", "rebuilt", "reason"],
+            delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+        for row in rows:
+            if row["status"] == "invalid":
+                logger.warning(f"Rejected index of '{row['bam']}': {row['reason']}")
+            writer.writerow(row)
+        n_rebuilt = sum(row["rebuilt"] for row in rows)
+        logger.info(f"Checked {len(rows)} (u)BAM indexes, rebuilt {n_rebuilt}.")
+        return
+    if args.rebuild:
+        raise ValueError("--rebuild is only available with --input-dir or --manifest.")
+
     # Check if a XAM has a valid index
-    has_valid_index = validate_xam_index(args.input_xam)
+    has_valid_index = validate_xam_index(
+        args.input_xam, check_mtime=args.check_mtime, logger=logger)
     # write `has_valid_index` out so that they can be set as env.
     sys.stdout.write(
         f"HAS_VALID_INDEX={int(has_valid_index)}"
@@ -39,5 +170,27 @@ def main(args):
 def argparser():
     """Argument parser for entrypoint."""
     parser = wf_parser("check_xam_index")
-    parser.add_argument("input_xam", type=Path, help="Path to target XAM")
+    parser.add_argument(
+        "input_xam", type=Path, nargs="?", help="Path to target XAM")
+    batch = parser.add_mutually_exclusive_group()
+    batch.add_argument(
+        "--input-dir", type=Path,
+        help="Check the indexes of all BAM (*.bam) in a directory")
+    batch.add_argument(
+        "--manifest", type=Path,
+        help=(
+            "Check the indexes of BAM listed in a TSV with the columns bam and, "
+            "optionally, index"))
+    parser.add_argument(
+        "--rebuild", action="store_true",
+        help="Rebuild invalid or missing indexes of --input-dir or --manifest")
+    parser.add_argument(
+        "--csi", action="store_true",
+        help="Rebuild missing indexes as CSI rather than BAI")
+    parser.add_argument(
+        "--threads", type=int, default=1,
+        help="Number of threads checking and rebuilding indexes")
+    parser.add_argument(
+        "--check-mtime", action="store_true",
+        help="Reject a BAM index that was modified before the BAM")
     return parser
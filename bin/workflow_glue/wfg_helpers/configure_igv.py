@@ -1,10 +1,27 @@
-"""Create an IGV config file."""
-
+"""Create an IGV config file.
+
+Tracks are written as they are built, rather than kept for a single
+`json.dump`, so the config of many samples is not held in memory. With
+`--shard-by-sample` a config is written for each sample, with a manifest,
+so that the report of a sample only loads its own tracks.
+
+With `--build-missing-indexes` the files without an index, including the
+reference, are indexed on a pool of processes, so that IGV can always
+fetch them by range. Plain interval files are bgzipped to be indexed.
+"""
+
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import itertools
 import json
+import os
 from pathlib import Path
+import re
 import sys
 
-from ..util import get_named_logger, wf_parser  # noqa: ABS101
+from .xam_header import BGZF_MAGIC  # noqa: ABS101
+from ..util import count_records, get_named_logger, wf_parser  # noqa: ABS101
 
 
 # Common variables
@@ -31,6 +48,9 @@ DATA_TYPES_LISTS = {
 DATA_TYPES = {
     ext: ftype for ftype, extlist in DATA_TYPES_LISTS.items() for ext in extlist
 }
+# Most dot separated parts in an extension. No extension is the part after a
+# dot of another, so a file name ends with at most one of them.
+MAX_EXTENSION_PARTS = max(ext.count(".") for ext in DATA_TYPES) + 1
 
 # Data by idx
 DATA_INDEXES_FMT = {
@@ -38,6 +58,30 @@ DATA_INDEXES_FMT = {
 }
 
 # Assign each format to its index
+# JSON separators of compact configs, as with indent=None
+COMPACT_SEPARATORS = (",", ":")
+SHARD_MANIFEST = "manifest.json"
+
+# Index built for each format by --build-missing-indexes, and the tabix
+# presets of the formats indexed by tabix
+BUILT_INDEXES = {
+    "bam": "bai",
+    "cram": "crai",
+    "vcf": "tbi",
+    "bcf": "csi",
+    "bed": "tbi",
+    "bedmethyl": "tbi",
+    "gff": "tbi",
+    "gtf": "tbi",
+}
+TABIX_PRESETS = {
+    "vcf": "vcf",
+    "bed": "bed",
+    "bedmethyl": "bed",
+    "gff": "gff",
+    "gtf": "gff",
+}
+
 INDEX_PAIRS = {
     "bam": ("bai",),
     "cram": ("crai",),
@@ -148,8 +192,69 @@ class TrackBuilder:
             samples.update({"NO_SAMPLE": tmp_samples["NO_SAMPLE"]})
         self.samples = samples
 
-    def build_igv_json(self):
-        """Ensure there is a reference genome."""
+    def build_missing_indexes(self, threads=1):
+        """Index the files without an index, and the reference, on processes.
+
+        An index that is next to a file but not in the list of file names is
+        used rather than built again. Files that cannot be indexed, eg. as
+        they are not sorted, keep a track without an index.
+
+        :param threads: number of processes building indexes.
+        :return: tuple of the number of indexes built and a list of the
+            (file, error) of those that failed.
+        """
+        # the bundles each file is in, as it may be in those of many samples
+        missing = collections.defaultdict(list)
+        ftypes = {}
+        for bundle in self.samples.values():
+            bundle.process_data()
+            for fname, index, ftype in bundle.data_bundles:
+                if index is not None or ftype not in BUILT_INDEXES:
+                    continue
+                index = existing_index(fname, INDEX_PAIRS[ftype])
+                if index is not None:
+                    bundle.append(index)
+                else:
+                    missing[fname].append(bundle)
+                    ftypes[fname] = ftype
+        build_ref = False
+        if self.ref:
+            if not self.fai:
+                self.fai = existing_index(self.ref, ["fai"])
+            if self.ref.endswith(".gz") and not self.gzi:
+                self.gzi = existing_index(self.ref, ["gzi"])
+            build_ref = not self.fai or (self.ref.endswith(".gz") and not self.gzi)
+
+        n_built = 0
+        failed = []
+        with ProcessPoolExecutor(max_workers=threads) as executor:
+            ref_future = None
+            if build_ref:
+                ref_future = executor.submit(build_ref_index, self.ref)
+            futures = {
+                fname: executor.submit(build_index, fname, ftype)
+                for fname, ftype in ftypes.items()}
+            for fname, future in futures.items():
+                try:
+                    new_fname, index = future.result()
+                except Exception as e:
+                    failed.append((fname, str(e)))
+                    continue
+                n_built += 1
+                for bundle in missing[fname]:
+                    bundle.replace(fname, new_fname)
+                    bundle.append(index)
+            if ref_future is not None:
+                try:
+                    self.fai, gzi = ref_future.result()
+                    self.gzi = gzi or self.gzi
+                    n_built += 1
+                except Exception as e:
+                    failed.append((self.ref, str(e)))
+        return n_built, failed
+
+    def build_reference(self):
+        """Ensure there is a reference genome and set it in the json."""
         if not self.ref:
             raise ValueError(
                 "No reference file (i.e. file ending in one of "
@@ -171,22 +276,39 @@ class TrackBuilder:
         if self.gzi:
             self.igv_json["reference"]["compressedIndexURL"] = self.gzi
 
+    def build_igv_json(self):
+        """Add the reference genome and tracks of all samples to the json."""
+        self.build_reference()
+        self.igv_json["tracks"].extend(self.iter_tracks())
+
+    def iter_tracks(self, samples=None):
+        """Yield the tracks of samples as they are built.
+
+        :param samples: names of the samples to build the tracks of, all of
+            them by default.
+        """
+        if samples is None:
+            samples = self.samples
+        # Merge lists of custom opts per sample once, rather than for each track
+        sample_opts = {}
+        for file_fmt, extra_opts in self.extra_opts_lookups.items():
+            if isinstance(extra_opts, list):
+                sample_opts[file_fmt] = {}
+                for e in extra_opts:
+                    sample_opts[file_fmt].update(e)
+
         # Add samples data now
-        for sample, bundle in self.samples.items():
+        for sample in samples:
+            bundle = self.samples[sample]
             bundle.process_data()
             # Add the bundled data to the tracks
             for fname, index, file_fmt in bundle.data_bundles:
                 # Check if there are custom opts per track
-                if sample != "NO_SAMPLE" and isinstance(
-                    self.extra_opts_lookups[file_fmt], list
-                ):
-                    sample_info = {}
-                    for e in self.extra_opts_lookups[file_fmt]:
-                        sample_info.update(e)
-                    extra_opts_lookups_track = sample_info[sample]
+                if sample != "NO_SAMPLE" and file_fmt in sample_opts:
+                    extra_opts_lookups_track = sample_opts[file_fmt][sample]
                 else:
                     extra_opts_lookups_track = self.extra_opts_lookups[file_fmt]
-                self.add_track(
+                yield self.make_track(
                     fname,
                     file_fmt,
                     sample_name=sample if sample != "NO_SAMPLE" else None,
@@ -195,7 +317,14 @@ class TrackBuilder:
                 )
 
     def add_track(self, infile, file_fmt, sample_name=None, index=None, extra_opts={}):
-        """Add a track to an IGV json.
+        """Add a track to an IGV json, see `make_track`."""
+        self.igv_json["tracks"].append(
+            self.make_track(infile, file_fmt, sample_name, index, extra_opts))
+
+    def make_track(
+        self, infile, file_fmt, sample_name=None, index=None, extra_opts={}
+    ):
+        """Make a track of an IGV json.
 
         This function takes an input file, an optional index file, its
         file format and additional extra options for the track.
@@ -221,12 +350,53 @@ class TrackBuilder:
         if index:
             track_dict["indexURL"] = index
         track_dict.update(extra_opts)
-        self.igv_json["tracks"] += [track_dict]
+        count_records("tracks")
+        return track_dict
 
     def add_locus(self, locus):
         """Add target locus to the json."""
         self.igv_json["locus"] = locus
 
+    def write(self, fh, compact=False):
+        """Write the json, building the tracks of all samples as it is written.
+
+        :return: number of tracks written.
+        """
+        return write_igv_json(
+            fh, self.igv_json["reference"], self.iter_tracks(),
+            locus=self.igv_json.get("locus"), compact=compact)
+
+    def write_shards(self, out_dir, compact=False):
+        """Write a json of each sample, and a manifest of them, to a directory.
+
+        Tracks of files without a sample are added to the json of every
+        sample, or written to their own json if there are no samples.
+
+        :return: the manifest, a list of dicts with the sample name, the file
+            name of its json and its number of tracks.
+        """
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        samples = [sample for sample in self.samples if sample != "NO_SAMPLE"]
+        shared_tracks = []
+        if not samples:
+            samples = list(self.samples)
+        elif "NO_SAMPLE" in self.samples:
+            shared_tracks = list(self.iter_tracks(["NO_SAMPLE"]))
+        manifest = []
+        used_names = {Path(SHARD_MANIFEST).stem}
+        for sample in samples:
+            fname = f"{shard_name(sample, used_names)}.json"
+            with open(out_dir / fname, "w") as fh:
+                n_tracks = write_igv_json(
+                    fh, self.igv_json["reference"],
+                    itertools.chain(self.iter_tracks([sample]), shared_tracks),
+                    locus=self.igv_json.get("locus"), compact=compact)
+            manifest.append({"sample": sample, "config": fname, "tracks": n_tracks})
+        with open(out_dir / SHARD_MANIFEST, "w") as fh:
+            json.dump(manifest, fh, indent=None if compact else 4)
+        return manifest
+
     def add_extra_opts(
         self,
         extra_alignment_opts=None,
@@ -251,6 +421,148 @@ class TrackBuilder:
                     self.extra_opts_lookups[ftype] = extra_interval_opts_json
 
 
+def shard_name(sample, used_names):
+    """Return a unique file name for the json of a sample, without extension."""
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", sample)
+    unique_name = name
+    i = 1
+    while unique_name in used_names:
+        unique_name = f"{name}_{i}"
+        i += 1
+    used_names.add(unique_name)
+    return unique_name
+
+
+def write_igv_json(fh, reference, tracks, locus=None, compact=False):
+    """Write an IGV json, writing tracks as they are given.
+
+    The output is that of `json.dump` of the whole json with an indent of 4,
+    or with compact separators and no indent.
+
+    :param fh: file to write to.
+    :param reference: dict of the reference genome.
+    :param tracks: iterable of track dicts.
+    :param locus: locus string or list of them, if any.
+    :param compact: whether to write without whitespace.
+    :return: number of tracks written.
+    """
+    if compact:
+        def dumps(obj, level):
+            return json.dumps(obj, separators=COMPACT_SEPARATORS)
+        newline = ""
+        key_separator = ":"
+    else:
+        def dumps(obj, level):
+            # nested values are indented relative to the line they start on
+            return json.dumps(obj, indent=4).replace("\n", "\n" + " " * 4 * level)
+        newline = "\n"
+        key_separator = ": "
+
+    def line(level):
+        return newline + (" " * 4 * level if newline else "")
+
+    fh.write(f'{{{line(1)}"reference"{key_separator}{dumps(reference, 1)},')
+    fh.write(f'{line(1)}"tracks"{key_separator}[')
+    n_tracks = 0
+    for track in tracks:
+        if n_tracks:
+            fh.write(",")
+        fh.write(f"{line(2)}{dumps(track, 2)}")
+        n_tracks += 1
+    fh.write(f"{line(1)}]" if n_tracks else "]")
+    if locus is not None:
+        fh.write(f',{line(1)}"locus"{key_separator}{dumps(locus, 1)}')
+    fh.write(f"{line(0)}}}")
+    return n_tracks
+
+
+def existing_index(fname, extensions):
+    """Return the first index of a file with one of the extensions, or None."""
+    for ext in extensions:
+        index = f"{fname}.{ext}"
+        if os.path.exists(index):
+            return index
+    return None
+
+
+@contextlib.contextmanager
+def atomic_output(fname):
+    """Give a temporary path to write to, which is moved to fname on success.
+
+    The temporary file is in the same directory, so readers of fname never
+    see a partial file.
+    """
+    path = Path(fname)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        yield str(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def is_bgzf(fname):
+    """Return whether a file is BGZF compressed."""
+    with open(fname, "rb") as fh:
+        return fh.read(len(BGZF_MAGIC)) == BGZF_MAGIC
+
+
+def build_index(fname, ftype):
+    """Index a file for IGV, bgzipping it first if it is a plain interval file.
+
+    :param fname: path of the file, the index is written next to it.
+    :param ftype: format of the file, one of BUILT_INDEXES.
+    :return: tuple of the path of the (bgzipped) file and of its index.
+    """
+    # deferred as pysam is only needed to build indexes
+    import pysam
+    import pysam.bcftools
+    bgzipped = None
+    if ftype in TABIX_PRESETS:
+        if not fname.endswith(".gz"):
+            bgzipped = f"{fname}.gz"
+            with atomic_output(bgzipped) as tmp_fname:
+                pysam.tabix_compress(fname, tmp_fname, force=True)
+        elif not is_bgzf(fname):
+            raise ValueError(f"'{fname}' is gzip rather than BGZF compressed.")
+    indexed = bgzipped or fname
+    index = f"{indexed}.{BUILT_INDEXES[ftype]}"
+    try:
+        with atomic_output(index) as tmp_index:
+            if ftype in TABIX_PRESETS:
+                pysam.tabix_index(
+                    indexed, preset=TABIX_PRESETS[ftype], index=tmp_index,
+                    keep_original=True, force=True)
+            elif ftype == "bcf":
+                pysam.bcftools.index("--csi", "-o", tmp_index, indexed)
+            else:
+                pysam.index(indexed, tmp_index)
+    except Exception:
+        # the track is of the original file if it cannot be indexed
+        if bgzipped is not None:
+            os.unlink(bgzipped)
+        raise
+    return indexed, index
+
+
+def build_ref_index(ref):
+    """Index a reference FASTA, which may be bgzipped.
+
+    :return: tuple of the paths of the FAI and, for a bgzipped FASTA, the GZI.
+    """
+    # deferred as pysam is only needed to build indexes
+    import pysam
+    fai = f"{ref}.fai"
+    gzi = f"{ref}.gzi" if ref.endswith(".gz") else None
+    with contextlib.ExitStack() as stack:
+        args = ["--fai-idx", stack.enter_context(atomic_output(fai))]
+        if gzi is not None:
+            args += ["--gzi-idx", stack.enter_context(atomic_output(gzi))]
+        pysam.faidx(ref, *args)
+    return fai, gzi
+
+
 class SampleBundle:
     """Sample data class.
 
@@ -269,6 +581,10 @@ class SampleBundle:
         """Add a new raw file to the bundle."""
         self.infiles.append(fname)
 
+    def replace(self, fname, new_fname):
+        """Replace a raw file of the bundle, eg. with its bgzipped copy."""
+        self.infiles = [new_fname if f == fname else f for f in self.infiles]
+
     def process_data(self):
         """Process input files."""
         fbasenames = [Path(fname).name for fname in self.infiles]
@@ -277,51 +593,42 @@ class SampleBundle:
 
     @staticmethod
     def classify_files(fname):
-        """Classify inputs."""
-        for extension, ftype in DATA_TYPES.items():
-            if fname.endswith(f".{extension}"):
+        """Classify inputs by the longest of their extensions in DATA_TYPES."""
+        parts = fname.rsplit(".", MAX_EXTENSION_PARTS)
+        for i in range(1, len(parts)):
+            ftype = DATA_TYPES.get(".".join(parts[i:]))
+            if ftype is not None:
                 return ftype
+        return None
 
     @staticmethod
     def pair_file_with_index(infiles, fbasenames, ftypes):
         """Clump files with their indexes."""
-        # Collect data by group type
-        groups = {ftype: {"basenames": [], "paths": []} for ftype in set(ftypes)}
-        # Group each file by its type and base name
+        # Group the paths of each file type, and map the base names of each
+        # type to the first path with that base name
+        paths = collections.defaultdict(list)
+        basename_paths = collections.defaultdict(dict)
         for ftype, fbasename, fname in zip(ftypes, fbasenames, infiles):
-            groups[ftype]["basenames"] += [fbasename]
-            groups[ftype]["paths"] += [fname]
+            paths[ftype].append((fbasename, fname))
+            basename_paths[ftype].setdefault(fbasename, fname)
 
         # Output bundles
         outputs = []
         # Start matching the variant files
         for ftype, itype in DATA_INDEXES_FMT.items():
             # Ignore file formats that are not present in the bundle.
-            if ftype not in groups:
+            if ftype not in paths:
                 continue
-            # Make pairs of files.
-            for fbasename, fpath in zip(
-                groups[ftype]["basenames"], groups[ftype]["paths"]
-            ):
-                #  Construct potential index file names based on basename of input files
-                idx_basenames = set(
-                    [f"{fbasename}.{idx}" for idx in INDEX_PAIRS[ftype]]
-                )
-                # Find which indexes are available
-                if itype in groups.keys():
-                    idx_basenames = list(
-                        idx_basenames.intersection(set(groups[itype]["basenames"]))
-                    )
-                    # Get the first index (if there are more than one,
-                    # it doesn't matter)
-                    bname = idx_basenames[0]
-                    idx_fn = groups[itype]["paths"][
-                        groups[itype]["basenames"].index(bname)
-                    ]
-                    outputs.append([fpath, idx_fn, ftype])
-                # Otherwise, return only the simple file.
-                else:
-                    outputs.append([fpath, None, ftype])
+            indexes = basename_paths.get(itype, {})
+            # Make pairs of files, using the first of the possible indexes of
+            # each that is present
+            for fbasename, fpath in paths[ftype]:
+                idx_fn = None
+                for idx in INDEX_PAIRS[ftype]:
+                    idx_fn = indexes.get(f"{fbasename}.{idx}")
+                    if idx_fn is not None:
+                        break
+                outputs.append([fpath, idx_fn, ftype])
         return outputs
 
 
@@ -342,15 +649,35 @@ def main(args):
     # Import files
     igv_builder.parse_fnames(args.fofn, args.keep_track_order)
 
+    if args.build_missing_indexes:
+        n_built, failed = igv_builder.build_missing_indexes(args.threads)
+        for fname, error in failed:
+            logger.warning(
+                f"Could not index '{fname}', IGV will read all of it: {error}")
+        logger.info(f"Built {n_built} missing indexes.")
+
     # initialise the IGV options dict with the reference options
-    igv_builder.build_igv_json()
+    igv_builder.build_reference()
 
     # Add locus information
     if args.locus is not None:
         igv_builder.add_locus(args.locus)
-
-    json.dump(igv_builder.igv_json, sys.stdout, indent=4)
-    logger.info("Printed IGV config JSON to STDOUT.")
+    elif args.loci is not None:
+        # IGV shows a list of loci side by side
+        with open(args.loci) as fh:
+            loci = json.load(fh)
+        igv_builder.add_locus([
+            locus["locus"] if isinstance(locus, dict) else locus for locus in loci])
+
+    # the tracks are built as the json is written
+    if args.shard_by_sample is not None:
+        manifest = igv_builder.write_shards(args.shard_by_sample, args.compact)
+        logger.info(
+            f"Wrote IGV config JSON of {len(manifest)} samples and a manifest to "
+            f"'{args.shard_by_sample}'.")
+    else:
+        igv_builder.write(sys.stdout, compact=args.compact)
+        logger.info("Printed IGV config JSON to STDOUT.")
 
 
 def argparser():
@@ -369,10 +696,18 @@ def argparser():
         action="store_true",
         help="Keep track order as provided in fofn",
     )
-    parser.add_argument(
+    locus = parser.add_mutually_exclusive_group()
+    locus.add_argument(
         "--locus",
         help="Locus string to set initial genomic coordinates to display in IGV",
     )
+    locus.add_argument(
+        "--loci",
+        help=(
+            "JSON list of loci to display side by side in IGV, as written by "
+            "`get_max_depth_locus --output-format json`"
+        ),
+    )
     parser.add_argument(
         "--extra-alignment-opts",
         help="JSON file with extra options for alignment tracks",
@@ -385,4 +720,31 @@ def argparser():
         "--extra_interval_opts",
         help="JSON file with extra options for interval tracks",
     )
+    parser.add_argument(
+        "--build-missing-indexes",
+        action="store_true",
+        help=(
+            "Index files without an index, and the reference, bgzipping plain "
+            "interval files first"
+        ),
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of processes building missing indexes",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Write JSON without indentation or whitespace",
+    )
+    parser.add_argument(
+        "--shard-by-sample",
+        type=Path,
+        help=(
+            "Directory to write an IGV config JSON for each sample to, with a "
+            f"{SHARD_MANIFEST} of them, rather than one to STDOUT"
+        ),
+    )
     return parser
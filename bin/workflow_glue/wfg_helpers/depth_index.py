@@ -0,0 +1,261 @@
+"""Binary index of a `mosdepth` regions BED for range-maximum depth queries.
+
+Asking for the deepest window in a region would otherwise mean parsing the
+whole BED again. The index stores, for each reference, the starts, ends
+and depths of its windows as flat arrays, and a sparse table over the
+deepest window of each block of `BLOCK_SIZE` windows, so that a query reads
+at most two partial blocks and two table entries. The file is memory-mapped
+when queried, so only the pages a query touches are read.
+
+Layout: an 8 byte magic and the little-endian uint64 offset of a JSON table
+of contents at the end of the file, then for each reference its arrays
+(uint32 starts and ends, float64 depths and uint32 sparse table levels),
+each aligned to 8 bytes.
+"""
+import array
+from bisect import bisect_left, bisect_right
+import itertools
+import json
+import mmap
+import os
+import struct
+import sys
+
+
+MAGIC = b"WFGRMQ1\n"
+VERSION = 1
+BLOCK_SIZE = 64
+# arrays are written in the byte order they are read in
+LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+def _sparse_table(depths, block_size=BLOCK_SIZE):
+    """Return the levels of a sparse table over the deepest window per block.
+
+    Level k holds, for each run of 2^k blocks, the index of the first window
+    with the largest depth in those blocks.
+    """
+    level = array.array("I")
+    for start in range(0, len(depths), block_size):
+        block = depths[start:start + block_size]
+        level.append(start + block.index(max(block)))
+    levels = [level]
+    n_blocks = len(level)
+    step = 1
+    while 2 * step <= n_blocks:
+        prev = levels[-1]
+        level = array.array("I", (
+            a if depths[a] >= depths[b] else b
+            for a, b in zip(prev, prev[step:])))
+        levels.append(level)
+        step *= 2
+    return levels
+
+
+class DepthIndexWriter:
+    """Write an index from the blocks of windows of a regions BED scan.
+
+    The file is written under a temporary name and renamed on `close`, so an
+    index is never seen half written.
+    """
+
+    def __init__(self, fname):
+        """Start writing an index."""
+        self.fname = fname
+        self.tmp_fname = f"{fname}.{os.getpid()}.tmp"
+        self.fh = open(self.tmp_fname, "wb")
+        self.fh.write(MAGIC + struct.pack("<Q", 0))
+        self.contigs = []
+        self.ref = None
+        self.all_int = True
+
+    def update(self, fields, depths, all_int):
+        """Add a block of windows, as a flat list of fields and depths."""
+        self.all_int = all_int
+        i = 0
+        for ref, windows in itertools.groupby(fields[0::4]):
+            n_windows = len(list(windows))
+            if ref != self.ref:
+                self._write_contig()
+                name = ref.decode()
+                if any(contig["name"] == name for contig in self.contigs):
+                    raise ValueError(
+                        f"Windows of reference '{name}' are not together in the BED.")
+                self.ref = ref
+                self.starts = array.array("I")
+                self.ends = array.array("I")
+                self.depths = array.array("d")
+            j = 4 * i
+            k = 4 * (i + n_windows)
+            self.starts.extend(map(int, fields[j + 1:k:4]))
+            self.ends.extend(map(int, fields[j + 2:k:4]))
+            self.depths.extend(depths[i:i + n_windows])
+            i += n_windows
+
+    def _write_array(self, values):
+        """Write an array aligned to 8 bytes, returning its offset."""
+        offset = self.fh.tell()
+        if not LITTLE_ENDIAN:
+            values = array.array(values.typecode, values)
+            values.byteswap()
+        values.tofile(self.fh)
+        self.fh.write(b"\0" * (-self.fh.tell() % 8))
+        return offset
+
+    def _write_contig(self):
+        """Write the arrays of the current reference."""
+        if self.ref is None:
+            return
+        self.contigs.append({
+            "name": self.ref.decode(),
+            "n_windows": len(self.depths),
+            "starts": self._write_array(self.starts),
+            "ends": self._write_array(self.ends),
+            "depths": self._write_array(self.depths),
+            "levels": [
+                [self._write_array(level), len(level)]
+                for level in _sparse_table(self.depths)],
+        })
+        self.ref = None
+
+    def close(self):
+        """Write the table of contents and move the index into place."""
+        self._write_contig()
+        toc_offset = self.fh.tell()
+        self.fh.write(json.dumps({
+            "version": VERSION,
+            "block_size": BLOCK_SIZE,
+            "all_int": self.all_int,
+            "contigs": self.contigs,
+        }).encode())
+        self.fh.seek(len(MAGIC))
+        self.fh.write(struct.pack("<Q", toc_offset))
+        self.fh.close()
+        os.replace(self.tmp_fname, self.fname)
+
+    def abort(self):
+        """Stop writing, removing the partial index."""
+        self.fh.close()
+        os.unlink(self.tmp_fname)
+
+    def __enter__(self):
+        """Enter the context manager."""
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        """Finish the index, or remove it if writing failed."""
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def is_depth_index(fname):
+    """Return whether a file is a depth index."""
+    with open(fname, "rb") as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+class DepthIndex:
+    """Answer range-maximum depth queries from a memory-mapped index."""
+
+    def __init__(self, fname):
+        """Map an index and read its table of contents."""
+        with open(fname, "rb") as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"'{fname}' is not a depth index.")
+            self.mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        (toc_offset,) = struct.unpack_from("<Q", self.mmap, len(MAGIC))
+        toc = json.loads(self.mmap[toc_offset:])
+        if toc["version"] != VERSION or not LITTLE_ENDIAN:
+            raise ValueError(f"Cannot read depth index '{fname}'.")
+        self.block_size = toc["block_size"]
+        self.all_int = toc["all_int"]
+        self.view = memoryview(self.mmap)
+        self.contigs = dict()
+        for contig in toc["contigs"]:
+            n = contig["n_windows"]
+            self.contigs[contig["name"]] = (
+                self._array(contig["starts"], n, "I"),
+                self._array(contig["ends"], n, "I"),
+                self._array(contig["depths"], n, "d"),
+                [self._array(offset, size, "I") for offset, size in contig["levels"]],
+            )
+
+    def _array(self, offset, n, typecode):
+        """Return a view of an array in the index."""
+        size = n * struct.calcsize(typecode)
+        return self.view[offset:offset + size].cast(typecode)
+
+    def ref_length(self, ref):
+        """Return the end of the last window of a reference."""
+        return self.contigs[ref][1][-1]
+
+    def _deepest(self, ref, lo, hi):
+        """Return the index of the first deepest window of lo to hi."""
+        _, _, depths, levels = self.contigs[ref]
+        best = None
+
+        def consider(i):
+            nonlocal best
+            if best is None or depths[i] > depths[best]:
+                best = i
+
+        def scan(a, b):
+            window = depths[a:b].tolist()
+            consider(a + window.index(max(window)))
+
+        first_block = -(-lo // self.block_size)
+        last_block = hi // self.block_size
+        if first_block >= last_block:
+            scan(lo, hi)
+            return best
+        if lo < first_block * self.block_size:
+            scan(lo, first_block * self.block_size)
+        # the whole blocks, from two (overlapping) runs in the sparse table
+        k = (last_block - first_block).bit_length() - 1
+        consider(levels[k][first_block])
+        consider(levels[k][last_block - (1 << k)])
+        if last_block * self.block_size < hi:
+            scan(last_block * self.block_size, hi)
+        return best
+
+    def query(self, ref, start=0, end=None):
+        """Return the first deepest window overlapping a 0-based region.
+
+        :return: tuple of (ref, start, end, depth), or None if no window
+            overlaps the region.
+        """
+        if ref not in self.contigs:
+            raise ValueError(f"Reference '{ref}' is not in the depth index.")
+        starts, ends, depths, _ = self.contigs[ref]
+        lo = bisect_right(ends, start)
+        hi = len(starts) if end is None else bisect_left(starts, end)
+        if lo >= hi:
+            return None
+        i = self._deepest(ref, lo, hi)
+        depth = int(depths[i]) if self.all_int else depths[i]
+        return ref, starts[i], ends[i], depth
+
+    def deepest(self):
+        """Return the first deepest window of all references."""
+        best = None
+        for ref in self.contigs:
+            window = self.query(ref)
+            if window is not None and (best is None or window[3] > best[3]):
+                best = window
+        return best
+
+    def close(self):
+        """Unmap the index."""
+        self.contigs = None
+        self.view.release()
+        self.mmap.close()
+
+    def __enter__(self):
+        """Enter the context manager."""
+        return self
+
+    def __exit__(self, *exc):
+        """Unmap the index on leaving the context manager."""
+        self.close()
@@ -1,45 +1,429 @@
-"""Find max depth window in a `mosdepth` regions BED file and write as locus string."""
+"""Find max depth window in a `mosdepth` regions BED file and write as locus string.
 
+With `--top N` (and/or `--per-contig`) the N best loci, overall or of each
+reference, are written instead. Windows with the largest depths are kept
+in a bounded heap during the scan, then picked in order of depth: each
+window adjacent to a region picked before it is merged into that region,
+as long as the region stays within the locus size, and each new region is
+at least `--min-separation` from the others.
+
+With `--build-index PATH` a depth index (see `depth_index`) is written
+during the scan. Given such an index in place of the BED, the deepest
+window of the genome, or of `--region chr:start-end`, is found without
+reading the BED again.
+
+Given a BAM instead, the locus is estimated from its BAI or CSI alone: the
+densest window is the one whose reads span the most compressed bytes (see
+`xam_index.index_density`). This needs no mosdepth run, and with
+`--refine` only the reads of that window are read to find its deepest base.
+"""
+
+import collections
+import contextlib
+import gzip
+import heapq
+import itertools
+import json
+import math
 from pathlib import Path
 import sys
 
-import pandas as pd
+from .depth_index import (  # noqa: ABS101
+    DepthIndex, DepthIndexWriter, is_depth_index)
+from .xam_header import is_bam, read_references  # noqa: ABS101
+from .xam_index import find_index, index_density  # noqa: ABS101
+from ..util import count_records, get_named_logger, wf_parser  # noqa: ABS101
 
-from ..util import get_named_logger, wf_parser  # noqa: ABS101
 
+GZIP_MAGIC = b"\x1f\x8b"
+# reads not counted by mosdepth by default: unmapped, secondary, QC fail and
+# duplicate
+EXCLUDE_FLAGS = 1796
+# Size of reads of the BED, large enough for the scan to be I/O bound
+READ_SIZE = 1024 * 1024
 
-def main(args):
-    """Run the entry point."""
-    logger = get_named_logger("getMaxDepth")
 
-    # read the regions BED file
-    df = pd.read_csv(
-        args.depths_bed, sep="\t", header=None, names=["ref", "start", "end", "depth"]
-    )
+def open_bed(fname):
+    """Open a BED, which may be gzip or BGZF compressed, for reading bytes."""
+    with open(fname, "rb") as fh:
+        magic = fh.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(fname, "rb")
+    return open(fname, "rb")
 
-    # get the window with the largest depth
-    ref, start, end, depth = df.loc[df["depth"].idxmax()]
 
-    # get the length of the reference of that window
-    ref_length = df.query("ref == @ref")["end"].iloc[-1]
+def iter_chunks(fh, size=READ_SIZE):
+    """Yield blocks of whole lines from a file of bytes."""
+    rest = b""
+    while True:
+        data = fh.read(size)
+        if not data:
+            if rest:
+                # the last line has no newline
+                yield rest + b"\n"
+            return
+        data = rest + data
+        cut = data.rfind(b"\n") + 1
+        rest = data[cut:]
+        if cut:
+            yield data[:cut]
+
+
+# A run of adjacent windows and the largest depth in it
+Region = collections.namedtuple("Region", ["ref", "start", "end", "depth"])
+
+
+class TopWindows:
+    """Keep the windows with the largest depths as candidates for loci.
+
+    A picked region takes in the windows adjacent to it, up to the locus
+    size, and excludes those within `min_separation` of it, so each region
+    uses up at most `ceil(2 * (min_separation + locus_size) / window) + 3`
+    of the windows in order of depth. We keep that many windows per region,
+    so N regions can be picked if the BED has them, even when the deepest
+    windows form long runs.
+    """
+
+    def __init__(self, n, locus_size, min_separation, per_contig=False):
+        """Initialise the heaps, sized on seeing the first window."""
+        self.n = n
+        self.locus_size = locus_size
+        self.min_separation = min_separation
+        self.per_contig = per_contig
+        self.capacity = None
+        # heaps of (depth, -order, ref, start, end), by ref if per_contig
+        self.heaps = collections.defaultdict(list)
+        self.n_seen = 0
+        self.all_int = True
+
+    def _set_capacity(self, fields):
+        """Size the heaps for the window size of the BED."""
+        window = max(1, int(fields[2]) - int(fields[1]))
+        excluded = math.ceil(2 * (self.min_separation + self.locus_size) / window)
+        self.capacity = self.n * (excluded + 3)
+
+    def update(self, fields, depths, all_int):
+        """Consider a block of windows, as a flat list of fields and depths."""
+        if self.capacity is None:
+            self._set_capacity(fields)
+        self.all_int = all_int
+        offset = self.n_seen
+        self.n_seen += len(depths)
+        if not self.per_contig:
+            self._update(self.heaps[None], fields, depths, offset)
+            return
+        # the windows of each reference go to its own heap
+        i = 0
+        for ref, windows in itertools.groupby(fields[0::4]):
+            n_windows = len(list(windows))
+            self._update(
+                self.heaps[ref], fields[4 * i:4 * (i + n_windows)],
+                depths[i:i + n_windows], offset + i)
+            i += n_windows
+
+    def _update(self, heap, fields, depths, offset):
+        """Push the windows of a block that could be kept onto a heap."""
+        # Only windows deeper than the smallest kept can be kept, which we
+        # filter for without a Python loop over the whole block.
+        keep = float("-inf").__lt__
+        if len(heap) == self.capacity:
+            keep = heap[0][0].__lt__
+        elif len(depths) > self.capacity:
+            # no more windows of the block than fit in the heap can be kept
+            keep = sorted(depths)[-self.capacity].__le__
+        for i in itertools.compress(range(len(depths)), map(keep, depths)):
+            j = 4 * i
+            item = (depths[i], -(offset + i), fields[j], fields[j + 1], fields[j + 2])
+            if len(heap) < self.capacity:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
 
+    def regions(self):
+        """Return the picked regions, in order of depth within each heap."""
+        picked = []
+        for heap in self.heaps.values():
+            picked.extend(pick_regions(
+                heap, self.n, self.min_separation, self.locus_size))
+        return picked
+
+
+def pick_regions(windows, n, min_separation, max_size=math.inf):
+    """Pick up to n regions from (depth, -order, ref, start, end) windows.
+
+    Windows are considered in order of depth (then of position in the BED).
+    A window adjacent to a region picked before it is merged into that
+    region unless the region would be longer than max_size, one within
+    min_separation of a region (or adjacent to a full one) is dropped, and
+    any other starts a new region, until n regions have been picked.
+    """
+    picked = []
+    for depth, _, ref, start, end in sorted(windows, reverse=True):
+        if len(picked) == n:
+            break
+        ref, start, end = ref.decode(), int(start), int(end)
+        gaps = [
+            (max(start - region.end, region.start - end), i)
+            for i, region in enumerate(picked) if region.ref == ref]
+        gap, i = min(gaps, default=(math.inf, None))
+        if gap <= 0:
+            region = picked[i]
+            start, end = min(start, region.start), max(end, region.end)
+            if end - start <= max_size:
+                picked[i] = region._replace(start=start, end=end)
+        elif gap >= min_separation:
+            picked.append(Region(ref, start, end, depth))
+    return picked
+
+
+def scan_windows(chunks, consumers=()):
+    """Find the window with the largest depth in a single pass.
+
+    Only the running maximum and the last end of each reference are kept, so
+    memory does not grow with the number of windows. Each block of lines is
+    split into a flat list of fields, so that finding the maximum and the
+    last ends is done by builtins over slices of the list rather than a
+    Python loop over lines.
+
+    :param chunks: blocks of whole lines of a `mosdepth` regions BED, as bytes.
+    :param consumers: objects with an `update(fields, depths, all_int)`
+        method to also give each block to, eg. `TopWindows`.
+    :return: tuple of the (ref, start, end, depth) of the first window with
+        the largest depth, and a dict of the last end of each reference.
+    """
+    best = None
+    best_depth = float("-inf")
+    # as when the BED was read with pandas, depths are written as integers
+    # if all of them are, otherwise as floats
+    all_int = True
+    last_end = dict()
+    n_windows = 0
+    for chunk in chunks:
+        fields = chunk.replace(b"\r", b"").replace(b"\n", b"\t").split(b"\t")
+        # the empty field after the last newline
+        fields.pop()
+        n_rows = chunk.count(b"\n")
+        if len(fields) != 4 * n_rows:
+            raise ValueError("Regions BED must have four columns.")
+        n_windows += n_rows
+        raw_depths = fields[3::4]
+        depths = list(map(float, raw_depths))
+        max_depth = max(depths)
+        if max_depth > best_depth:
+            best_depth = max_depth
+            i = 4 * depths.index(max_depth)
+            best = fields[i:i + 4]
+        if all_int and not all(map(bytes.isdigit, raw_depths)):
+            all_int = False
+        for consumer in consumers:
+            consumer.update(fields, depths, all_int)
+        if fields[0] == fields[-4]:
+            # mosdepth writes the windows of each reference together, so most
+            # blocks are within a single reference
+            last_end[fields[0]] = fields[-2]
+        else:
+            last_end.update(zip(fields[0::4], fields[2::4]))
+    count_records("windows", n_windows)
+    if best is None:
+        raise ValueError("No windows with a depth found.")
+    ref, start, end, depth = best
+    depth = int(depth) if all_int else float(depth)
+    last_end = {r.decode(): int(e) for r, e in last_end.items()}
+    return (ref.decode(), int(start), int(end), depth), last_end
+
+
+def locus_around(start, end, ref_length, locus_size):
+    """Return the (start, end) of a locus of locus_size around a window."""
     # show the whole reference in case it's shorter than the desired locus size
-    if ref_length < args.locus_size:
+    if ref_length < locus_size:
         start = 1
         end = ref_length
     else:
         # otherwise, show a region of the desired size around the window
-        half_size = args.locus_size // 2
+        half_size = locus_size // 2
         mid = (start + end) // 2
         start = mid - half_size
         end = mid + half_size
         # check if the region starts below `1` or ends beyond the end of the reference
         if start < 1:
             start = 1
-            end = args.locus_size
+            end = locus_size
         if end > ref_length:
-            start = ref_length - args.locus_size
+            start = ref_length - locus_size
             end = ref_length
+    return start, end
+
+
+def parse_region(region):
+    """Return the (ref, start, end) of a 1-based region as 0-based half-open.
+
+    A region without a range, or whose range cannot be parsed (as reference
+    names may contain ':'), is the whole reference and has an end of None.
+    """
+    ref, _, interval = region.rpartition(":")
+    try:
+        start, end = interval.replace(",", "").split("-")
+        start, end = int(start), int(end)
+    except ValueError:
+        return region, 0, None
+    if not ref or start < 1 or end < start:
+        raise ValueError(f"Invalid region '{region}'.")
+    return ref, start - 1, end
+
+
+def query_index(fname, region, locus_size):
+    """Return the depth and locus of the deepest window of a depth index."""
+    with DepthIndex(fname) as index:
+        if region is None:
+            window = index.deepest()
+        else:
+            window = index.query(*parse_region(region))
+        if window is None:
+            raise ValueError(f"No windows with a depth found in '{region}'.")
+        ref, start, end, depth = window
+        start, end = locus_around(start, end, index.ref_length(ref), locus_size)
+    return depth, f"{ref}:{start}-{end}"
+
+
+def densest_window(xam_file, index=None):
+    """Return the (ref, start, end, compressed bytes) of the densest window.
+
+    :param index: path of the BAI or CSI, defaults to the one htslib would use.
+    :return: tuple of the window and a dict of the length of each reference.
+    """
+    if index is None:
+        index = find_index(xam_file)
+        if index is None:
+            raise ValueError(f"No index found for '{xam_file}'.")
+    with open(index, "rb") as fh:
+        window_size, densities = index_density(fh.read())
+    references = read_references(xam_file)
+    if len(references) != len(densities):
+        raise ValueError(
+            f"Index has {len(densities)} references but the BAM has "
+            f"{len(references)}.")
+    best = None
+    for (ref, length), density in zip(references, densities):
+        # the bins of a CSI may cover windows beyond the end of the reference
+        density = density[:-(-length // window_size)]
+        if density and (best is None or max(density) > best[3]):
+            i = density.index(max(density))
+            end = min((i + 1) * window_size, length)
+            best = (ref, i * window_size, end, density[i])
+    if best is None:
+        raise ValueError(f"The index of '{xam_file}' has no reads.")
+    return best, dict(references)
+
+
+def refine_window(xam_file, ref, start, end, index=None):
+    """Return the (position, depth) of the first deepest base of a window.
+
+    Only the reads overlapping the window are read, and they are counted as
+    by mosdepth: without `EXCLUDE_FLAGS` and only over their aligned blocks.
+    """
+    # deferred as pysam is only needed to refine a locus
+    import pysam
+    if index is not None:
+        index = str(index)
+    # depths as differences from the previous base
+    changes = [0] * (end - start + 1)
+    with pysam.AlignmentFile(xam_file, index_filename=index) as bam:
+        for read in bam.fetch(ref, start, end):
+            if read.flag & EXCLUDE_FLAGS:
+                continue
+            for block_start, block_end in read.get_blocks():
+                block_start = max(block_start, start) - start
+                block_end = min(block_end, end) - start
+                if block_start < block_end:
+                    changes[block_start] += 1
+                    changes[block_end] -= 1
+    depths = list(itertools.accumulate(changes[:-1]))
+    depth = max(depths)
+    return start + depths.index(depth), depth
+
+
+def main(args):
+    """Run the entry point."""
+    logger = get_named_logger("getMaxDepth")
+
+    bed_only = args.top is not None or args.per_contig or args.build_index
+    if is_bam(args.depths_bed):
+        if bed_only or args.region is not None:
+            raise ValueError(
+                "--top, --per-contig, --build-index and --region need a regions "
+                "BED or depth index.")
+        (ref, start, end, _), ref_lengths = densest_window(
+            args.depths_bed, args.xam_index)
+        # the depth is not known without reading the window
+        depth = "NA"
+        if args.refine:
+            start, depth = refine_window(
+                args.depths_bed, ref, start, end, args.xam_index)
+            end = start + 1
+        start, end = locus_around(start, end, ref_lengths[ref], args.locus_size)
+        sys.stdout.write(f"{depth}\t{ref}:{start}-{end}")
+        logger.info("Wrote locus estimated from the BAM index to STDOUT.")
+        return
+    if args.refine or args.xam_index is not None:
+        raise ValueError("--refine and --xam-index need a BAM.")
+    if is_depth_index(args.depths_bed):
+        if bed_only:
+            raise ValueError(
+                "--top, --per-contig and --build-index need a regions BED.")
+        depth, locus = query_index(args.depths_bed, args.region, args.locus_size)
+        sys.stdout.write(f"{depth}\t{locus}")
+        logger.info("Wrote locus with maximum depth from the index to STDOUT.")
+        return
+    if args.region is not None:
+        raise ValueError("--region needs a depth index, see --build-index.")
+
+    if args.top is not None and args.top < 1:
+        raise ValueError("--top must be at least 1.")
+    top = None
+    if args.top is not None or args.per_contig:
+        min_separation = args.min_separation
+        if min_separation is None:
+            min_separation = args.locus_size
+        top = TopWindows(
+            args.top or 1, args.locus_size, min_separation,
+            per_contig=args.per_contig)
+
+    # scan the regions BED file for the window with the largest depth
+    consumers = [] if top is None else [top]
+    with contextlib.ExitStack() as stack:
+        if args.build_index is not None:
+            consumers.append(
+                stack.enter_context(DepthIndexWriter(args.build_index)))
+        fh = stack.enter_context(open_bed(args.depths_bed))
+        (ref, start, end, depth), last_end = scan_windows(
+            iter_chunks(fh), consumers=consumers)
+    if args.build_index is not None:
+        logger.info(f"Wrote depth index to '{args.build_index}'.")
+
+    if top is not None:
+        loci = []
+        for region in top.regions():
+            locus_start, locus_end = locus_around(
+                region.start, region.end, last_end[region.ref], args.locus_size)
+            depth = region.depth
+            loci.append({
+                "ref": region.ref,
+                "start": region.start,
+                "end": region.end,
+                "depth": int(depth) if top.all_int else depth,
+                "locus": f"{region.ref}:{locus_start}-{locus_end}",
+            })
+        if args.output_format == "json":
+            json.dump(loci, sys.stdout, indent=4)
+        else:
+            for locus in loci:
+                sys.stdout.write(f"{locus['depth']}\t{locus['locus']}\n")
+        logger.info(f"Wrote {len(loci)} loci with the largest depths to STDOUT.")
+        return
+
+    # get the length of the reference of that window
+    ref_length = last_end[ref]
+    start, end = locus_around(start, end, ref_length, args.locus_size)
 
     # write depth and locus string
     sys.stdout.write(f"{depth}\t{ref}:{start}-{end}")
@@ -53,9 +437,64 @@ def argparser():
     parser.add_argument(
         "depths_bed",
         type=Path,
-        help="path to mosdepth regions depth file (can be compressed)",
+        help=(
+            "path to mosdepth regions depth file (can be compressed), to a "
+            "depth index written with --build-index, or to an indexed BAM to "
+            "estimate the locus from its index"
+        ),
     )
     parser.add_argument(
         "locus_size", type=int, help="size of the locus in basepairs (e.g. '2000')"
     )
+    parser.add_argument(
+        "--top", type=int,
+        help="write the N loci with the largest depths, one per line",
+    )
+    parser.add_argument(
+        "--per-contig",
+        action="store_true",
+        help="write the top loci (by default one) of each reference",
+    )
+    parser.add_argument(
+        "--min-separation",
+        type=int,
+        help=(
+            "minimum distance in basepairs between the windows of the top loci "
+            "(defaults to the locus size)"
+        ),
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=["tsv", "json"],
+        default="tsv",
+        help=(
+            "format of the top loci: lines of depth and locus, or a JSON list "
+            "as read by `configure_igv --loci`"
+        ),
+    )
+    parser.add_argument(
+        "--build-index",
+        type=Path,
+        help="also write a depth index of the regions BED to this path",
+    )
+    parser.add_argument(
+        "--region",
+        help=(
+            "find the deepest window overlapping a region ('chr:start-end', "
+            "1-based, or 'chr'), only with a depth index"
+        ),
+    )
+    parser.add_argument(
+        "--xam-index",
+        type=Path,
+        help="BAI or CSI of a BAM given as input, if not next to the BAM",
+    )
+    parser.add_argument(
+        "--refine",
+        action="store_true",
+        help=(
+            "read the reads of the densest window of a BAM to centre the locus "
+            "on its deepest base and write its depth, rather than 'NA'"
+        ),
+    )
     return parser
@@ -0,0 +1,127 @@
+"""Summarise workflow-glue task metrics into per-subcommand percentiles.
+
+Metrics are written by any subcommand run with `--metrics`, or with
+`WORKFLOW_GLUE_METRICS` set (see `util.metrics`). This collects the JSON
+sidecars found under the given directories (e.g. a Nextflow work
+directory) and any JSON lines metrics files given directly, and writes a
+TSV with the distribution of each metric for each subcommand.
+"""
+import collections
+import csv
+import json
+import os
+import sys
+
+from ..util import (  # noqa: ABS101
+    count_records, get_named_logger, METRICS_SIDECAR_PREFIX,
+    METRICS_SIDECAR_SUFFIX, wf_parser)
+
+
+METRICS = [
+    "wall_time", "cpu_time", "cpu_user", "cpu_system", "peak_rss",
+    "bytes_read", "bytes_written"]
+PERCENTILES = [50, 90, 99]
+FIELDS = (
+    ["command", "metric", "n", "total", "mean", "min"]
+    + [f"p{p}" for p in PERCENTILES] + ["max"])
+
+
+def find_metrics_files(paths):
+    """Yield metrics files, searching any directories for sidecars."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, _, files in os.walk(path):
+            for fname in files:
+                if (
+                    fname.startswith(METRICS_SIDECAR_PREFIX)
+                    and fname.endswith(METRICS_SIDECAR_SUFFIX)
+                ):
+                    yield os.path.join(root, fname)
+
+
+def read_records(fname):
+    """Read the metrics records from a sidecar or JSON lines file."""
+    with open(fname) as fh:
+        for line in fh:
+            if line.strip():
+                yield json.loads(line)
+
+
+def percentile(values, q):
+    """Return the q-th percentile of sorted values, interpolating linearly."""
+    if not values:
+        return None
+    pos = (len(values) - 1) * q / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+
+def summarise(records):
+    """Compute the distribution of each metric for each subcommand."""
+    values = collections.defaultdict(lambda: collections.defaultdict(list))
+    for record in records:
+        metrics = {key: record.get(key) for key in METRICS}
+        if record.get("cpu_user") is not None:
+            metrics["cpu_time"] = record["cpu_user"] + record.get("cpu_system", 0)
+        for key, count in record.get("records", {}).items():
+            metrics[f"records.{key}"] = count
+        for key, value in metrics.items():
+            if value is not None:
+                values[record["command"]][key].append(value)
+
+    rows = []
+    for command in sorted(values):
+        # keep the standard metrics first, then record counts by name
+        keys = [k for k in METRICS if k in values[command]] + sorted(
+            k for k in values[command] if k not in METRICS)
+        for key in keys:
+            vals = sorted(values[command][key])
+            total = sum(vals)
+            row = {
+                "command": command,
+                "metric": key,
+                "n": len(vals),
+                "total": total,
+                "mean": total / len(vals),
+                "min": vals[0],
+                "max": vals[-1],
+            }
+            for p in PERCENTILES:
+                row[f"p{p}"] = percentile(vals, p)
+            rows.append(row)
+    return rows
+
+
+def main(args):
+    """Run the entry point."""
+    logger = get_named_logger("metricsSum")
+
+    records = []
+    n_files = 0
+    for fname in find_metrics_files(args.paths):
+        n_files += 1
+        records.extend(read_records(fname))
+    count_records("metrics", len(records))
+    logger.info(f"Read {len(records)} metrics records from {n_files} files.")
+
+    writer = csv.DictWriter(
+        sys.stdout, fieldnames=FIELDS, delimiter="\t", lineterminator="\n")
+    writer.writeheader()
+    for row in summarise(records):
+        writer.writerow({
+            k: f"{v:.6g}" if isinstance(v, float) else v for k, v in row.items()})
+    logger.info("Wrote metrics summary to STDOUT.")
+
+
+def argparser():
+    """Argument parser for entrypoint."""
+    parser = wf_parser("metrics_summary")
+    parser.add_argument(
+        "paths", nargs="+",
+        help=(
+            "Directories to search for metrics sidecars (e.g. a Nextflow work "
+            "directory) and/or JSON lines metrics files"))
+    return parser
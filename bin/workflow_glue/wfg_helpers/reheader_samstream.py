@@ -16,6 +16,9 @@ This script handles:
     of the existing XAM header to maintain a chain of custody
   - Updating any streamed PG.ID (and PG.PP) tags to avoid collisions
     with inserted PG.ID
+  - Optionally (`--rg-collision remap`) renaming streamed RG whose ID
+    collides with a different RG of the existing XAM header, and
+    rewriting the RG tags of the streamed alignments to match
 
 Handling collisions may seem like overkill but it is anticipated that
 this script will be called immediately after minimap2, any previous
@@ -37,7 +40,9 @@ This script will explode on a stream that contains:
 SQ lines are retained after an HD line. That is to say, the most recent
 set of SQ lines observed after an HD will appear in the final output.
 SQ, RG, PG and CO lines are emitted as a group together, with elements
-written out in the order observed.
+written out in the order observed. Runs of SQ lines are kept as the text
+they were read as, so the many SQ lines of an assembly with many contigs
+are never split into lines in Python.
 
 PG lines are naively appended to the last PG element in the chain. No
 attempt is made to keep multiple program chains intact as this can lead
@@ -46,18 +51,42 @@ samtools/hts-specs#275) but one that is preferable to headers that
 become unwieldly large to process: there IS an upper limit to a SAM
 header's size after all.
 
+When a sample is aligned in chunks, the header and inserted lines can be
+prepared once with `--save-template` and each chunk reheadered with
+`--from-template`, which loads the prepared state rather than parsing the
+same lines again.
+
 This script takes advantage of minimap2's SAM output to immediately
 reheader the stream before any downstream calls to other programs pollute
 the PG header. This script is a little overkill but attempts to be robust
 with handling PG collisions and more obviously encapsulates reheadering
 behaviour, and leaves some room to do more clever things as necessary.
 """
+import collections
+import errno
+import functools
+import io
+import json
+import os
+import re
 from shutil import copyfileobj
 import sys
 
 from ..util import wf_parser  # noqa: ABS101
 
 
+# Size of blocks read from, and moved between, file descriptors
+CHUNK_SIZE = 1024 * 1024
+# errno values indicating a zero-copy method cannot be used with a given
+# pair of file descriptors (eg. splice needs a pipe on one side)
+UNSUPPORTED_COPY_ERRNOS = (errno.EINVAL, errno.ENOSYS, errno.ESPIPE, errno.EOPNOTSUPP)
+# Version of the SamHeader template format, see SamHeader.to_template
+TEMPLATE_VERSION = 1
+# A run of whole SQ lines, each with something other than whitespace
+SQ_LINES = re.compile(r"(?:@SQ\t[^\n]*\S[^\n]*\n)+")
+SQ_LINES_BYTES = re.compile(SQ_LINES.pattern.encode())
+
+
 class SamHeader:
     """An overkill container to manage merging PG lines in SAM headers.
 
@@ -74,6 +103,11 @@ class SamHeader:
         self.remapped_pgids = {}
         self.collision_suffix = 0
 
+        # How to handle an RG with the ID of a different, earlier RG: either
+        # "error" or "remap" the new RG to an unused ID
+        self.rg_collision = "error"
+        self.remapped_rgids = {}
+
         # Default HD, in case the new stream does not provide one
         self.hd = "@HD\tVN:1.6\tSO:unknown"
 
@@ -85,7 +119,8 @@ class SamHeader:
         # We keep the most recently observed block of SQ records by
         # resetting SQ on the first SQ seen after non-SQ. We cannot
         # rely on HD being emitted (as minimap2 does not do this!)
-        self.sq_records = []
+        # Records are kept as runs of whole "@SQ\t...\n" lines.
+        self.sq_lines = []
         self.reset_sq = False
 
         self.observed_rgids = set()
@@ -95,6 +130,12 @@ class SamHeader:
     @staticmethod
     def str_to_record(line):
         """Return an appropriate struct for a given string record."""
+        # SQ and CO are passed through verbatim so we can skip the general
+        # parsing below, which matters for assemblies with many contigs
+        if line[3:4] == "\t" and line[:3] in ("@SQ", "@CO"):
+            record_data = line.strip()[4:]
+            if record_data:
+                return line[:3], record_data
         try:
             record_type, record_data = line.strip().split('\t', 1)
         except ValueError:
@@ -148,17 +189,24 @@ class SamHeader:
                 raise Exception("PG chain does not have a head.")
             elif pgids_without_ppid > 1:
                 raise Exception("PG chain has multiple heads.")
+        # Walk from each ID towards the head. IDs already known to reach the
+        # head are not walked again, so each link is followed at most once
+        # (other than on the walk that finds a cycle).
+        resolved = set()
         for source in links:
             head = source
             path = [head]
-            while True:
+            on_path = {head}
+            while head not in resolved:
                 head = links[head]
                 if head is None:
                     break
-                if head in path:
+                if head in on_path:
                     path.append(head)
                     raise Exception(f"PG chain appears to contain cycle: {path}")
                 path.append(head)
+                on_path.add(head)
+            resolved.update(on_path)
         # This function is only really called to catch any explosions
         # but we'll return the links here as it is useful for testing
         return links
@@ -174,6 +222,54 @@ class SamHeader:
         self._bump_pg_collider()
         return new_pgid
 
+    @property
+    def sq_records(self):
+        """Return the data of each SQ record, without its record type."""
+        return [
+            line[4:] for lines in self.sq_lines for line in lines.split("\n")[:-1]]
+
+    @property
+    def n_sq(self):
+        """Return the number of SQ records."""
+        return sum(lines.count("\n") for lines in self.sq_lines)
+
+    def add_sq_lines(self, lines):
+        """Add a run of whole SQ lines, which are kept verbatim.
+
+        A run that is not all well formed SQ lines is added line by line, so
+        that the line at fault is reported.
+        """
+        if not SQ_LINES.fullmatch(lines):
+            for line in lines.splitlines(keepends=True):
+                self.add_line(line)
+            return
+        if self.reset_sq:
+            self.sq_lines = []
+            self.reset_sq = False
+        self.sq_lines.append(lines)
+
+    def _uncollide_rg(self, record):
+        """Return an RG record with an unused ID for a colliding RG record."""
+        rgid = record["ID"]
+        if rgid in self.remapped_rgids:
+            # the same RG may be repeated, but the tags of the reads cannot
+            # tell apart two different RG that share an ID
+            remapped = dict(record, ID=self.remapped_rgids[rgid])
+            if remapped in self.rg_records:
+                return remapped
+            raise Exception(
+                f"RG with ID '{rgid}' conflicts with more than one previously seen RG with same ID."  # noqa:E501
+            )
+        suffix = 0
+        while f"{rgid}-{suffix}" in self.observed_rgids:
+            suffix += 1
+        new_rgid = f"{rgid}-{suffix}"
+        self.remapped_rgids[rgid] = new_rgid
+        self.observed_rgids.add(new_rgid)
+        record = dict(record, ID=new_rgid)
+        self.rg_records.append(record)
+        return record
+
     def add_line(self, line):
         """Add a header line to the header."""
         record_type, record = self.str_to_record(line)
@@ -183,16 +279,17 @@ class SamHeader:
         elif record_type == "@CO":
             self.co_records.append(record)
         elif record_type == "@SQ":
-            if self.reset_sq:
-                self.sq_records = []
-                self.reset_sq = False
-            self.sq_records.append(record)
+            self.add_sq_lines(f"@SQ\t{record}\n")
         elif record_type == "@RG":
             rgid = record["ID"]
             if rgid not in self.observed_rgids:
                 self.observed_rgids.add(rgid)
                 self.rg_records.append(record)
-            elif record not in self.rg_records:
+            elif record in self.rg_records:
+                pass
+            elif self.rg_collision == "remap":
+                record = self._uncollide_rg(record)
+            else:
                 # if rgid has been seen before, abort if this record is different
                 raise Exception(
                     f"Duplicate RG with ID '{rgid}' conflicts with previously seen RG with same ID."  # noqa:E501
@@ -229,17 +326,68 @@ class SamHeader:
 
             self.pg_records.append(record)
 
-        if len(self.sq_records) > 0 and record_type != '@SQ':
+        if self.sq_lines and record_type != '@SQ':
             self.reset_sq = True
 
         return record
 
+    def header_str(self):
+        """Return this header as a string."""
+        buf = io.StringIO()
+        self.write_header(buf)
+        return buf.getvalue()
+
+    def to_template(self):
+        """Return the state of this header as a JSON serialisable dict.
+
+        A template saves parsing the same header and inserted lines again
+        for each chunk of a sample that is aligned separately, and ensures
+        every chunk starts from an identical header.
+        """
+        return {
+            "version": TEMPLATE_VERSION,
+            "hd": self.hd,
+            "sq_lines": self.sq_lines,
+            "reset_sq": self.reset_sq,
+            "rg_records": self.rg_records,
+            "pg_records": self.pg_records,
+            "co_records": self.co_records,
+            "observed_rgids": sorted(self.observed_rgids),
+            "remapped_rgids": self.remapped_rgids,
+            "observed_pgids": sorted(self.observed_pgids),
+            "remapped_pgids": self.remapped_pgids,
+            "collision_suffix": self.collision_suffix,
+            "last_pgid": self.last_pgid,
+        }
+
+    @classmethod
+    def from_template(cls, template):
+        """Create a header from a dict made by to_template."""
+        version = template.get("version")
+        if version != TEMPLATE_VERSION:
+            raise Exception(
+                f"Header template version {version} is not supported, "
+                f"expected {TEMPLATE_VERSION}.")
+        sh = cls()
+        sh.hd = template["hd"]
+        sh.sq_lines = template["sq_lines"]
+        sh.reset_sq = template["reset_sq"]
+        sh.rg_records = template["rg_records"]
+        sh.pg_records = template["pg_records"]
+        sh.co_records = template["co_records"]
+        sh.observed_rgids = set(template["observed_rgids"])
+        sh.remapped_rgids = template["remapped_rgids"]
+        sh.observed_pgids = set(template["observed_pgids"])
+        sh.remapped_pgids = template["remapped_pgids"]
+        sh.collision_suffix = template["collision_suffix"]
+        sh.last_pgid = template["last_pgid"]
+        return sh
+
     def write_header(self, fh):
         """Write this header to a file handle."""
         self.resolve_pg_chain(self.pg_records)  # check PG header
         fh.write(f"{self.hd}\n")
-        for sq in self.sq_records:
-            fh.write(self.record_to_str("@SQ", sq) + '\n')
+        fh.writelines(self.sq_lines)
         for rg in self.rg_records:
             fh.write(self.record_to_str("@RG", rg) + '\n')
         for pg in self.pg_records:
@@ -248,56 +396,372 @@ class SamHeader:
             fh.write(self.record_to_str("@CO", co) + '\n')
 
 
-def reheader_samstream(header_in, stream_in, stream_out, args):
-    """Run reheader_samstream."""
-    # read original header into container
-    sh = SamHeader()
-    for line in header_in:
-        sh.add_line(line)
+def _fileno(stream):
+    """Return the file descriptor underlying a stream, if there is one."""
+    try:
+        return stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        # StringIO and friends raise io.UnsupportedOperation
+        return None
+
+
+def _write_all(fd, data):
+    """Write all of data to a file descriptor."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def read_header(sh, read, chunk_size=CHUNK_SIZE):
+    """Add the header lines read in blocks to a SamHeader.
+
+    We track our own position within the blocks, so that the bytes read
+    beyond the header can be handed back rather than needing to seek the
+    stream. Runs of SQ lines are found with a regular expression and added
+    as one slice.
+
+    :param read: function to read up to a number of bytes, returning an
+        empty result at the end of the stream.
+    :return: bytes read past the end of the header, the start of the
+        alignment body.
+    """
+    buf = bytearray()
+    pos = 0
+    eof = False
+    while True:
+        if pos < len(buf) and buf[pos] != ord('@'):
+            return bytes(buf[pos:])
+        sq_lines = SQ_LINES_BYTES.match(buf, pos)
+        if sq_lines:
+            sh.add_sq_lines(sq_lines.group().decode())
+            pos = sq_lines.end()
+            continue
+        nl = buf.find(b"\n", pos)
+        if nl != -1:
+            sh.add_line(buf[pos:nl + 1].decode())
+            pos = nl + 1
+        elif eof:
+            # the last line of a stream need not be newline terminated
+            if pos < len(buf):
+                sh.add_line(buf[pos:].decode())
+            return b""
+        else:
+            del buf[:pos]
+            pos = 0
+            chunk = read(chunk_size)
+            eof = not chunk
+            buf += chunk
+
+
+def read_header_fd(sh, fd, chunk_size=CHUNK_SIZE):
+    """Add the header lines read straight from a file descriptor to a SamHeader.
+
+    :return: bytes read past the end of the header.
+    """
+    return read_header(sh, functools.partial(os.read, fd), chunk_size=chunk_size)
+
+
+def read_header_text(sh, stream):
+    """Add the header lines read from a text stream to a SamHeader.
+
+    :return: text read past the end of the header, the start of the
+        alignment body, or an empty string if the stream has no alignments.
+    """
+    # the blocks are encoded from whole characters and the rest starts at a
+    # line, so it can be decoded on its own
+    return read_header(sh, _block_reader(stream, None)).decode()
+
+
+def _block_reader(stream, fd):
+    """Return a function to read bytes from a stream, or its descriptor."""
+    if fd is not None:
+        return functools.partial(os.read, fd)
+
+    def read(size):
+        return stream.read(size).encode()
+    return read
+
+
+def iter_blocks(read, head=b"", chunk_size=CHUNK_SIZE):
+    """Yield blocks of whole lines.
+
+    :param read: function to read up to a number of bytes, returning an
+        empty result at the end of the stream.
+    :param head: bytes already read from the stream.
+    """
+    rest = head
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        block = rest + chunk
+        end = block.rfind(b"\n") + 1
+        yield block[:end]
+        rest = block[end:]
+    # the last line of a stream need not be newline terminated
+    if rest:
+        yield rest
+
+
+def rg_tag_remapper(remapped_rgids):
+    """Return a function rewriting RG tags in blocks of whole SAM lines.
+
+    Blocks are searched for the tags of remapped IDs, so only the lines
+    holding one are touched and no fields are parsed. A match is only
+    replaced once it is known to be an optional field, after the eleventh
+    tab of its line.
+    """
+    new_rgids = {
+        old.encode(): new.encode() for old, new in remapped_rgids.items()}
+    # longest first, though the lookahead already requires the whole ID
+    alternatives = b"|".join(
+        re.escape(old) for old in sorted(new_rgids, key=len, reverse=True))
+    pattern = re.compile(rb"\tRG:Z:(" + alternatives + rb")(?=[\t\n]|\Z)")
+
+    def replace(match):
+        block = match.string
+        start = block.rfind(b"\n", 0, match.start()) + 1
+        if block.count(b"\t", start, match.start()) < 10:
+            return match.group(0)
+        return b"\tRG:Z:" + new_rgids[match.group(1)]
+
+    def remap(block):
+        return pattern.sub(replace, block)
+    return remap
+
+
+class StreamStats:
+    """Count alignments by type as blocks of SAM lines stream past.
+
+    The counts follow those of `bamstats.flagstat.tsv`: unmapped records
+    are counted separately from the primary, secondary and supplementary
+    alignments. Mapped bases are the SEQ lengths of the primary alignments.
+    """
+
+    def __init__(self):
+        """Initialise empty counts."""
+        # records and bases by FLAG, there are few distinct values so
+        # these are only decoded at the end
+        self.records = collections.Counter()
+        self.bases = collections.Counter()
+
+    def update(self, block):
+        """Count the alignments in a block of whole lines, returning it.
+
+        Splitting on bytes is done in C and is several times faster than
+        matching the fields with a regular expression.
+        """
+        records = self.records
+        bases = self.bases
+        for line in block.split(b"\n"):
+            fields = line.split(b"\t", 10)
+            if len(fields) < 11:
+                continue
+            flag, seq = fields[1], fields[9]
+            records[flag] += 1
+            if seq != b"*":
+                bases[flag] += len(seq)
+        return block
+
+    def to_dict(self):
+        """Return the counts."""
+        stats = dict.fromkeys(
+            ["total", "primary", "secondary", "supplementary", "unmapped"], 0)
+        stats["mapped_bases"] = 0
+        for flag, n in self.records.items():
+            flag = int(flag)
+            stats["total"] += n
+            if flag & 0x4:
+                stats["unmapped"] += n
+            elif flag & 0x100:
+                stats["secondary"] += n
+            elif flag & 0x800:
+                stats["supplementary"] += n
+            else:
+                stats["primary"] += n
+        for flag, n in self.bases.items():
+            if not int(flag) & 0x904:
+                stats["mapped_bases"] += n
+        return stats
+
+
+def write_bam(sh, blocks, stream_out, threads=1):
+    """Write the header and the alignments in blocks of SAM lines as BAM.
+
+    Records are encoded by htslib and BGZF blocks are compressed on its
+    thread pool, saving a pipe to a separate `samtools view` process and a
+    second serialisation of the uncompressed SAM.
+    """
+    # deferred as pysam is not needed for passing SAM through
+    import pysam
+    header = pysam.AlignmentHeader.from_text(sh.header_str())
+    stream_out.flush()
+    with pysam.AlignmentFile(
+        stream_out, "wb", header=header, threads=threads
+    ) as bam:
+        for block in blocks:
+            for line in block.decode().splitlines():
+                if line:
+                    bam.write(pysam.AlignedSegment.fromstring(line, header))
+
+
+def _splice_fd(in_fd, out_fd, chunk_size):
+    """Move data between descriptors in the kernel, one must be a pipe."""
+    if not hasattr(os, "splice"):
+        return False
+    moved = False
+    try:
+        while os.splice(in_fd, out_fd, chunk_size):
+            moved = True
+    except OSError as e:
+        if moved or e.errno not in UNSUPPORTED_COPY_ERRNOS:
+            raise
+        return False
+    return True
+
+
+def _sendfile_fd(in_fd, out_fd, chunk_size):
+    """Move data from a regular file to any descriptor in the kernel."""
+    moved = False
+    try:
+        while os.sendfile(out_fd, in_fd, None, chunk_size):
+            moved = True
+    except OSError as e:
+        if moved or e.errno not in UNSUPPORTED_COPY_ERRNOS:
+            raise
+        return False
+    return True
+
+
+def _readinto_fd(in_fd, out_fd, chunk_size):
+    """Copy data between descriptors through a single reused buffer."""
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    while True:
+        n = os.readv(in_fd, [buf])
+        if not n:
+            return True
+        _write_all(out_fd, view[:n])
+
+
+COPY_STRATEGIES = {
+    "splice": _splice_fd,
+    "sendfile": _sendfile_fd,
+    "readinto": _readinto_fd,
+}
+
+
+def copy_fd(in_fd, out_fd, strategies=COPY_STRATEGIES, chunk_size=CHUNK_SIZE):
+    """Copy the remainder of in_fd to out_fd with the first strategy that works.
+
+    :return: name of the strategy used.
+    """
+    for name in strategies:
+        if COPY_STRATEGIES[name](in_fd, out_fd, chunk_size):
+            return name
+    raise ValueError(f"None of the copy strategies {list(strategies)} worked.")
+
+
+def prepare_header(header_in, args):
+    """Return the header to merge the stream's header into."""
+    if args.from_template:
+        sh = SamHeader.from_template(json.load(header_in))
+    else:
+        # read original header into container, a line that is not a header
+        # record is still added so that it is reported
+        sh = SamHeader()
+        rest = read_header_text(sh, header_in)
+        if rest:
+            sh.add_line(rest.splitlines(keepends=True)[0])
 
     # append user provided lines to container
     for line in args.insert:
         sh.add_line(line)
+    return sh
 
-    # read the header portion of the minimap2 stream
-    wrote_header = False
-    for line in stream_in:
-        if line[0] != '@':
-            # write out header on first alignment
-            sh.write_header(stream_out)
-            wrote_header = True
-            # and actually write the first alignment
-            stream_out.write(line)
-            break
-        sh.add_line(line)
 
-    # Pass through the rest of the alignments.
-    # I toyed with a few ways of doing this:
-    #   - A trivial iter over the input file was slow. presumably as we incurred some
-    #     overhead calling read() and write() and decoding more than other methods.
-    #   - os.read/write avoids dealing with higher level python read/write but requires
-    #     file descriptors which rules out non-file-like objects. this made testing more
-    #     annoying as StringIO does not have a file descriptor. we could have mocked fds
-    #     but i was not happy with the discrepancy between real and test execution.
-    #   - copyfileobj with the stream_in.buffer would also avoid some of the higher
-    #     level text handling but would require all tests to provide inputs that have
-    #     an underlying binary buffer. it was also not possible to seek the buffer to
-    #     the position of the text stream as we've used next() to iterate over the
-    #     header lines, fixing this would have required rewriting of the header
-    #     handling or keeping track of the position in the stream ourselves which
-    #     just seemed unncessary overkill given how we expect this program to be used.
-    # copyfileobj on the text streams is more efficient than merely iterating the file
-    # and dumping the lines out and seems to do the job. this keeps the code and tests
-    # simple with minimal additional cost to performance. i anticipate any overhead of
-    # this program will be dwarfed by that of minimap2/samtools sort anyway.
-    # increasing the buffer size gave worse performance in my limited testing so we
-    # leave it as the default here.
-    copyfileobj(stream_in, stream_out)
-
-    # If there were no alignments, we won't have hit the != @ case in the first stdin,
-    # and we won't have written the header out. Write a header if we haven't already.
-    if not wrote_header:
-        sh.write_header(stream_out)
+def reheader_samstream(header_in, stream_in, stream_out, args):
+    """Run reheader_samstream."""
+    sh = prepare_header(header_in, args)
+    # only RG from the stream are remapped, those in header_in are kept
+    sh.rg_collision = args.rg_collision
+
+    # When the input is backed by a file descriptor (ie. the usual case of
+    # stdin) we avoid the text layer entirely. The header is read in blocks
+    # from the raw descriptor while tracking where it ends. If the output also
+    # has a descriptor, the rest of the stream (the vast majority of the data)
+    # is moved to it without being decoded: by splice(2) when either side is a
+    # pipe, by sendfile(2) when reading from a file, or failing that with large
+    # reads into a reused buffer. Otherwise we fall back to the text path,
+    # which is what tests using StringIO will exercise. The text path can also
+    # be chosen with `--passthrough text`, eg. for benchmarking.
+    in_fd = out_fd = None
+    if args.passthrough != "text":
+        in_fd = _fileno(stream_in)
+        out_fd = _fileno(stream_out)
+    if in_fd is not None:
+        body = read_header_fd(sh, in_fd)
+    else:
+        body = read_header_text(sh, stream_in).encode()
+
+    # If any RG were remapped the tags of the alignments need rewriting, and
+    # counting alignments needs to see them, so in these cases we pass blocks
+    # of lines through each filter in turn rather than copying.
+    filters = []
+    if sh.remapped_rgids:
+        filters.append(rg_tag_remapper(sh.remapped_rgids))
+    stats = None
+    if args.stats_out:
+        stats = StreamStats()
+        filters.append(stats.update)
+    blocks = iter_blocks(_block_reader(stream_in, in_fd), body)
+    for block_filter in filters:
+        blocks = map(block_filter, blocks)
+
+    if args.output_bam:
+        # htslib writes to the descriptor whatever the passthrough mode
+        if _fileno(stream_out) is None:
+            raise ValueError("BAM output requires a file or pipe to write to.")
+        write_bam(sh, blocks, stream_out, threads=args.threads)
+    elif filters:
+        if out_fd is not None:
+            stream_out.flush()
+            _write_all(out_fd, sh.header_str().encode())
+            for block in blocks:
+                _write_all(out_fd, block)
+        else:
+            stream_out.write(sh.header_str())
+            for block in blocks:
+                stream_out.write(block.decode())
+    elif in_fd is not None and out_fd is not None:
+        stream_out.flush()
+        _write_all(out_fd, sh.header_str().encode() + body)
+        if args.passthrough == "auto":
+            copy_fd(in_fd, out_fd)
+        else:
+            copy_fd(in_fd, out_fd, strategies=[args.passthrough])
+    elif in_fd is not None:
+        # Raw reads from the descriptor can end within a multibyte character,
+        # so the alignments are written as bytes where the output has a
+        # buffer, or else decoded in blocks of whole lines.
+        stream_out.write(sh.header_str())
+        buffer = getattr(stream_out, "buffer", None)
+        if buffer is not None:
+            stream_out.flush()
+            buffer.writelines(blocks)
+        else:
+            stream_out.writelines(block.decode() for block in blocks)
+    else:
+        stream_out.write(sh.header_str() + body.decode())
+        # Pass through the rest of the alignments. The header was read from
+        # the text layer, so we cannot hand the underlying buffer to anything
+        # else. copyfileobj on the text streams is more efficient than merely
+        # iterating the file and dumping the lines out.
+        copyfileobj(stream_in, stream_out)
+
+    if stats is not None:
+        with open(args.stats_out, "w") as fh:
+            json.dump(stats.to_dict(), fh)
 
 
 def argparser():
@@ -305,10 +769,49 @@ def argparser():
     parser = wf_parser("reheader_samstream")
     parser.add_argument("header_in")
     parser.add_argument("--insert", action="append", default=[])
+    parser.add_argument(
+        "--rg-collision", choices=["error", "remap"], default="error",
+        help=(
+            "How to handle an RG in the stream with the ID of a different RG "
+            "in header_in: error, or remap it to a new ID and rewrite the RG "
+            "tags of its alignments."))
+    parser.add_argument(
+        "--passthrough", default="auto",
+        choices=["auto", "text"] + list(COPY_STRATEGIES),
+        help=(
+            "How to copy the alignments to the output: the first copy strategy "
+            "that works with the streams (auto), a given strategy, or through "
+            "the text layer."))
+    parser.add_argument(
+        "--stats-out",
+        help=(
+            "Write counts of primary, secondary, supplementary and unmapped "
+            "records, and of mapped bases, to this JSON file."))
+    template = parser.add_mutually_exclusive_group()
+    template.add_argument(
+        "--save-template", metavar="TEMPLATE",
+        help=(
+            "Write the header prepared from header_in and any --insert lines "
+            "to a template file and exit, without reading a stream."))
+    template.add_argument(
+        "--from-template", action="store_true",
+        help="header_in is a template written by --save-template.")
+    parser.add_argument(
+        "--output-bam", action="store_true",
+        help="Write BAM rather than SAM to stdout.")
+    parser.add_argument(
+        "--threads", type=int, default=1,
+        help="Number of BGZF compression threads for --output-bam.")
     return parser
 
 
 def main(args):
     """reheader_samstream default entry point."""
     with open(args.header_in) as header_in:
+        if args.save_template:
+            sh = prepare_header(header_in, args)
+            sh.resolve_pg_chain(sh.pg_records)  # check PG header
+            with open(args.save_template, "w") as fh:
+                json.dump(sh.to_template(), fh, separators=(",", ":"))
+            return
         reheader_samstream(header_in, sys.stdin, sys.stdout, args)
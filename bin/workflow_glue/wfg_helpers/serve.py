@@ -0,0 +1,236 @@
+"""Serve workflow-glue subcommands from a warm interpreter.
+
+Short per-sample helpers (e.g. `check_xam_index`) typically spend more
+time starting Python and importing pysam/pandas than doing any work. The
+`serve` subcommand imports the components once and listens on a local
+Unix socket; `workflow-glue-client` forwards its arguments, working
+directory, environment and standard streams to the server and exits with
+the status of the subcommand.
+
+Each request is handled in a process forked from the server so that
+subcommands run with a pristine copy of the warm interpreter: they may
+`sys.exit`, change directory or leave global state behind without
+affecting later requests. The client's stdin, stdout and stderr file
+descriptors are passed over the socket (SCM_RIGHTS) and installed as the
+forked process' own, so output is identical to running the subcommand
+directly.
+
+The protocol is a single request and a single response:
+  - the client sends a JSON object (`argv`, `cwd`, `env`) terminated by a
+    newline, along with its three standard file descriptors
+  - the server replies with the exit status as a newline terminated
+    integer and closes the connection
+"""
+import json
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from .. import cli, get_components  # noqa: ABS101
+from ..util import exit_status, get_named_logger, wf_parser  # noqa: ABS101
+
+
+SOCKET_ENV = "WORKFLOW_GLUE_SOCKET"
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+
+
+def _recv_request(conn):
+    """Read a request and its file descriptors from a connection."""
+    data, fds, _, _ = socket.recv_fds(conn, 65536, 3)
+    buf = bytearray(data)
+    while not buf.endswith(b"\n"):
+        if len(buf) > MAX_REQUEST_SIZE:
+            raise ValueError("Request exceeds maximum size.")
+        data = conn.recv(65536)
+        if not data:
+            raise ValueError("Connection closed before request was complete.")
+        buf += data
+    if len(fds) != 3:
+        raise ValueError(f"Expected 3 file descriptors, received {len(fds)}.")
+    return json.loads(buf), fds
+
+
+def run_argv(argv):
+    """Run a workflow-glue command line and return its exit status."""
+    try:
+        cli(argv)
+        code = 0
+    except SystemExit as e:
+        code = exit_status(e.code)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+    return code
+
+
+def _handle_request(conn):
+    """Handle a single request in a forked process, never returning."""
+    code = 1
+    try:
+        request, fds = _recv_request(conn)
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = ["workflow-glue"] + request["argv"]
+        code = run_argv(request["argv"])
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            conn.sendall(f"{code}\n".encode())
+        except OSError:
+            pass
+        os._exit(code)
+
+
+def _reap(children):
+    """Collect any finished request processes."""
+    for pid in list(children):
+        try:
+            done, _ = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            done = pid
+        if done:
+            children.discard(pid)
+
+
+def _bind(path):
+    """Bind a listening socket, refusing to replace a live server."""
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            # stale socket left behind by a server that has gone away
+            os.unlink(path)
+        else:
+            raise ValueError(f"A server is already listening on '{path}'.")
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen(128)
+    return server
+
+
+def serve(path, components=None, idle_timeout=None, poll_interval=1.0):
+    """Serve requests on a Unix socket until terminated or idle."""
+    logger = get_named_logger("serve")
+    loaded = get_components(allowed_components=components)
+    logger.info(f"Loaded {len(loaded)} components: {', '.join(sorted(loaded))}.")
+
+    server = _bind(path)
+    server.settimeout(poll_interval)
+    # turn SIGTERM into a normal exit so the socket is cleaned up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info(f"Listening on '{path}'.")
+
+    children = set()
+    last_active = time.monotonic()
+    try:
+        while True:
+            _reap(children)
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                idle = time.monotonic() - last_active
+                if idle_timeout and not children and idle > idle_timeout:
+                    logger.info("Idle timeout reached, shutting down.")
+                    break
+                continue
+            last_active = time.monotonic()
+            conn.settimeout(None)
+            # avoid duplicating anything buffered in the server's streams
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                _handle_request(conn)
+            conn.close()
+            children.add(pid)
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+
+def client(argv=None, socket_path=None):
+    """Forward a command line to a server, falling back to a local run."""
+    if argv is None:
+        argv = sys.argv[1:]
+    if socket_path is None:
+        socket_path = os.environ.get(SOCKET_ENV)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        if not socket_path:
+            raise OSError("No server socket configured.")
+        sock.connect(socket_path)
+    except OSError:
+        # no warm server available, run the command ourselves
+        sock.close()
+        sys.exit(run_argv(argv))
+
+    with sock:
+        payload = json.dumps({
+            "argv": argv,
+            "cwd": os.getcwd(),
+            "env": dict(os.environ),
+        }).encode() + b"\n"
+        sent = socket.send_fds(sock, [payload], [0, 1, 2])
+        sock.sendall(payload[sent:])
+        response = bytearray()
+        while True:
+            data = sock.recv(64)
+            if not data:
+                break
+            response += data
+    try:
+        code = int(response)
+    except ValueError:
+        # the request process died without reporting a status
+        code = 1
+    sys.exit(code)
+
+
+def main(args):
+    """Run the entry point."""
+    if args.socket is None:
+        raise ValueError(
+            f"A socket path must be given with --socket or ${SOCKET_ENV}.")
+    serve(args.socket, components=args.components, idle_timeout=args.idle_timeout)
+
+
+def argparser():
+    """Argument parser for entrypoint."""
+    parser = wf_parser("serve")
+    parser.add_argument(
+        "--socket", default=os.environ.get(SOCKET_ENV),
+        help=f"Path of the Unix socket to listen on (defaults to ${SOCKET_ENV})")
+    parser.add_argument(
+        "--components", nargs="+",
+        help="Only preload these components (defaults to all)")
+    parser.add_argument(
+        "--idle-timeout", type=float,
+        help="Shut down after this many seconds without requests")
+    return parser
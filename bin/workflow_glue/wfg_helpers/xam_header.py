@@ -0,0 +1,207 @@
+"""Read the parts of XAM headers that are compared between files.
+
+Opening a file with `pysam.AlignmentFile` reads and parses the whole
+header with htslib, and comparing lists of `@SQ` dicts in Python is slow
+for references with many contigs. For BAM we instead inflate only the
+leading BGZF blocks holding the header, and reduce the `@SQ` lines to a
+digest over their SN, LN and M5 elements so files can be compared by a
+single value. Files that are not BAM (SAM, CRAM) are read with pysam.
+"""
+import collections
+import hashlib
+import re
+import struct
+import zlib
+
+
+# gzip magic with the deflate method and FEXTRA flag set, as in all BGZF blocks
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+BAM_MAGIC = b"BAM\x01"
+# Size of reads of compressed data, a few BGZF blocks (each at most 64 KiB)
+READ_SIZE = 64 * 1024
+# SN, LN and M5 (if present) of each `@SQ` line. SN and LN are almost always
+# the first tags so we try that quicker pattern first, then allow any order.
+FAST_SQ_PATTERN = re.compile(
+    r"^@SQ\tSN:([^\t\n]*)\tLN:([^\t\n]*)(?:[^\n]*?\tM5:([^\t\n]*))?",
+    re.MULTILINE)
+SQ_PATTERN = re.compile(
+    r"^@SQ(?=[^\n]*?\tSN:([^\t\n]*))(?=[^\n]*?\tLN:([^\t\n]*))"
+    r"(?:(?=[^\n]*?\tM5:([^\t\n]*)))?", re.MULTILINE)
+HD_PATTERN = re.compile(r"^@HD\t[^\n]*", re.MULTILINE)
+RG_PATTERN = re.compile(r"^@RG\t[^\n]*", re.MULTILINE)
+
+
+class BgzfReader:
+    """Read from the start of a BGZF file, inflating blocks only as needed."""
+
+    def __init__(self, fh):
+        """Initialise the reader with a binary file handle."""
+        self.fh = fh
+        self.buf = bytearray()
+        self.pos = 0
+        # BGZF blocks are gzip members, 31 is a gzip header and maximum window
+        self.decompressor = zlib.decompressobj(31)
+
+    def _inflate(self):
+        """Inflate more data into the buffer, return False at end of file."""
+        data = b""
+        if self.decompressor.eof:
+            # start the next block with anything read past the last
+            data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj(31)
+        if not data:
+            data = self.fh.read(READ_SIZE)
+            if not data:
+                return False
+        # drop what has been read before growing the buffer
+        del self.buf[:self.pos]
+        self.pos = 0
+        self.buf += self.decompressor.decompress(data)
+        return True
+
+    def read(self, size):
+        """Read exactly size bytes."""
+        while len(self.buf) - self.pos < size:
+            if not self._inflate():
+                raise ValueError("BGZF file ended within the BAM header.")
+        data = bytes(self.buf[self.pos:self.pos + size])
+        self.pos += size
+        return data
+
+    def read_int32(self):
+        """Read a little-endian int32."""
+        return struct.unpack("<i", self.read(4))[0]
+
+
+# Summary of the `@SQ`, `@HD` and `@RG` lines of a XAM header, the run IDs and
+# basecall models are taken from RG.DS as written by dorado
+XamHeader = collections.namedtuple(
+    "XamHeader", ["n_sq", "sq_digest", "hd", "run_ids", "basecall_models"])
+
+
+def sq_digest(sq_records):
+    """Return a digest of (SN, LN, M5) tuples, M5 may be None."""
+    # NUL cannot appear in a header so fields cannot run into each other
+    return hashlib.sha256("".join(
+        f"{sn}\0{ln}\0{m5 or ''}\0" for sn, ln, m5 in sq_records
+    ).encode()).hexdigest()
+
+
+def _tags(line):
+    """Return the tags of a header line as a dict."""
+    return dict(
+        field.split(":", 1) for field in line.split("\t")[1:] if ":" in field)
+
+
+def _run_info(read_groups):
+    """Return the sorted run IDs and basecall models from RG tag dicts."""
+    run_ids = set()
+    basecall_models = set()
+    for read_group in read_groups:
+        for ds_kv in read_group.get("DS", "").split():
+            k, _, v = ds_kv.partition("=")
+            if k == "runid":
+                run_ids.add(v)
+            elif k == "basecall_model":
+                basecall_models.add(v)
+    return sorted(run_ids), sorted(basecall_models)
+
+
+def _open_bam(fh):
+    """Return a BgzfReader positioned after the BAM magic, or None if not BAM."""
+    if fh.read(4) != BGZF_MAGIC:
+        return None
+    fh.seek(0)
+    reader = BgzfReader(fh)
+    try:
+        if reader.read(4) != BAM_MAGIC:
+            # eg. bgzipped SAM
+            return None
+    except (ValueError, zlib.error):
+        return None
+    return reader
+
+
+def _sq_from_text(text):
+    """Return (SN, LN, M5) tuples of the `@SQ` lines of header text."""
+    n_lines = text.count("\n@SQ\t") + text.startswith("@SQ\t")
+    for pattern in (FAST_SQ_PATTERN, SQ_PATTERN):
+        sq_records = pattern.findall(text)
+        if len(sq_records) == n_lines:
+            return [(sn, int(ln), m5 or None) for sn, ln, m5 in sq_records]
+    raise ValueError("Header has @SQ lines without SN or LN.")
+
+
+def _read_references(reader):
+    """Read the binary reference list of a BAM, following the header text."""
+    references = []
+    for _ in range(reader.read_int32()):
+        # names are NUL terminated
+        name = reader.read(reader.read_int32())[:-1].decode()
+        references.append((name, reader.read_int32()))
+    return references
+
+
+def _header_from_bam(reader):
+    """Summarise the header of a BAM, from after its magic."""
+    text = reader.read(reader.read_int32()).decode(errors="replace")
+    sq_records = _sq_from_text(text)
+    if not sq_records:
+        # like htslib, use the binary references if the text has no SQ
+        sq_records = [
+            (name, length, None) for name, length in _read_references(reader)]
+    hd = HD_PATTERN.search(text)
+    if hd is not None:
+        hd = _tags(hd.group(0))
+    run_ids, basecall_models = _run_info(
+        _tags(line) for line in RG_PATTERN.findall(text))
+    return XamHeader(
+        len(sq_records), sq_digest(sq_records), hd, run_ids, basecall_models)
+
+
+def _header_from_pysam(fname):
+    """Summarise the header of any XAM with pysam."""
+    # deferred as pysam is only needed for files that are not BAM
+    import pysam
+    with pysam.AlignmentFile(fname, check_sq=False) as f:
+        header = f.header.to_dict()
+    sq_records = [
+        (sq["SN"], sq["LN"], sq.get("M5")) for sq in header.get("SQ", [])]
+    run_ids, basecall_models = _run_info(header.get("RG", []))
+    return XamHeader(
+        len(sq_records), sq_digest(sq_records), header.get("HD"), run_ids,
+        basecall_models)
+
+
+def read_header(fname):
+    """Summarise the `@SQ`, `@HD` and `@RG` lines of a XAM header.
+
+    Only the SN, LN and M5 elements of `@SQ` are used, so that XAM with the
+    same reference but, for example, a different SQ.UR compare equal (see
+    CW-4842).
+    """
+    with open(fname, "rb") as fh:
+        reader = _open_bam(fh)
+        if reader is not None:
+            return _header_from_bam(reader)
+    return _header_from_pysam(fname)
+
+
+def read_references(fname):
+    """Return the (name, length) of each reference of a BAM, in order.
+
+    These are the binary references that BAM records and indexes refer to
+    by number, rather than the `@SQ` lines of the header text.
+    """
+    with open(fname, "rb") as fh:
+        reader = _open_bam(fh)
+        if reader is None:
+            raise ValueError(f"'{fname}' is not a BAM.")
+        reader.read(reader.read_int32())
+        return _read_references(reader)
+
+
+def is_bam(fname):
+    """Return whether a file is BAM, rather than SAM or CRAM."""
+    with open(fname, "rb") as fh:
+        return _open_bam(fh) is not None
@@ -0,0 +1,130 @@
+"""Cache XAM header summaries across runs in an SQLite database.
+
+The same BAM files are typically checked again by every `-resume` run or
+re-analysis of a MinKNOW output directory. Summaries from `xam_header`
+are stored against the identity of the file they were read from: its
+real path (Nextflow stages inputs as symlinks), size, modification time
+and inode. A file that has been replaced or modified has a different
+identity, so it is read again rather than given a stale summary. The
+identity is taken before a header is read, so a file modified while it is
+being read is stored against its earlier identity.
+
+Parallel tasks may share a cache. SQLite serialises writers with file
+locks, so the database should be on a filesystem where those work (eg.
+a local disk rather than NFS). Lookups and updates are each a single
+transaction per directory, and a cache that cannot be used (locked for
+too long, unwritable) is logged and skipped rather than failing the check.
+"""
+import json
+import os
+import sqlite3
+
+from .xam_header import XamHeader  # noqa: ABS101
+from ..util import get_named_logger  # noqa: ABS101
+
+
+# Bump the table name if XamHeader or the way it is computed changes
+TABLE = "xam_headers_v1"
+# Seconds to wait for another writer to release the database
+TIMEOUT = 60
+
+
+def file_identity(fname):
+    """Return the (path, size, mtime_ns, inode) of a file."""
+    path = os.path.realpath(fname)
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+class HeaderCache:
+    """Persistent store of XamHeader keyed by file identity."""
+
+    def __init__(self, path):
+        """Open, creating if necessary, the cache database."""
+        self.logger = get_named_logger("hdrCache")
+        # autocommit mode, so we control the transactions
+        self.conn = sqlite3.connect(path, timeout=TIMEOUT, isolation_level=None)
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {TABLE} ("
+            "path TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+            "n_sq INTEGER, sq_digest TEXT, hd TEXT, run_ids TEXT, "
+            "basecall_models TEXT, "
+            "PRIMARY KEY (path, size, mtime_ns, inode))")
+
+    def close(self):
+        """Close the database."""
+        self.conn.close()
+
+    def __enter__(self):
+        """Enter the context manager."""
+        return self
+
+    def __exit__(self, *exc):
+        """Close the database on leaving the context manager."""
+        self.close()
+
+    def get_many(self, fnames):
+        """Return a dict of file name to the cached XamHeader of each hit."""
+        hits = dict()
+        try:
+            cur = self.conn.cursor()
+            cur.execute("BEGIN")
+            for fname in fnames:
+                try:
+                    identity = file_identity(fname)
+                except OSError as e:
+                    self.logger.warning(f"Could not look up '{fname}' in cache: {e}")
+                    continue
+                cur.execute(
+                    "SELECT n_sq, sq_digest, hd, run_ids, basecall_models "
+                    f"FROM {TABLE} WHERE path = ? AND size = ? "
+                    "AND mtime_ns = ? AND inode = ?",
+                    identity)
+                row = cur.fetchone()
+                if row is not None:
+                    n_sq, digest, hd, run_ids, models = row
+                    hits[fname] = XamHeader(
+                        n_sq, digest, json.loads(hd), json.loads(run_ids),
+                        json.loads(models))
+            cur.execute("COMMIT")
+        except sqlite3.Error as e:
+            self.logger.warning(f"Could not read from header cache: {e}")
+            self._rollback()
+            return dict()
+        return hits
+
+    def put_many(self, headers):
+        """Store XamHeader for files.
+
+        :param headers: dict of the `file_identity` of each file, taken
+            before its header was read, to its header.
+        """
+        if not headers:
+            return
+        try:
+            cur = self.conn.cursor()
+            # take the write lock up front rather than upgrading a read lock,
+            # which can fail immediately if another writer is waiting
+            cur.execute("BEGIN IMMEDIATE")
+            for identity, header in headers.items():
+                # drop entries for earlier versions of the file
+                cur.execute(f"DELETE FROM {TABLE} WHERE path = ?", identity[:1])
+                cur.execute(
+                    f"INSERT OR REPLACE INTO {TABLE} VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    identity + (
+                        header.n_sq, header.sq_digest, json.dumps(header.hd),
+                        json.dumps(header.run_ids),
+                        json.dumps(header.basecall_models)))
+            cur.execute("COMMIT")
+        except sqlite3.Error as e:
+            self.logger.warning(f"Could not write to header cache: {e}")
+            self._rollback()
+
+    def _rollback(self):
+        """Abandon any open transaction."""
+        if self.conn.in_transaction:
+            try:
+                self.conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
@@ -0,0 +1,264 @@
+"""Check the structure of BAM indexes without loading them with htslib.
+
+`pysam` will happily load a BAI or CSI that belongs to an earlier version
+of a BAM, for example one that has since been re-sorted or rewritten, and
+region queries against it then silently return nothing. Here we parse the
+index and check that it could belong to the BAM:
+
+* its magic is that of a BAI or CSI (a CSI being BGZF compressed),
+* it has as many references as the BAM header,
+* no virtual offset in the bin or linear index points past the end of the
+  compressed BAM,
+* it was not modified before the BAM.
+
+The checks are cheap compared to reading the BAM, so many BAM and index
+pairs can be checked on a pool of threads with `check_indexes`.
+
+The same parsing gives `index_density`, a coarse estimate of where the
+reads of a BAM are from its index alone.
+"""
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import os
+from pathlib import Path
+import struct
+import zlib
+
+from .xam_header import read_references  # noqa: ABS101
+
+
+BAI_MAGIC = b"BAI\x01"
+CSI_MAGIC = b"CSI\x01"
+# the BAI binning scheme, as a CSI with these parameters
+BAI_MIN_SHIFT = 14
+BAI_DEPTH = 5
+
+# Result of checking an index, reason is None for a valid index
+IndexCheck = collections.namedtuple(
+    "IndexCheck", ["xam_file", "index", "valid", "reason"])
+
+
+def index_candidates(xam_file):
+    """Return the local index files htslib would look for with a BAM."""
+    xam_file = Path(xam_file)
+    return [
+        path
+        for ext in (".csi", ".bai")
+        for path in (
+            xam_file.with_name(xam_file.name + ext), xam_file.with_suffix(ext))]
+
+
+def find_index(xam_file):
+    """Return the first index htslib would use for a BAM, or None."""
+    for path in index_candidates(xam_file):
+        if path.exists():
+            return path
+    return None
+
+
+def _pseudo_bin(depth):
+    """Return the number of the bin holding metadata, rather than chunks."""
+    return ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+
+
+def _read_refs(data, pos, n_ref, csi=False):
+    """Yield the bins and linear index of each reference of an index.
+
+    :param data: index contents.
+    :param pos: offset in data of the first reference.
+    :param n_ref: number of references.
+    :param csi: whether bins have a loffset and there is no linear index.
+    :return: generator of (bins, intervals) tuples, where bins is a list of
+        (bin_id, loffset, offsets) with the flat begin and end offsets of the
+        chunks of the bin, and intervals is the linear index (empty for CSI).
+    """
+    for _ in range(n_ref):
+        (n_bin,) = struct.unpack_from("<i", data, pos)
+        pos += 4
+        bins = []
+        for _ in range(n_bin):
+            if csi:
+                bin_id, loffset, n_chunk = struct.unpack_from("<IQi", data, pos)
+                pos += 16
+            else:
+                bin_id, n_chunk = struct.unpack_from("<Ii", data, pos)
+                loffset = 0
+                pos += 8
+            bins.append((
+                bin_id, loffset, struct.unpack_from(f"<{2 * n_chunk}Q", data, pos)))
+            pos += 16 * n_chunk
+        intervals = ()
+        if not csi:
+            (n_intv,) = struct.unpack_from("<i", data, pos)
+            pos += 4
+            intervals = struct.unpack_from(f"<{n_intv}Q", data, pos)
+            pos += 8 * n_intv
+        yield bins, intervals
+
+
+def _read_index(data):
+    """Return the (min_shift, depth, refs) of a BAI or CSI.
+
+    :return: tuple of the binning scheme and a list of the (bins, intervals)
+        of each reference, see `_read_refs`.
+    :raises ValueError: if the data is not a BAI or CSI, or is truncated.
+    """
+    if data[:4] == BAI_MAGIC:
+        pos = 4
+        min_shift, depth = BAI_MIN_SHIFT, BAI_DEPTH
+        csi = False
+    else:
+        try:
+            data = gzip.decompress(data)
+        except (OSError, EOFError, zlib.error):
+            raise ValueError("Not a BAI or BGZF compressed CSI.")
+        if data[:4] != CSI_MAGIC:
+            raise ValueError("Not a BAI or CSI (bad magic).")
+        min_shift, depth, l_aux = struct.unpack_from("<iii", data, 4)
+        pos = 16 + l_aux
+        csi = True
+    try:
+        (n_ref,) = struct.unpack_from("<i", data, pos)
+        refs = list(_read_refs(data, pos + 4, n_ref, csi=csi))
+    except struct.error:
+        raise ValueError("Index is truncated.")
+    return min_shift, depth, refs
+
+
+def parse_index(data):
+    """Return the (n_ref, largest virtual offset) of a BAI or CSI.
+
+    :raises ValueError: if the data is not a BAI or CSI, or is truncated.
+    """
+    _, depth, refs = _read_index(data)
+    pseudo_bin = _pseudo_bin(depth)
+    max_offset = 0
+    for bins, intervals in refs:
+        for bin_id, loffset, offsets in bins:
+            if bin_id == pseudo_bin:
+                # the begin and end offsets of the reference, then read counts
+                offsets = offsets[:2]
+            max_offset = max(max_offset, loffset, *offsets)
+        max_offset = max(max_offset, 0, *intervals)
+    return len(refs), max_offset
+
+
+def index_density(data):
+    """Estimate the amount of data in each window of the references of an index.
+
+    The linear index of a BAI holds, for each 16 kb window, the virtual
+    offset of the first read overlapping it. In a sorted BAM the reads of a
+    window lie between its offset and that of the next window, so the spread
+    of the compressed offsets is a rough measure of read density. A CSI has
+    no linear index, so the loffset of each bin is used in the same way for
+    the windows the bin covers. htslib merges the bins of sparse regions into
+    larger ones, so the bytes up to the next bin are shared evenly between
+    the windows of the smallest bin starting at a window. Windows read from
+    the same BGZF block have a spread of 0, so the estimate is only useful
+    for well covered BAM.
+
+    :return: tuple of the window size and, for each reference, a list of the
+        compressed bytes of each window.
+    """
+    min_shift, depth, refs = _read_index(data)
+    pseudo_bin = _pseudo_bin(depth)
+    # the first bin of each level, and the log2 of the windows of its bins
+    levels = [
+        (((1 << (3 * level)) - 1) // 7, 3 * (depth - level))
+        for level in range(depth, -1, -1)]
+    densities = []
+    for bins, intervals in refs:
+        ref_span = None
+        # the smallest loffset and number of windows of the bins starting at
+        # each window, from the linear index of a BAI
+        starts = {window: (offset, 1) for window, offset in enumerate(intervals)}
+        for bin_id, loffset, offsets in bins:
+            if bin_id == pseudo_bin:
+                ref_span = offsets[:2]
+                continue
+            if intervals:
+                continue
+            first, shift = next(level for level in levels if bin_id >= level[0])
+            window = (bin_id - first) << shift
+            offset, n_windows = starts.get(window, (loffset, 1 << shift))
+            starts[window] = (min(offset, loffset), min(n_windows, 1 << shift))
+        if not starts or ref_span is None:
+            densities.append([])
+            continue
+        # windows before the first read may point to the start of the file
+        ref_begin, ref_end = ref_span
+        windows = sorted(starts)
+        coffsets = [
+            min(max(starts[window][0], ref_begin), ref_end) >> 16
+            for window in windows]
+        coffsets.append(ref_end >> 16)
+        density = [0] * max(window + starts[window][1] for window in windows)
+        for i, window in enumerate(windows):
+            n_windows = starts[window][1]
+            if i + 1 < len(windows):
+                n_windows = min(n_windows, windows[i + 1] - window)
+            share, rest = divmod(coffsets[i + 1] - coffsets[i], n_windows)
+            for j in range(n_windows):
+                density[window + j] = share + (j < rest)
+        densities.append(density)
+    return 1 << min_shift, densities
+
+
+def check_index(xam_file, index=None, check_mtime=True):
+    """Check whether an index could belong to a BAM.
+
+    :param xam_file: path of the BAM.
+    :param index: path of the index, defaults to the one htslib would use.
+    :param check_mtime: whether to reject an index modified before the BAM.
+    :return: `IndexCheck`.
+    """
+    if index is None:
+        index = find_index(xam_file)
+        if index is None:
+            return IndexCheck(xam_file, None, False, "No index found.")
+
+    def rejected(reason):
+        return IndexCheck(xam_file, index, False, reason)
+
+    try:
+        xam_stat = os.stat(xam_file)
+        index_stat = os.stat(index)
+    except OSError as e:
+        return rejected(f"Could not read file: {e}")
+    if check_mtime and index_stat.st_mtime_ns < xam_stat.st_mtime_ns:
+        return rejected("Index is older than the BAM.")
+    try:
+        with open(index, "rb") as fh:
+            n_ref, max_offset = parse_index(fh.read())
+    except ValueError as e:
+        return rejected(str(e))
+    # indexes refer to the binary references, which need not match the SQ
+    # lines of the header text
+    try:
+        n_sq = len(read_references(xam_file))
+    except (ValueError, zlib.error) as e:
+        return rejected(f"Could not read the references of the BAM: {e}")
+    if n_ref != n_sq:
+        return rejected(
+            f"Index has {n_ref} references but the BAM header has {n_sq}.")
+    # A virtual offset is the offset of a BGZF block in the compressed file
+    # and an offset within the inflated block. The end of the last chunk may
+    # be the very end of a BAM without an EOF marker block.
+    coffset, uoffset = max_offset >> 16, max_offset & 0xFFFF
+    if (coffset, uoffset) > (xam_stat.st_size, 0):
+        return rejected(
+            f"Index points to offset {coffset} beyond the end of the BAM "
+            f"({xam_stat.st_size} bytes).")
+    return IndexCheck(xam_file, index, True, None)
+
+
+def check_indexes(pairs, threads=1, check_mtime=True):
+    """Check many BAM and index pairs, yielding `IndexCheck` in order.
+
+    :param pairs: iterable of (xam_file, index) tuples, where index may be
+        None to use the one htslib would.
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        yield from executor.map(
+            lambda pair: check_index(*pair, check_mtime=check_mtime), pairs)
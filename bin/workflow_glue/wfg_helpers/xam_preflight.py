@@ -0,0 +1,168 @@
+"""Plan the ingress of (u)BAM samples from their headers and indexes.
+
+`xam_ingress` otherwise runs a `checkBamHeaders` task for each sample and
+a `validateIndex` task for each indexed BAM before choosing how to prepare
+the sample. Here the headers of every file in a run, and the indexes of
+single-file samples, are read in one pass on a pool of threads, and a plan
+with the same decisions is written for each sample.
+
+The manifest is a TSV with the columns `alias` and `path`, one row per file
+in the order the files are given to the sample, and optionally `index`. When
+no index is given we look for `<path>.bai`, as ingress does.
+
+The plan is a JSON list with an object per sample, in manifest order:
+
+* `alias`, `files` and `index`: the sample and its files.
+* `is_unaligned`, `is_sorted` and `mixed_headers`: as written by
+  `check_bam_headers_in_dir`.
+* `index_valid`: whether the index loads, or null if it was not checked.
+* `branch`: how ingress should prepare the sample, one of `no_files`,
+  `indexed`, `to_index`, `to_catsort`, `to_sortmerge` or `to_merge`. This
+  is null for samples with mixed headers, which ingress rejects.
+* `run_ids` and `basecall_models`: from the `@RG` lines of all files.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import json
+import os
+from pathlib import Path
+import sys
+
+from .check_bam_headers_in_dir import check_headers, read_headers  # noqa: ABS101
+from .check_xam_index import validate_xam_index  # noqa: ABS101
+from ..util import count_records, get_named_logger, wf_parser  # noqa: ABS101
+
+
+# As in ingress, `samtools merge` opens all its inputs at once
+N_OPEN_FILES_LIMIT = 128
+
+
+def read_manifest(fname):
+    """Return a dict of sample alias to a tuple of (files, index)."""
+    files = dict()
+    indexes = dict()
+    with open(fname, newline="") as fh:
+        for row in csv.DictReader(fh, delimiter="\t"):
+            files.setdefault(row["alias"], []).append(row["path"])
+            if row.get("index"):
+                indexes[row["alias"]] = row["index"]
+    samples = dict()
+    for alias, paths in files.items():
+        index = indexes.get(alias)
+        if index is None and len(paths) == 1 and os.path.exists(f"{paths[0]}.bai"):
+            index = f"{paths[0]}.bai"
+        samples[alias] = (paths, index)
+    return samples
+
+
+def choose_branch(
+        n_files, is_unaligned, is_sorted, index_valid, keep_unaligned=False,
+        n_open_files_limit=N_OPEN_FILES_LIMIT):
+    """Return how ingress should prepare a sample, as in its `branch`."""
+    if not keep_unaligned and is_unaligned:
+        n_files = 0
+    if n_files == 0:
+        return "no_files"
+    if n_files == 1 and (is_unaligned or is_sorted):
+        # an invalid index is regenerated like a missing one
+        return "indexed" if index_valid else "to_index"
+    if n_files == 1 or n_files > n_open_files_limit or is_unaligned:
+        return "to_catsort"
+    if not is_sorted:
+        return "to_sortmerge"
+    return "to_merge"
+
+
+def plan_samples(samples, threads=1, keep_unaligned=False):
+    """Return the plan of each sample.
+
+    :param samples: dict of sample alias to a tuple of (files, index).
+    """
+    all_files = [f for files, _ in samples.values() for f in files]
+    # Reading all headers, rather than stopping at the first mismatch as
+    # `check_bam_headers_in_dir` does, gives the run IDs of every file.
+    headers = iter(list(read_headers(all_files, threads=threads)))
+    plans = []
+    for alias, (files, index) in samples.items():
+        sample_headers = [next(headers) for _ in files]
+        is_unaligned, mixed_headers, is_sorted = check_headers(sample_headers)
+        run_ids = set()
+        basecall_models = set()
+        for header in sample_headers:
+            run_ids.update(header.run_ids)
+            basecall_models.update(header.basecall_models)
+        plans.append({
+            "alias": alias,
+            "files": files,
+            "index": index,
+            "is_unaligned": is_unaligned,
+            "is_sorted": is_sorted,
+            "mixed_headers": mixed_headers,
+            "index_valid": None,
+            "branch": None,
+            "run_ids": sorted(run_ids),
+            "basecall_models": sorted(basecall_models),
+        })
+        count_records("samples")
+
+    # only indexes of samples that could be used as they are need checking
+    to_validate = [
+        plan for plan in plans
+        if not plan["mixed_headers"] and plan["index"] is not None
+        and choose_branch(
+            len(plan["files"]), plan["is_unaligned"], plan["is_sorted"], True,
+            keep_unaligned=keep_unaligned) == "indexed"]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = executor.map(
+            lambda plan: validate_xam_index(plan["files"][0], plan["index"]),
+            to_validate)
+        for plan, index_valid in zip(to_validate, results):
+            plan["index_valid"] = index_valid
+
+    for plan in plans:
+        if not plan["mixed_headers"]:
+            plan["branch"] = choose_branch(
+                len(plan["files"]), plan["is_unaligned"], plan["is_sorted"],
+                plan["index_valid"], keep_unaligned=keep_unaligned)
+    return plans
+
+
+def main(args):
+    """Run the entry point."""
+    logger = get_named_logger("xamPreflight")
+
+    samples = read_manifest(args.manifest)
+    if not samples:
+        raise ValueError(f"No files found in manifest '{args.manifest}'.")
+    plans = plan_samples(
+        samples, threads=args.threads, keep_unaligned=args.keep_unaligned)
+    for plan in plans:
+        if plan["mixed_headers"]:
+            logger.warning(f"Found mixed headers in (u)BAM files of '{plan['alias']}'.")
+
+    if args.output is None:
+        json.dump(plans, sys.stdout, indent=4)
+    else:
+        with open(args.output, "w") as fh:
+            json.dump(plans, fh, indent=4)
+    logger.info(f"Planned ingress of {len(plans)} samples.")
+
+
+def argparser():
+    """Argument parser for entrypoint."""
+    parser = wf_parser("xam_preflight")
+    parser.add_argument(
+        "manifest", type=Path,
+        help="TSV with the columns alias and path, and optionally index")
+    parser.add_argument(
+        "-o", "--output", type=Path,
+        help="File to write the JSON plan to, rather than stdout")
+    parser.add_argument(
+        "--keep-unaligned", action="store_true",
+        help=(
+            "Plan to keep samples of only unaligned files, as ingress does with "
+            "`keep_unaligned`"))
+    parser.add_argument(
+        "--threads", type=int, default=1,
+        help="Number of threads reading headers and indexes (mostly I/O bound)")
+    return parser
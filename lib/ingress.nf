@@ -662,8 +662,10 @@ process checkBamHeaders {
             env(IS_SORTED),
         )
     script:
+    // reading headers is I/O bound so we use more threads than CPUs, which helps
+    // most with many small files on network filesystems
     """
-    workflow-glue check_bam_headers_in_dir input_dir > env.vars
+    workflow-glue check_bam_headers_in_dir input_dir --threads 8 > env.vars
     source env.vars
     """
 }
@@ -1,10 +1,15 @@
 from collections import defaultdict
 from pathlib import Path
 import re
+import sys
 
 import pandas as pd
 import pysam
 
+# share the XAM header reader with workflow-glue
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bin"))
+from workflow_glue.wfg_helpers.xam_header import read_header  # noqa: E402
+
 
 INPUT_TYPES_EXTENSIONS = {
     "fastq": ["fastq", "fastq.gz", "fq", "fq.gz"],
@@ -269,24 +274,19 @@ def is_unaligned(path, params):
     else:
         raise ValueError("`path` is neither file nor directory.")
 
-    first_sq_lines = None
+    first_header = None
     for target_file in target_files:
-        with pysam.AlignmentFile(target_file, check_sq=False) as f:
-            sq_lines = [{
-                "SN": sq["SN"],
-                "LN": sq["LN"],
-                "M5": sq.get("M5"),
-            } for sq in f.header.get("SQ", [])]
-        if first_sq_lines is None:
+        header = read_header(target_file)
+        if first_header is None:
             # first file
-            first_sq_lines = sq_lines
+            first_header = header
         else:
             # subsequent file
-            if first_sq_lines != sq_lines:
+            if first_header.sq_digest != header.sq_digest:
                 raise ValueError(f"'{path}' contains (u)BAM files with mixed headers.")
     # if no error was raised, all files had the same `@SQ` files and we can determine
     # `is_unaligned` based on the `@SQ` lines of the first file
-    return not first_sq_lines
+    return first_header is None or not first_header.n_sq
 
 
 def get_valid_inputs(input_path, input_type, output_type, sample_sheet, params):